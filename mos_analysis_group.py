@@ -6,11 +6,19 @@ Created on Fri Feb 26 14:25:09 2021
 @author: Bryce
 
 --- deSCRIPTION ---
-
-
+    - group maps per muscle from the subjects' standard-space (warped) heatmaps: mean, SD and coverage (number of
+      subjects with a non-zero heatmap at each voxel), reduced one heatmap at a time so memory does not grow with
+      the cohort. The 4D concatenated file is only written if 'group concatenated' is set
+    - the running sums behind the group maps are saved per muscle (<muscle>_group_accumulator.npz, with the content
+      hash, size and mtime of each subject's heatmap), so each run only adds new subjects / subtracts dropped ones,
+      and only hashes heatmaps whose size or mtime changed
+    - group hotspot / center of mass, and each subject's distance to them, saved to cohort_mapping_results.xlsx
+    - each subject heatmap's hotspot / center of mass (and a short summary) is kept in a sidecar next to the
+      heatmap (<heatmap>_metrics.json), written in the same pass that reads it for the group maps. Later group
+      runs only load heatmaps that are new or changed since their sidecar was written
 """
 
-import os, logging
+import os, logging, json
 import numpy as np
 from scipy import ndimage as ndi
 from nipype.interfaces import fsl
@@ -20,12 +28,25 @@ from scipy.spatial import distance
 import pandas as pd
 
 import mos_load_data_multi_muscle
+import mos_operators
+import mos_cache
+import mos_storage
+import mos_writer
 
 parent_logger = logging.getLogger('main')
 
 def main(data_dict, config_dict):
+    # returns True once every group map has been written (for the command line's exit code)
     
     file_atlas = str(config_dict['atlas'])
+    # the N x X x Y x Z concatenated heatmaps file is optional (not needed for the group maps)
+    save_concatenated = config_dict.get('group concatenated', 0)
+    if hasattr(save_concatenated, 'get'):
+        save_concatenated = save_concatenated.get()
+    # data types the group maps are saved as (mos_storage)
+    storage = mos_storage.storage_option(config_dict)
+    # group maps are compressed in background threads (mos_writer)
+    mos_writer.start(config_dict)
     save_dir_parent = data_dict['save_dir']
     save_dir_group = save_dir_parent+'/Group_analysis/'
     os.makedirs(save_dir_group,exist_ok=True)
@@ -47,16 +68,31 @@ def main(data_dict, config_dict):
             # key is the muscle name.
             heatmap_concatenated = os.path.join(save_dir_group, key+'_heatmaps_concatenated.nii.gz')
             heatmap_group_average = os.path.join(save_dir_group, key+'_heatmaps_averaged.nii.gz')
-        
-            if not os.path.isfile(heatmap_concatenated) and not os.path.isfile(heatmap_group_average):
-                parent_logger.info('Concatenating warped maps and producing an average '+key+' map')
-                merge_and_mean(muscle_heatmap_dict[key], heatmap_concatenated, heatmap_group_average)
+            heatmap_group_sd = os.path.join(save_dir_group, key+'_heatmaps_sd.nii.gz')
+            heatmap_group_coverage = os.path.join(save_dir_group, key+'_heatmaps_coverage.nii.gz')
+            file_accumulator = os.path.join(save_dir_group, key+'_group_accumulator.npz')
+            
+            # bring the muscle's running sums up to date with the subject heatmaps found this time
+            accumulator, accumulator_changed = update_group_accumulator(muscle_heatmap_dict[key], file_accumulator)
+            map_average, map_sd, map_coverage = group_maps(accumulator)
+            if accumulator_changed or not all(os.path.isfile(group_map) for group_map in [heatmap_group_average, heatmap_group_sd, heatmap_group_coverage]):
+                parent_logger.info('Saving mean, SD and coverage '+key+' maps')
+                mos_writer.save(mos_storage.nifti_image(map_average, accumulator['affine'], 'heatmap', storage), heatmap_group_average)
+                mos_writer.save(mos_storage.nifti_image(map_sd, accumulator['affine'], 'heatmap', storage), heatmap_group_sd)
+                mos_writer.save(nib.Nifti1Image(map_coverage, accumulator['affine']), heatmap_group_coverage)
             else:
-                parent_logger.info('Concatenated and averaged heatmaps for '+key+' already produced')
+                parent_logger.info('Averaged heatmaps for '+key+' already up to date')
+            
+            if save_concatenated == 1 and (accumulator_changed or not os.path.isfile(heatmap_concatenated)):
+                parent_logger.info('Concatenating warped '+key+' maps')
+                merge_heatmaps(muscle_heatmap_dict[key], heatmap_concatenated, mos_operators.use_native(config_dict), storage)
 
+            # each subject's hotspot / center of mass, from the sidecars (only missing ones load their heatmap)
+            subject_summaries = heatmap_summaries(muscle_heatmap_dict[key])
+            
             #simple, load in averaged heatmap and use numpy / scipy methods to calculate these metrics
             parent_logger.info('Calculating average '+key+' map hotspot and center of mass')
-            averaged_metrics = calculate_group_average_metrics(heatmap_group_average, file_atlas)
+            averaged_metrics = calculate_group_average_metrics(map_average, file_atlas)
             average_hotspot = averaged_metrics[0]
             average_com = averaged_metrics[1]
         
@@ -66,14 +102,19 @@ def main(data_dict, config_dict):
 
             # Calculate distance from each heatmap to group average heatmap hotspot + COM
             parent_logger.info('Calculating euclidean distance from patient '+key+' hotspot/COM to group average '+key+' hotspot/COM')
-            distance_metrics = distance_to_average(muscle_heatmap_dict[key], average_hotspot, average_com, file_atlas)
+            distance_metrics = distance_to_average(subject_summaries, average_hotspot, average_com, file_atlas)
 
             # Save these values to an excel sheet?
             store_info(key, muscle_heatmap_dict[key], distance_metrics, average_hotspot, average_com, output_spreadsheet)
 
     parent_logger.info('Saving groupwise results in Group_analysis subfolder')
     print_spreadsheet(save_dir_group, output_spreadsheet)
+    # the group analysis is only complete once every map has been compressed
+    all_written = mos_writer.drain()
+    if not all_written:
+        parent_logger.error('some group maps could not be written, see above')
     parent_logger.info('MOSAICS group analysis completed!')
+    return all_written
 
 def construct_heatmap_list(data_dict, save_dir_parent):
        
@@ -105,13 +146,151 @@ def construct_heatmap_list(data_dict, save_dir_parent):
             
     return muscle_heatmap_dict
     
-def merge_and_mean(muscle_heatmaps, heatmap_concatenated, heatmap_group_average):
+def update_group_accumulator(muscle_heatmaps, file_accumulator):
+    # Loads the muscle's saved accumulator and updates it to match muscle_heatmaps ([tag, heatmap] entries):
+    # new subjects are added and dropped subjects subtracted, reading one heatmap each. A heatmap that has changed
+    # since it was added can't be subtracted (its old contents are gone), nor can a dropped one that is no longer
+    # on disk, so the accumulator is then rebuilt from every heatmap. Returns the accumulator and whether it changed
+    
+    accumulator = load_group_accumulator(file_accumulator)
+    previous = dict() if accumulator is None else accumulator['subjects']
+    current = dict()
+    for list_entry in muscle_heatmaps:
+        current[list_entry[0]] = heatmap_entry(list_entry[1], previous.get(list_entry[0]))
+    
+    rebuild = accumulator is None
+    if not rebuild:
+        removed = [tag for tag in previous if tag not in current]
+        replaced = [tag for tag in previous if tag in current and previous[tag][1] != current[tag][1]]
+        added = [tag for tag in current if tag not in previous]
+        rebuild = len(replaced) > 0 or not all(os.path.isfile(previous[tag][0]) and
+                                               heatmap_entry(previous[tag][0], previous[tag])[1] == previous[tag][1]
+                                               for tag in removed)
+    
+    if rebuild:
+        parent_logger.info('building group accumulator from '+str(len(current))+' heatmaps')
+        data_first = nib.load(muscle_heatmaps[0][1])
+        accumulator = new_group_accumulator(data_first.shape, data_first.affine)
+        for tag in current:
+            add_group_heatmap(accumulator, tag, current[tag])
+    elif len(removed) + len(added) > 0:
+        parent_logger.info('updating group accumulator: '+str(len(added))+' subjects added, '+str(len(removed))+' removed')
+        for tag in removed:
+            subtract_group_map(accumulator, nib.load(previous[tag][0]).get_fdata())
+            del accumulator['subjects'][tag]
+        for tag in added:
+            add_group_heatmap(accumulator, tag, current[tag])
+    else:
+        # same heatmaps. Sizes / mtimes are refreshed if any changed (a heatmap rewritten with the same contents,
+        # an accumulator from before they were kept), so those heatmaps are not hashed again next run
+        if any(previous[tag] != current[tag] for tag in current):
+            accumulator['subjects'] = current
+            save_group_accumulator(file_accumulator, accumulator)
+        return accumulator, False
+    
+    for tag in current:
+        accumulator['subjects'][tag] = current[tag]
+    save_group_accumulator(file_accumulator, accumulator)
+    return accumulator, True
+
+def heatmap_entry(heatmap, previous_entry=None):
+    # [heatmap, content hash, size, mtime_ns] of an accumulator subject. The file is only hashed if its size or
+    # mtime differ from previous_entry's (as for the _metrics.json sidecars), so unchanged heatmaps are not read
+    stat = os.stat(heatmap)
+    if previous_entry is not None and list(previous_entry) == [heatmap, previous_entry[1], stat.st_size, stat.st_mtime_ns]:
+        return previous_entry
+    return [heatmap, mos_cache.file_digest(heatmap), stat.st_size, stat.st_mtime_ns]
+
+def add_group_heatmap(accumulator, tag, entry):
+    heatmap = entry[0]
+    map_heatmap = nib.load(heatmap).get_fdata()
+    if map_heatmap.shape != accumulator['sum'].shape:
+        raise ValueError(heatmap+' is '+str(map_heatmap.shape)+', other heatmaps are '+str(accumulator['sum'].shape))
+    accumulate_group_map(accumulator, map_heatmap)
+    accumulator['subjects'][tag] = entry
+    # subject metrics from the same read of the heatmap
+    if load_heatmap_summary(heatmap) is None:
+        save_heatmap_summary(heatmap, summarize_heatmap(map_heatmap))
+
+def new_group_accumulator(shape, affine):
+    # running sum, sum of squares and non-zero count of the heatmaps added so far, n = number of heatmaps,
+    # subjects = tag -> [heatmap, content hash, size, mtime_ns] of each heatmap added (heatmap_entry),
+    # affine = affine of the group maps
+    return {'sum': np.zeros(shape),
+            'sum of squares': np.zeros(shape),
+            'coverage': np.zeros(shape, dtype=np.int16),
+            'n': 0,
+            'affine': affine,
+            'subjects': dict()}
+
+def accumulate_group_map(accumulator, map_heatmap):
+    accumulator['sum'] += map_heatmap
+    accumulator['sum of squares'] += np.square(map_heatmap)
+    accumulator['coverage'] += map_heatmap > 0
+    accumulator['n'] += 1
+
+def subtract_group_map(accumulator, map_heatmap):
+    accumulator['sum'] -= map_heatmap
+    accumulator['sum of squares'] -= np.square(map_heatmap)
+    accumulator['coverage'] -= map_heatmap > 0
+    accumulator['n'] -= 1
+    # voxels no remaining subject covers are exactly zero again, rather than rounding residue
+    accumulator['sum'][accumulator['coverage'] == 0] = 0
+    accumulator['sum of squares'][accumulator['coverage'] == 0] = 0
+
+def group_maps(accumulator):
+    # mean, SD (n - 1, as fslmaths -Tstd) and coverage maps from an accumulator (SD is zero for a single heatmap).
+    # The mean is the same as fslmaths -Tmean of the concatenated heatmaps
+    n = accumulator['n']
+    map_average = accumulator['sum'] / n
+    # sum of squared deviations, clipped at zero where rounding makes it very slightly negative
+    map_deviations = np.maximum(accumulator['sum of squares'] - accumulator['sum'] * map_average, 0)
+    map_sd = np.sqrt(map_deviations / max(n - 1, 1))
+    
+    return map_average, map_sd, accumulator['coverage']
+
+def load_group_accumulator(file_accumulator):
+    if not os.path.isfile(file_accumulator):
+        return None
+    try:
+        with np.load(file_accumulator, allow_pickle=False) as saved:
+            accumulator = {'sum': saved['sum'],
+                           'sum of squares': saved['sum_of_squares'],
+                           'coverage': saved['coverage'],
+                           'n': int(saved['n']),
+                           'affine': saved['affine'],
+                           'subjects': json.loads(str(saved['subjects']))}
+    except (OSError, KeyError, ValueError):
+        parent_logger.warning('group accumulator '+file_accumulator+' could not be read, rebuilding it')
+        return None
+    return accumulator
+
+def save_group_accumulator(file_accumulator, accumulator):
+    # written under a temporary name and swapped in, so an interrupted run leaves the previous accumulator
+    with open(file_accumulator+'.tmp', 'wb') as f:
+        np.savez(f, sum=accumulator['sum'],
+                 sum_of_squares=accumulator['sum of squares'],
+                 coverage=accumulator['coverage'],
+                 n=accumulator['n'],
+                 affine=accumulator['affine'],
+                 subjects=json.dumps(accumulator['subjects']))
+    os.replace(file_accumulator+'.tmp', file_accumulator)
+
+def merge_heatmaps(muscle_heatmaps, heatmap_concatenated, native_ops=False, storage=mos_storage.STORAGE_LIST[0]):
+    # optional 4D (fslmerge -t) file of all subject heatmaps, not used for the group maps
 
     heatmap_list = list()
     # heatmap_list is a list with two values per entry, first is the tag and
     # second is the location of a warped heatmap for the muscle for that subject
     for list_entry in muscle_heatmaps:
         heatmap_list.append(list_entry[1])
+    
+    if native_ops:
+        # same output as fslmerge below, header and affine taken from the first heatmap
+        data_first = nib.load(heatmap_list[0])
+        map_concatenated = mos_operators.merge([nib.load(heatmap).get_fdata() for heatmap in heatmap_list])
+        mos_writer.save(mos_storage.nifti_image(map_concatenated, data_first.affine, 'heatmap', storage), heatmap_concatenated)
+        return
         
     merge_heatmaps = fsl.Merge()
     merge_heatmaps.inputs.in_files = heatmap_list
@@ -120,21 +299,11 @@ def merge_and_mean(muscle_heatmaps, heatmap_concatenated, heatmap_group_average)
     merge_heatmaps.inputs.output_type = 'NIFTI_GZ'
     # parent_logger.critical(merge_heatmaps.cmdline)
     merge_results = merge_heatmaps.run()
-    
-    mean_heatmap = fsl.MeanImage()
-    mean_heatmap.inputs.in_file = heatmap_concatenated
-    mean_heatmap.inputs.dimension = 'T'
-    mean_heatmap.inputs.out_file = heatmap_group_average
-    mean_heatmap.inputs.output_type = 'NIFTI_GZ'
-    # parent_logger.critical(mean_heatmap.cmdline)
-    mean_result = mean_heatmap.run()
-
-def calculate_group_average_metrics(heatmap_group_average, file_atlas):
+
+def calculate_group_average_metrics(averaged_heatmap, file_atlas):
     
     # ~~~~~~CALCULATE METRICS (group average map)~~~~~~
-    
-    # load back in masked heatmap to calculate metrics
-    averaged_heatmap = nib.load(heatmap_group_average).get_fdata()        
+    # averaged_heatmap = mean map from the group accumulator
     
     # HOTSPOT:
     # raw MEP from the stim data, and smoothed (post-Gaussian filter), needed to normalize patient heatmap
@@ -154,27 +323,68 @@ def calculate_group_average_metrics(heatmap_group_average, file_atlas):
 
     return average_hotspot, average_center_mass
 
-def distance_to_average(muscle_heatmaps, average_hotspot, average_com, file_atlas):
-    
-    heatmap_list = list()
-    # heatmap_list is a list with two values per entry, first is the tag and
-    # second is the location of a warped heatmap for the muscle for that subject
+def summarize_heatmap(map_heatmap):
+    # hotspot and center of mass (voxel coordinates) of one subject heatmap, plus a short summary of the map
+    summary = dict()
+    summary['hotspot'] = [int(i) for i in np.unravel_index(np.argmax(map_heatmap), map_heatmap.shape)]
+    summary['center of mass'] = [float(i) for i in ndi.measurements.center_of_mass(map_heatmap)]
+    summary['max'] = float(np.max(map_heatmap))
+    summary['sum'] = float(np.sum(map_heatmap))
+    summary['non-zero voxels'] = int(np.count_nonzero(map_heatmap))
+    summary['shape'] = list(map_heatmap.shape)
+    return summary
+
+def heatmap_summary_file(heatmap):
+    return heatmap.replace('.nii.gz','').replace('.nii','')+'_metrics.json'
+
+def load_heatmap_summary(heatmap):
+    # sidecar summary of a heatmap, or None if there is none or the heatmap has changed since it was written
+    file_summary = heatmap_summary_file(heatmap)
+    if not os.path.isfile(file_summary):
+        return None
+    try:
+        with open(file_summary) as f:
+            summary = json.load(f)
+    except ValueError:
+        return None
+    stat = os.stat(heatmap)
+    if summary.get('heatmap size') != stat.st_size or summary.get('heatmap mtime') != stat.st_mtime_ns:
+        return None
+    return summary
+
+def save_heatmap_summary(heatmap, summary):
+    # the heatmap's size and modification time are stored to tell when the sidecar is out of date
+    stat = os.stat(heatmap)
+    summary = dict(summary, **{'heatmap size': stat.st_size, 'heatmap mtime': stat.st_mtime_ns})
+    with open(heatmap_summary_file(heatmap)+'.tmp', 'w') as f:
+        json.dump(summary, f, indent=1)
+    os.replace(heatmap_summary_file(heatmap)+'.tmp', heatmap_summary_file(heatmap))
+
+def heatmap_summaries(muscle_heatmaps):
+    # summaries of all subject heatmaps for one muscle, in muscle_heatmaps order, loading only the heatmaps
+    # without an up to date sidecar
+    summaries = list()
     for list_entry in muscle_heatmaps:
-        heatmap_list.append(list_entry[1])
+        summary = load_heatmap_summary(list_entry[1])
+        if summary is None:
+            summary = summarize_heatmap(nib.load(list_entry[1]).get_fdata())
+            save_heatmap_summary(list_entry[1], summary)
+        summaries.append(summary)
+    return summaries
+
+def distance_to_average(subject_summaries, average_hotspot, average_com, file_atlas):
+    # subject_summaries: heatmap_summaries() of the muscle's subject heatmaps, in the same order
     
     distance_metrics = list()
     
     atlas_affine = nib.load(file_atlas)
     atlas_affine = atlas_affine.affine
     
-    for index in range(0,len(heatmap_list)):
-        
-        subject_heatmap = nib.load(heatmap_list[index]).get_fdata()
-        # calculate subject hotspot
-        subject_hotspot = np.unravel_index(np.argmax(subject_heatmap), subject_heatmap.shape)
+    for index in range(0,len(subject_summaries)):
         
-        # calculate subject com
-        subject_com = ndi.measurements.center_of_mass(subject_heatmap)
+        # subject hotspot and com (voxel coordinates), from the heatmap's summary
+        subject_hotspot = tuple(subject_summaries[index]['hotspot'])
+        subject_com = tuple(subject_summaries[index]['center of mass'])
         
         # -- Convert standard space hotspot / COM from voxel coordinates to SD anatomical coords (mm)
         ## Hotspot
@@ -18,6 +18,7 @@ MOSAICS - Mapping of sensory activation hotspots during cortical stimulation
 # export FSLDIR PATH
     
 import os
+import json
 import nibabel as nib
 from nibabel.affines import apply_affine
 import pandas as pd
@@ -25,18 +26,58 @@ import numpy as np
 from scipy import ndimage as ndi
 from nipype.interfaces import fsl
 import logging
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from logging.handlers import QueueHandler, QueueListener
 
+import mos_find_datasets
 import mos_skullstrip
 import mos_warp_to_mni
 import mos_load_data_multi_muscle
+import mos_operators
+import mos_splat
+import mos_cache
+import mos_storage
+import mos_writer
+import mos_journal
+import mos_sites
 
 parent_logger = logging.getLogger('main')
 
+# peak bytes per T1 voxel held by one muscle (standard / memory-lean per-muscle path, see process_muscle;
+# a batch holds the standard amount for every muscle at once), and by a subject whatever its muscles do
+MUSCLE_BYTES_PER_VOXEL = {False: 72, True: 28}
+SUBJECT_BYTES_PER_VOXEL = 16
+
+# columns of mapping_results.xlsx, one row per subject muscle (process_muscle)
+RESULTS_COLUMNS = ['Subject File Name',
+                   'Muscle',
+                   'Hotspot X',
+                   'Hotspot Y',
+                   'Hotspot Z',
+                   'Max MEP',
+                   'COM X',
+                   'COM Y',
+                   'COM Z',
+                   'Map area (mm^2)',
+                   'Map volume (mm^2 * mV)',
+                   'SD Hotspot X',
+                   'SD Hotspot Y',
+                   'SD Hotspot Z',
+                   'SD COM X',
+                   'SD COM Y',
+                   'SD COM Z',
+                   'Coordinates Used',
+                   'Dilation (mm)',
+                   'Smoothing kernel (mm)',
+                   'MEP threshold (%)']
+
 def main(data_dict, config_dict):  
+    # returns True if every subject was processed and every output written (for the command line's exit code)
 
     print()
     # ~~~~~~ SET UP GLOBAL VARIABLES ~~~~~~
-    data_folder = data_dict['data folder']
     data_list = data_dict['data list']
 
     if len(data_list) != 0:
@@ -46,94 +87,396 @@ def main(data_dict, config_dict):
         # # save directory
         save_dir_parent = str(data_dict['save_dir'])
         
-        # dilate variable
-        dilate = int(config_dict['dilate'])
-        # smooth variable
-        smooth = int(config_dict['smooth'])
-        # MEP threshold
-        MEP_thresh = int(config_dict['MEP_threshold'])
-        # Grid spacing
-        grid_spacing = int(data_dict['grid spacing'])
-        
-        file_atlas = str(config_dict['atlas'])
+        # plain-value copy of both dicts (tk variables resolved), used by every subject / worker process
+        settings = analysis_settings(data_dict, config_dict)
+        # sharding (a cohort split across machines): this run only processes its shard's subjects and saves
+        # their rows to a shard file, merge_shards() assembles mapping_results.xlsx once every shard is done
+        shard_index, shard_count = shard_option(settings)
+        shard_subjects = mos_find_datasets.shard_indices(len(data_list), shard_index, shard_count)
+        if shard_count > 1:
+            parent_logger.info('shard '+str(shard_index)+' of '+str(shard_count)+': processing '+
+                               str(len(shard_subjects))+' of '+str(len(data_list))+' subjects')
+            data_list = [data_list[index] for index in shard_subjects]
+        # run journal: every finished muscle's row is journaled, a resumed run skips them (see mos_journal)
+        settings['journal'] = mos_journal.journal_file(save_dir_parent, shard_index, shard_count)
+        mos_journal.start(settings['journal'], settings.get('resume', 0) == 1)
+        if settings['in memory'] == 1 and not mos_operators.use_native(settings):
+            parent_logger.warning('in-memory processing requires the native backend, intermediate files will be used')
+        # number of subjects processed at once, each in its own worker process (1 = serial)
+        workers = max(int(settings.get('workers', 1)), 1)
+        # peak memory ceiling (GB, 0 = none): subjects only start while their estimated peaks fit under it,
+        # and a subject's muscle threads are reduced to fit (see memory_plan)
+        memory_limit = float(settings.get('memory limit', 0)) * 1024**3
+        if memory_limit > 0:
+            parent_logger.info('memory limit '+str(settings['memory limit'])+' GB')
+        subject_plans = [memory_plan(subject, settings, memory_limit) for subject in data_list]
+        # final .nii.gz outputs are compressed in background threads (see mos_writer)
+        mos_writer.start(settings)
         
         # Initialize a list before our for loop so we can create a dataframe to
-        # output for our results spreadsheet!
-        results_column_names = ['Subject File Name',
-                                'Muscle',
-                                'Hotspot X',
-                                'Hotspot Y',
-                                'Hotspot Z',
-                                'Max MEP',
-                                'COM X',
-                                'COM Y',
-                                'COM Z',
-                                'Map area (mm^2)',
-                                'Map volume (mm^2 * mV)',
-                                'SD Hotspot X',
-                                'SD Hotspot Y',
-                                'SD Hotspot Z',
-                                'SD COM X',
-                                'SD COM Y',
-                                'SD COM Z',
-                                'Coordinates Used',
-                                'Dilation (mm)',
-                                'Smoothing kernel (mm)',
-                                'MEP threshold (%)']
-        results_metrics_list = list()
+        # output for our results spreadsheet! (one list of rows per subject, columns in RESULTS_COLUMNS)
+        subject_results = [list() for subject in data_list]
+        run_complete = True
+        # names of the subjects that failed, reported at the end
+        failed_subjects = list()
         
-        for subject in data_list:
-            
-            # ~~~~~~SET UP SUBJECT-SPECIFIC VARIABLES~~~~~~
-            
-            # data_list constructed, and these variables determined, by mos_find_datasets.py
-            # tag = subj name, stim_name = name of stimulation data (everything before .xls(x) extension),
-            # structural = nii*, stim_data = xls*
-            tag = subject[0]
+        # each subject returns its metric rows, which are kept in data list order. A subject that fails
+        # is logged and left out of the spreadsheet rather than stopping the whole run
+        if len(data_list) == 0:
+            # (a shard with no subjects)
+            pass
+        elif workers == 1:
+            # pipelined: while a subject computes, the next subject's T1 header and stimulation data are read
+            # in a background thread (one subject ahead, so only one is held), and the previous subject's
+            # outputs are still compressing in mos_writer's threads
+            with ThreadPoolExecutor(max_workers=1) as prefetcher:
+                next_inputs = prefetcher.submit(prefetch_subject, data_list[0], settings)
+                for index, (subject, (subject_memory, subject_settings)) in enumerate(zip(data_list, subject_plans)):
+                    subject_inputs = next_inputs.result()
+                    if index + 1 < len(data_list):
+                        next_inputs = prefetcher.submit(prefetch_subject, data_list[index + 1], settings)
+                    try:
+                        subject_results[index] = process_subject(subject, subject_settings, subject_inputs)
+                    except Exception:
+                        parent_logger.exception('processing '+subject[0]+' failed, moving on to the next subject')
+                        failed_subjects.append(subject[0])
+                        run_complete = False
+            # the run is only complete once every output has been compressed
+            if not mos_writer.drain():
+                parent_logger.error('some outputs could not be written, see above')
+                run_complete = False
+        else:
+            parent_logger.info('processing '+str(len(data_list))+' subjects with '+str(workers)+' worker processes')
+            # workers log through a queue, re-emitted here by the 'main' logger (and so the GUI)
+            mp_context = multiprocessing.get_context('spawn')
+            log_queue = mp_context.Queue()
+            log_listener = QueueListener(log_queue, ParentLogForwarder())
+            log_listener.start()
+            try:
+                with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=init_worker,
+                                         initargs=(log_queue, parent_logger.getEffectiveLevel())) as executor:
+                    # subjects start in data list order, while a worker is free and the estimated memory of
+                    # everything running stays under the limit (a subject over the limit by itself runs alone)
+                    pending = list(range(len(data_list)))
+                    running = dict()
+                    memory_used = 0
+                    while pending or running:
+                        while pending and len(running) < workers and \
+                                (not running or memory_limit <= 0 or memory_used + subject_plans[pending[0]][0] <= memory_limit):
+                            index = pending.pop(0)
+                            running[executor.submit(process_subject_written, data_list[index], subject_plans[index][1])] = index
+                            memory_used += subject_plans[index][0]
+                        done, not_done = wait(running, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            index = running.pop(future)
+                            memory_used -= subject_plans[index][0]
+                            try:
+                                subject_results[index] = future.result()
+                            except Exception as error:
+                                parent_logger.error('processing '+data_list[index][0]+' failed ('+repr(error)+'), moving on to the next subject')
+                                failed_subjects.append(data_list[index][0])
+                                run_complete = False
+            finally:
+                log_listener.stop()
     
-            file_t1 = os.path.join(data_folder,subject[1])
-            file_nibs_map = os.path.join(data_folder,subject[2])
-            
-            #save directory, including sub-directory for each subject
-            save_dir = str(data_dict['save_dir']+'/'+tag)
-            
-            # # Create output directory
-            os.makedirs(save_dir,exist_ok=True)
-            
-            # ~~~~~~THINGS TO DO ONCE PER SUBJECT~~~~~~   
-
-            parent_logger.info('')
-            parent_logger.info('processing '+tag+', stim data: '+file_nibs_map)
+    
+        # ~~~~~~print values to spreadsheet after the loop has completed~~~~~~
+        if shard_count > 1:
+            save_shard_results(save_dir_parent, shard_index, shard_count, data_dict['data list'], settings,
+                               zip(shard_subjects, subject_results), run_complete)
+        else:
+            save_results([row for rows in subject_results for row in rows], save_dir_parent)
+    
+        if run_complete:
+            parent_logger.info('MOSAICS main analysis completed successfully!')
+        elif len(failed_subjects) > 0:
+            parent_logger.warning('MOSAICS main analysis finished incomplete, '+str(len(failed_subjects))+' of '+
+                                  str(len(data_list))+' subjects failed and are left out of the results: '+
+                                  ', '.join(failed_subjects))
+        else:
+            # (every subject ran, but some outputs could not be written)
+            parent_logger.warning('MOSAICS main analysis finished incomplete, some outputs could not be written')
+        return run_complete
         
-            # ~~~~~~LOAD DATA~~~~~~
-            # Read in a 1mm isotropic T1-weighted MRI .nii
-            data_T1 = nib.load(file_t1)
-            
-            # ~~~~~~STRIP T1 image~~~~~~
-            # reminder, brainmask check = 0 if user does not provide their own brainmask and
-            # MOSAICS is to devise its own (we use default BET settings)
-            if data_dict['brainmask check'].get() == 0:
-                # if and elif check if brainmask exists in data folder and save dir (in that order)
-                # if it doesn't exist, run BET skullstripping
-                if os.path.isfile(os.path.join(data_folder, tag+data_dict['brainmask suffix'])):
-                    ps_brainmask = os.path.abspath(os.path.join(data_folder, tag+data_dict['brainmask suffix']))
-                elif os.path.isfile(os.path.join(save_dir, tag+data_dict['brainmask suffix'])):
-                    ps_brainmask = os.path.abspath(os.path.join(save_dir, tag+data_dict['brainmask suffix']))
-                else:
-                    parent_logger.info('performing BET skull stripping')
-                    ps_brainmask = mos_skullstrip.main(tag, file_t1, data_folder, save_dir)
-            elif data_dict['brainmask check'].get() == 1:
-                # if and elif check if brainmask exists in data folder and save dir (in that order)
-                # if it doesn't exist, run BET skullstripping
-                if os.path.isfile(os.path.join(data_folder, tag+data_dict['brainmask suffix'])):
-                    ps_brainmask = os.path.abspath(os.path.join(data_folder, tag+data_dict['brainmask suffix']))
-                elif os.path.isfile(os.path.join(save_dir, tag+data_dict['brainmask suffix'])):
-                    ps_brainmask = os.path.abspath(os.path.join(save_dir, tag+data_dict['brainmask suffix']))
-                else:
-                    parent_logger.warning('supplied brainmask not found, creating our own.')
-                    parent_logger.info('performing BET skull stripping')
-                    ps_brainmask = mos_skullstrip.main(tag, file_t1, data_folder, save_dir)
-            
+    else:
+        
+        parent_logger.error('No subjects found for processing, MOSAICS processing not run')
+        return False
+
+def save_results(results_metrics_list, save_dir_parent):
+    # mapping_results.xlsx, one row per subject muscle
+    metrics_dataframe = pd.DataFrame(results_metrics_list, columns=RESULTS_COLUMNS)    
+    measures_file = os.path.join(save_dir_parent,'mapping_results.xlsx')
+    # (swapped into place once complete)
+    metrics_dataframe.to_excel(os.path.join(save_dir_parent,'mapping_results_tmp.xlsx'))
+    os.replace(os.path.join(save_dir_parent,'mapping_results_tmp.xlsx'), measures_file)
+
+def shard_option(settings):
+    # (shard index, shard count) of a sharded run, (0, 1) = the whole data list
+    return int(settings.get('shard index', 0)), max(int(settings.get('shard count', 1)), 1)
+
+def shard_results_file(save_dir_parent, shard_index, shard_count):
+    return os.path.join(save_dir_parent, 'mapping_results_shard_'+str(shard_index)+'_of_'+str(shard_count)+'.json')
+
+def shard_settings(settings):
+    # the settings that change the results (mos_journal.RESULT_SETTINGS), as stored in a shard file
+    return json.loads(json.dumps({key: settings.get(key) for key in mos_journal.RESULT_SETTINGS}, default=str))
+
+def shard_mismatch(shard, settings):
+    # why a shard file cannot be merged into this run (None if it can): another data list, or other settings
+    # (compared as JSON, which has no tuples)
+    if shard['data list'] != json.loads(json.dumps(settings['data list'])):
+        return 'a different data list'
+    run_settings = shard_settings(settings)
+    changed = [key for key in mos_journal.RESULT_SETTINGS
+               if shard.get('settings', dict()).get(key) != run_settings[key]]
+    if len(changed) > 0:
+        return 'other settings ('+', '.join(changed)+')'
+    return None
+
+def save_shard_results(save_dir_parent, shard_index, shard_count, data_list, settings, shard_rows, run_complete):
+    # one shard's rows, with the data list index of their subject, and the whole data list and the settings
+    # that change the results (so merge_shards() can tell shards of other runs apart). JSON keeps the values'
+    # types for the spreadsheet
+    shard = {'shard index': shard_index,
+             'shard count': shard_count,
+             'data list': data_list,
+             'settings': shard_settings(settings),
+             'complete': run_complete,
+             'rows': [[index, rows] for index, rows in shard_rows]}
+    file_shard = shard_results_file(save_dir_parent, shard_index, shard_count)
+    # write to a temporary file and swap it in, so merge_shards() never reads a partial shard
+    with open(file_shard+'.tmp', 'w') as f:
+        json.dump(shard, f, default=lambda value: value.item() if hasattr(value, 'item') else str(value))
+    os.replace(file_shard+'.tmp', file_shard)
+    parent_logger.info('shard results saved to '+file_shard)
+
+def shards_done(data_dict, config_dict):
+    # True once every shard of the run has saved its results. A shard file left by a run on another data list
+    # or with other settings does not count, its shard has not finished this run yet
+    settings = analysis_settings(data_dict, config_dict)
+    save_dir_parent = str(settings['save_dir'])
+    shard_count = shard_option(settings)[1]
+    for shard_index in range(shard_count):
+        file_shard = shard_results_file(save_dir_parent, shard_index, shard_count)
+        if not os.path.isfile(file_shard):
+            return False
+        with open(file_shard) as f:
+            mismatch = shard_mismatch(json.load(f), settings)
+        if mismatch is not None:
+            parent_logger.info(file_shard+' is left from a run with '+mismatch+', waiting for its shard')
+            return False
+    return True
+
+def merge_shards(data_dict, config_dict):
+    # mapping_results.xlsx of a sharded run, from its shard files, rows in data list order (as an unsharded run).
+    # Returns True if every shard was found and completed all its subjects. Raises ValueError if a shard file
+    # is from a run on another data list or with other settings, so rows of different runs are never mixed
+    settings = analysis_settings(data_dict, config_dict)
+    save_dir_parent = str(settings['save_dir'])
+    shard_count = shard_option(settings)[1]
+    
+    subject_rows = dict()
+    merge_complete = True
+    for shard_index in range(shard_count):
+        file_shard = shard_results_file(save_dir_parent, shard_index, shard_count)
+        if not os.path.isfile(file_shard):
+            parent_logger.error('shard '+str(shard_index)+' of '+str(shard_count)+' has not finished, '+file_shard+' not found')
+            return False
+        with open(file_shard) as f:
+            shard = json.load(f)
+        mismatch = shard_mismatch(shard, settings)
+        if mismatch is not None:
+            raise ValueError(file_shard+' was run with '+mismatch+', not merging. Rerun its shard, or remove it')
+        if not shard['complete']:
+            parent_logger.warning('some subjects of shard '+str(shard_index)+' failed, they are left out')
+            merge_complete = False
+        for index, rows in shard['rows']:
+            subject_rows[index] = rows
+    
+    save_results([row for index in sorted(subject_rows) for row in subject_rows[index]], save_dir_parent)
+    parent_logger.info('merged '+str(shard_count)+' shards into '+os.path.join(save_dir_parent,'mapping_results.xlsx'))
+    return merge_complete
+
+def memory_plan(subject, settings, memory_limit):
+    # Estimated peak memory (bytes) of process_subject() for one subject, and the settings it runs with:
+    # under a memory limit (bytes, 0 = none) its muscle threads are reduced until the estimate fits.
+    # Voxels come from the T1 header and muscles from the (cached) stimulation data. Cropping is not
+    # accounted for, so the estimate is an upper bound
+    if memory_limit <= 0:
+        return 0, settings
+    try:
+        n_voxels = int(np.prod(nib.load(os.path.join(settings['data folder'],subject[1])).shape[:3]))
+        n_muscles = len(mos_load_data_multi_muscle.main(os.path.join(settings['data folder'],subject[2]))['muscles'])
+    except Exception:
+        # an unreadable subject fails (and is reported) in process_subject
+        return 0, settings
+    
+    in_memory = mos_operators.use_native(settings) and settings['in memory'] == 1
+    subject_memory = SUBJECT_BYTES_PER_VOXEL * n_voxels
+    if in_memory and settings['batch muscles'] == 1:
+        subject_memory += MUSCLE_BYTES_PER_VOXEL[False] * n_voxels * n_muscles
+    else:
+        muscle_memory = MUSCLE_BYTES_PER_VOXEL[settings.get('memory lean', 0) == 1] * n_voxels
+        muscle_threads = min(max(int(settings.get('muscle threads', 1)), 1), max(n_muscles, 1))
+        fitting_threads = max(int((memory_limit - subject_memory) // muscle_memory), 1)
+        if fitting_threads < muscle_threads:
+            parent_logger.info(subject[0]+': '+str(fitting_threads)+' muscle threads fit in the memory limit')
+            muscle_threads = fitting_threads
+            settings = dict(settings, **{'muscle threads': muscle_threads})
+        subject_memory += muscle_memory * muscle_threads
+    
+    if subject_memory > memory_limit:
+        parent_logger.warning(subject[0]+' needs about '+str(round(subject_memory / 1024**3, 2))+
+                              ' GB, more than the memory limit, it will be processed on its own')
+    return subject_memory, settings
+
+def process_subject_written(subject, settings):
+    # process_subject() in a worker process: its rows are only handed back once the worker's outputs are written
+    results_metrics_list = process_subject(subject, settings)
+    if not mos_writer.drain():
+        raise RuntimeError('some outputs of '+subject[0]+' could not be written')
+    return results_metrics_list
+
+def prefetch_subject(subject, settings):
+    # the inputs process_subject() reads first (T1 header, parsed stimulation data), loaded ahead of time.
+    # Anything that cannot be read is left out, process_subject() then reads it itself and reports the error
+    subject_inputs = dict()
+    try:
+        subject_inputs['data_T1'] = nib.load(os.path.join(settings['data folder'],subject[1]))
+        subject_inputs['stim_dict'] = mos_load_data_multi_muscle.main(os.path.join(settings['data folder'],subject[2]))
+    except Exception:
+        pass
+    return subject_inputs
+
+def process_subject(subject, settings, subject_inputs=None):
+    # Everything main() does for one [tag, nii, xls] entry of the data list. settings is the plain-value
+    # copy of data_dict / config_dict from analysis_settings(), subject_inputs what prefetch_subject() already
+    # loaded. Returns this subject's metric rows.
+    if subject_inputs is None:
+        subject_inputs = dict()
+    
+    # ~~~~~~ SET UP VARIABLES ~~~~~~
+    data_folder = settings['data folder']
+    # dilate variable
+    dilate = int(settings['dilate'])
+    # smooth variable
+    smooth = int(settings['smooth'])
+    # MEP threshold
+    MEP_thresh = int(settings['MEP_threshold'])
+    # Grid spacing
+    grid_spacing = int(settings['grid spacing'])
+    
+    file_atlas = str(settings['atlas'])
+    # operator backend: in-process numpy ('native', default) or fslmaths through nipype ('FSL')
+    native_ops = mos_operators.use_native(settings)
+    # in memory: per-muscle intermediates stay as arrays, only final maps are written (native backend only)
+    in_memory = native_ops and settings['in memory'] == 1
+    # debug dump: also write (and keep) the intermediate samples / initial / weighted heatmap files
+    debug_dump = settings['debug dump'] == 1
+    # crop: compute each muscle's maps in a box around its stimulation sites (in-memory runs only),
+    # padded by the dilation sphere and Gaussian truncation radius so results match the full volume
+    crop_roi = in_memory and settings['crop to stimulations'] == 1
+    # heatmap engine: Gaussian filter of the whole (cropped) volume, or kernel splatting per stimulation
+    splat_heatmap = settings['heatmap_engine'] == 'Kernel splatting'
+    # site aggregation: the value mapped at a site stimulated more than once (mos_sites)
+    site_aggregation = settings.get('site_aggregation', mos_sites.SITE_AGGREGATIONS[0])
+    # batch: all muscles of a subject processed as one 4D (muscle x volume) array pass, in-memory runs only
+    batch_muscles = in_memory and settings['batch muscles'] == 1
+    # memory lean: each muscle's responses / heatmaps are float32 and weighted / masked in place, the grid is
+    # uint8 and the unused responses array is never allocated (per-muscle path, batches stay float64)
+    memory_lean = settings.get('memory lean', 0) == 1 and not batch_muscles
+    # muscle threads: muscles of this subject processed concurrently, sharing the loaded T1 and brainmask
+    muscle_threads = max(int(settings.get('muscle threads', 1)), 1)
+    # cache: skip stages whose inputs, parameters and backend are unchanged since the last run (see mos_cache)
+    use_cache = settings['use cache'] == 1
+    # storage: data types the output maps are saved as (full precision, or compact float32 / uint8 / int16)
+    storage = mos_storage.storage_option(settings)
+    # (worker processes set up their own output writer)
+    mos_writer.start(settings)
+    
+    results_metrics_list = list()
+    
+    # ~~~~~~SET UP SUBJECT-SPECIFIC VARIABLES~~~~~~
+    
+    # data_list constructed, and these variables determined, by mos_find_datasets.py
+    # tag = subj name, stim_name = name of stimulation data (everything before .xls(x) extension),
+    # structural = nii*, stim_data = xls*
+    tag = subject[0]
+    
+    file_t1 = os.path.join(data_folder,subject[1])
+    file_nibs_map = os.path.join(data_folder,subject[2])
+    
+    #save directory, including sub-directory for each subject
+    save_dir = str(settings['save_dir']+'/'+tag)
+    
+    # # Create output directory
+    os.makedirs(save_dir,exist_ok=True)
+    
+    # ~~~~~~THINGS TO DO ONCE PER SUBJECT~~~~~~   
+
+    parent_logger.info('')
+    parent_logger.info('processing '+tag+', stim data: '+file_nibs_map)
+
+    # ~~~~~~LOAD DATA~~~~~~
+    # Read in a 1mm isotropic T1-weighted MRI .nii
+    if 'data_T1' in subject_inputs:
+        data_T1 = subject_inputs['data_T1']
+    else:
+        data_T1 = nib.load(file_t1)
+    if 'stim_dict' in subject_inputs:
+        stim_dict = subject_inputs['stim_dict']
+    else:
+        stim_dict = mos_load_data_multi_muscle.main(file_nibs_map)
+    # muscle names, and the stimulations' coords / MEPs / responsive arrays (see mos_load_data_multi_muscle)
+    muscles = stim_dict['muscles']
+    mos_load_data_multi_muscle.check_bounds(stim_dict, data_T1.shape, file_nibs_map)
+    
+    # ~~~~~~RESUME: SKIP MUSCLES ALREADY DONE~~~~~~
+    # rows of the muscles a resumed run finished (same inputs and settings, outputs in place), see mos_journal
+    journal_key = None
+    journal_rows = dict()
+    if 'journal' in settings:
+        journal_key = mos_journal.subject_key(subject, settings)
+        if settings.get('resume', 0) == 1:
+            journal_rows = {muscle: row for (key, muscle), row in mos_journal.load(settings['journal']).items()
+                            if key == journal_key and muscle in muscles and
+                            all(os.path.isfile(output) for output in final_outputs(save_dir, tag, muscle, settings))}
+        if len(muscles) > 0 and len(journal_rows) == len(muscles):
+            parent_logger.info(tag+' was already done (run journal), skipping it')
+            return [journal_rows[muscle] for muscle in muscles]
+    
+    # ~~~~~~STRIP T1 image~~~~~~
+    # reminder, brainmask check = 0 if user does not provide their own brainmask and
+    # MOSAICS is to devise its own (we use default BET settings)
+    # cache: a BET mask made by an earlier run is redone if the T1 (or FSL version) has changed since
+    bet_rerun = use_cache and mos_cache.stage_status(save_dir, 'brainmask', brainmask_key(file_t1)) == 'changed'
+    # check if brainmask exists in data folder and save dir (in that order), the data folder being the T1's
+    # folder when subfolders are searched (mos_find_datasets)
+    ps_brainmask = existing_brainmask(tag, os.path.dirname(file_t1), save_dir, settings['brainmask suffix'], bet_rerun,
+                                      os.path.basename(file_t1).split('.nii')[0])
+    if ps_brainmask is None:
+        # if it doesn't exist, run BET skullstripping
+        if settings['brainmask check'] == 1:
+            parent_logger.warning('supplied brainmask not found, creating our own.')
+        parent_logger.info('performing BET skull stripping')
+        ps_brainmask = mos_skullstrip.main(tag, file_t1, os.path.dirname(file_t1), save_dir, bet_rerun)
+        if use_cache:
+            mos_cache.record_stage(save_dir, 'brainmask', brainmask_key(file_t1), [ps_brainmask])
+    
+    # load the brainmask once per subject, rather than once per muscle through a mask file
+    map_ps_brainmask = None
+    if in_memory:
+        map_ps_brainmask = nib.load(ps_brainmask).get_fdata()
+    
+    # voxels of padding needed around the stimulation sites for an exact cropped computation
+    roi_pad = roi_padding(dilate, smooth/2.355, data_T1.header.get_zooms())
+    
+    # ~~~~~~AGGREGATE REPEATED STIMULATIONS OF A SITE~~~~~~
+    # the maps are made of one value per site (mos_sites), the per site table is saved next to them
+    site_dict = mos_sites.aggregate_sites(stim_dict, site_aggregation)
+    mos_sites.save_site_table(site_dict, os.path.join(save_dir,tag+'_sites.csv'))
+    
 
 ##### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 ##### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -141,283 +484,595 @@ def main(data_dict, config_dict):
 ##### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 ##### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 ##### ~~~~~~~~~~~~~~~~~~~ Muscle loop starts below here
-            
-            
-            stim_dict = mos_load_data_multi_muscle.main(file_nibs_map)
-            locs_dict = stim_dict['locs']
-            muscles_dict = stim_dict['muscles'] # muscles_dict[0] = MEP data, [1] = responsive yes or no
-            
-            for muscle in muscles_dict:
-                
-                parent_logger.info('processing '+muscle+' data')
-                    
-                # establish save file names PER MUSCLE
-                file_grid = os.path.join(save_dir,tag+'_'+muscle+'_grid.nii.gz')
-                file_samples = os.path.join(save_dir,tag+'_'+muscle+'_samples.nii.gz')
-                file_responses = os.path.join(save_dir,tag+'_'+muscle+'_responses.nii.gz')
-                # Noscale (below) is the initial heatmap, gets warped to standard space used
-                file_heatmap_ps_initial = os.path.join(save_dir,tag+'_'+muscle+'_heatmap_initial.nii')
-                # Nomask includes weighted MEP values for heatmap, and is masked by fsl.ApplyMask() on line ~237
-                file_heatmap_ps_weighted = os.path.join(save_dir,tag+'_'+muscle+'_heatmap_weighted.nii')
-                # Below variable is used on line 236
-                file_heatmap_ps_final = os.path.join(save_dir,tag+'_'+muscle+'_heatmap.nii.gz')
-                file_heatmap_sd = os.path.join(save_dir,tag+'_'+muscle+'_warped_heatmap.nii.gz')
-                
-                # ~~~~~~SET UP STIM DATA ARRAYS~~~~~~
-                # Create an array of zeroes equal to size of T1 image, to initialize our output images
-                
-                # What are these maps (below)?
-                #     - map_responses = MEP amplitude overlayed in an array the same size as the T1 image, dilated across 5 voxels
-                #       (so 5mm isotropic) in the script
-                #     - map_samples = the same as responses, but no dilation, so 1mm isotropic?
-                #     - map_grid = 'binary' mask, 0 or 99, which points had a stim? Originally 
-                #       also points orthogonally adjacent to each stim point are 1 instead of 99.
-                
-                # the dict, map_outputs, contains the matrix arrays for each image
-                #map_outputs = initialize_stim_arrays(data_T1, data_nibs_map, MEP_thresh)
-                map_outputs = initialize_stim_arrays(data_T1, locs_dict, muscles_dict, muscle, MEP_thresh)
-                map_grid = map_outputs['grid']
-                map_samples = map_outputs['samples']
-                map_responses = map_outputs['responses']
-    
-                # ~~~~~~SAVE RESPONSE MAP SO WE CAN DILATE~~~~~~
-                # save_map(file_responses, map_responses, data_T1)
-                save_map(file_samples, map_samples, data_T1)
-    
-                """
-                --- DEV NOTE ---
-                Need to ensure that borders between MEPs are maintained, no values are overwritten if dilation is too large
-                    - if user inputs resolution in configure GUI, we can check if dilation is too large for the voxel size?
-                """
-                
-                # ~~~~~~RESLICE STRUCTURAL AND STIM IMAGES~~~~~~
-                # nibabel.processing.conform(data_T1) produces a 1mm isotropic, 256x256x256 image
-                #   above also reorients the image to RAS which is something I guess.
-                
-                #   - Not implemented yet. Helen has notes in Slack I have not read yet.
-                    
-                # ~~~~~~DILATE STIMULATION DATA (MAP_RESPONSES)~~~~~~
-                parent_logger.info('dilating stimulation coordinates by '+str(config_dict['dilate'])+' voxels')
-                
-                if not os.path.isfile(file_responses):
-                    map_responses_dilate = fsl.DilateImage()
-                    map_responses_dilate.inputs.in_file = file_samples
-                    map_responses_dilate.inputs.operation = 'max'
-                    map_responses_dilate.inputs.kernel_shape = 'sphere'
-                    map_responses_dilate.inputs.kernel_size = dilate
-                    map_responses_dilate.inputs.out_file = file_responses
-                    map_responses_temp = map_responses_dilate.run()
-                else:
-                    parent_logger.info('dilation already done, skipping this step')
-                
-                # Re-load the responses map, to receive the dilated version of the map
-                map_responses = nib.load(file_responses).get_fdata()
-    
-    
-                # ~~~~~~FLIP MAPS ANTERIOR/POSTERIOR IF BRAINSIGHT COORDINATES USED~~~~~~   
-                # Rotate matrices in the y dimension (AP) to convert from RPS (Brainsight) to RAS (Nifti)
-                # RPS = +x is right, +y is posterior, +z is superior
-                # RAS = +x is right, +y is anterior, +z is superior
-                if data_dict['stim_coords'].get() == "Brainsight":
-                    parent_logger.info('flipping coordinates of stimulations along anterior-posterior axis')
-                    map_responses = np.flip(map_responses,1)
-                    map_samples = np.flip(map_samples,1)
-                    map_grid = np.flip(map_grid,1)
-            
-            
-                # ~~~~~~PRODUCE HEATMAP~~~~~~
-                # Smooth the hotspot map using a 3D Gaussian
-                # Interestingly, FWHM = 2.355 * s.d. for Gaussian distribution, so divide smooth by 2.355 to get s.d.
-                parent_logger.info('producing heatmap of responsive sites')
-                stdev_gaussian = smooth/2.355
-                map_heatmap_ps_initial = ndi.gaussian_filter(map_responses,stdev_gaussian,0,mode='reflect')
-    
-    
-                # ~~~~~~WEIGHT MEPs~~~~~~
-                parent_logger.info('normalizing response map (by hotspot MEP)')
-                
-                MEP_ps_max, map_responses_weighted, map_heatmap_ps_weighted =\
-                    normalize_ps_heatmap(map_heatmap_ps_initial, map_samples, map_responses)
-    
-    
-                # ~~~~~~SAVE PATIENT SPACE FILES~~~~~~
-                # Stimulations: MEP amplitudes within a matrix sized to match structural image.
-                #               Stimulations from experiment have been uniformaly dilated by the 'dilate' integer.
-                # Heatmap:      Stimulations map with a gaussian filter applied to smooth the data
-                
-                parent_logger.info('saving stimulation sites (grid), responsive sites (responses), and heatmap (heatmap)')
-                save_map(file_grid, map_grid, data_T1)
-                save_map(file_responses, map_responses_weighted, data_T1)
-                save_map(file_heatmap_ps_initial, map_heatmap_ps_initial, data_T1)
-                save_map(file_heatmap_ps_weighted, map_heatmap_ps_weighted, data_T1)
+    
+    
+    # batch: every muscle is stacked along a leading muscle axis (muscle x X x Y x Z) and dilated,
+    # smoothed, normalized, masked and reduced to hotspot / center of mass in one pass
+    batch_results = None
+    if batch_muscles:
+        parent_logger.info('processing all '+str(len(muscles))+' muscles in one batch')
+        if crop_roi:
+            batch_roi = stim_roi(data_T1.shape, site_dict['coords'], site_dict['responsive'].any(axis=1), roi_pad)
+        else:
+            batch_roi = full_roi(data_T1.shape)
+        batch_results = batch_muscle_maps(data_T1, site_dict, MEP_thresh, batch_roi, dilate,
+                                          smooth/2.355, settings['stim_coords'] == "Brainsight", splat_heatmap,
+                                          map_ps_brainmask)
+    
+    # everything the muscles share: loaded once per subject, read-only inside process_muscle()
+    subject_dict = {'tag': tag, 'data_folder': data_folder, 'file_t1': file_t1, 'file_nibs_map': file_nibs_map,
+                    'save_dir': save_dir,
+                    'data_T1': data_T1, 'ps_brainmask': ps_brainmask, 'map_ps_brainmask': map_ps_brainmask,
+                    'sites': site_dict, 'muscles': muscles, 'roi_pad': roi_pad,
+                    'dilate': dilate, 'smooth': smooth, 'MEP_thresh': MEP_thresh, 'grid_spacing': grid_spacing,
+                    'file_atlas': file_atlas, 'native_ops': native_ops, 'in_memory': in_memory,
+                    'debug_dump': debug_dump, 'crop_roi': crop_roi, 'splat_heatmap': splat_heatmap,
+                    'batch_muscles': batch_muscles, 'batch': batch_results, 'use_cache': use_cache,
+                    'storage': storage, 'memory_lean': memory_lean,
+                    'journal_key': journal_key, 'journal_rows': journal_rows}
+    
+    # the T1 -> atlas registration is shared by all muscles, so it is run before they start
+    if settings['normalize'] == 1:
+        register_rerun = False
+        if use_cache:
+            register_rerun = mos_cache.stage_status(save_dir, 'T1 registration',
+                                                    registration_key(file_t1, file_atlas)) == 'changed'
+        mos_warp_to_mni.register_t1(tag, save_dir, file_t1, file_atlas, register_rerun)
+        if use_cache:
+            mos_cache.record_stage(save_dir, 'T1 registration', registration_key(file_t1, file_atlas),
+                                   [os.path.join(save_dir,tag+'_warped.nii.gz'),
+                                    os.path.join(save_dir,tag+'_warped_omat.mat')])
+    
+    if muscle_threads == 1 or len(muscles) < 2:
+        for muscle_index, muscle in enumerate(muscles):
+            results_metrics_list.append(process_muscle(muscle_index, muscle, subject_dict, settings))
+    else:
+        # muscle threads: the numpy / scipy filters, gzip compression and FSL subprocesses release the GIL.
+        # Rows are collected in muscle order, the first muscle to fail fails the subject (as in the loop above)
+        parent_logger.info('processing '+str(len(muscles))+' muscles in '+str(muscle_threads)+' threads')
+        with ThreadPoolExecutor(max_workers=muscle_threads) as executor:
+            futures = [executor.submit(process_muscle, muscle_index, muscle, subject_dict, settings)
+                       for muscle_index, muscle in enumerate(muscles)]
+            results_metrics_list = [future.result() for future in futures]
+    
+    return results_metrics_list
+
+def process_muscle(muscle_index, muscle, subject_dict, settings):
+    # The muscle loop of process_subject() for one muscle. subject_dict holds what the muscles share
+    # (loaded T1, brainmask, stimulation data, options, batched maps), and is only read here, so
+    # muscles can run in parallel threads. Returns this muscle's metric row.
+    
+    tag = subject_dict['tag']
+    data_folder = subject_dict['data_folder']
+    file_t1 = subject_dict['file_t1']
+    file_nibs_map = subject_dict['file_nibs_map']
+    save_dir = subject_dict['save_dir']
+    data_T1 = subject_dict['data_T1']
+    ps_brainmask = subject_dict['ps_brainmask']
+    map_ps_brainmask = subject_dict['map_ps_brainmask']
+    site_dict = subject_dict['sites']
+    muscles = subject_dict['muscles']
+    roi_pad = subject_dict['roi_pad']
+    
+    dilate = subject_dict['dilate']
+    smooth = subject_dict['smooth']
+    MEP_thresh = subject_dict['MEP_thresh']
+    grid_spacing = subject_dict['grid_spacing']
+    file_atlas = subject_dict['file_atlas']
+    native_ops = subject_dict['native_ops']
+    in_memory = subject_dict['in_memory']
+    debug_dump = subject_dict['debug_dump']
+    crop_roi = subject_dict['crop_roi']
+    splat_heatmap = subject_dict['splat_heatmap']
+    batch_muscles = subject_dict['batch_muscles']
+    use_cache = subject_dict['use_cache']
+    storage = subject_dict['storage']
+    memory_lean = subject_dict['memory_lean']
+    # data type of the responses / heatmap maps
+    map_dtype = np.float32 if memory_lean else np.float64
+    if batch_muscles:
+        batch_maps, batch_MEP_ps_max, batch_hotspots, batch_centers_mass, batch_roi = subject_dict['batch']
+    
+    
+    parent_logger.info('processing '+muscle+' data')
         
-                # remove samples map as we don't actually want the users to see it, only useful for development
-                if os.path.exists(file_samples):
-                    os.remove(file_samples)
+    # establish save file names PER MUSCLE
+    file_grid = os.path.join(save_dir,tag+'_'+muscle+'_grid.nii.gz')
+    file_samples = os.path.join(save_dir,tag+'_'+muscle+'_samples.nii.gz')
+    file_responses = os.path.join(save_dir,tag+'_'+muscle+'_responses.nii.gz')
+    # Noscale (below) is the initial heatmap, gets warped to standard space used
+    file_heatmap_ps_initial = os.path.join(save_dir,tag+'_'+muscle+'_heatmap_initial.nii')
+    # Nomask includes weighted MEP values for heatmap, and is masked by fsl.ApplyMask() on line ~237
+    file_heatmap_ps_weighted = os.path.join(save_dir,tag+'_'+muscle+'_heatmap_weighted.nii')
+    # Below variable is used on line 236
+    file_heatmap_ps_final = os.path.join(save_dir,tag+'_'+muscle+'_heatmap.nii.gz')
+    file_heatmap_sd = os.path.join(save_dir,tag+'_'+muscle+'_warped_heatmap.nii.gz')
     
+    if muscle in subject_dict['journal_rows']:
+        parent_logger.info(tag+' '+muscle+' was already done (run journal), skipping it')
+        return subject_dict['journal_rows'][muscle]
     
-                # ~~~~~~MASK HEATMAP MAPS IN PATIENT SPACE~~~~~~
-                # Heatmap: apply brain mask to limit smoothing into skull / scalp
-                # native space mask application
-                parent_logger.info('applying brainmask to patient-space heatmap')
-                mask_heatmap(file_heatmap_ps_weighted, ps_brainmask, file_heatmap_ps_final)
-            
-                
-                # ~~~~~~CALCULATE METRICS (patient space)~~~~~~
-                
-                # load back in masked heatmap to calculate metrics
-                map_heatmap_masked = nib.load(file_heatmap_ps_final).get_fdata()        
-                
-                # HOTSPOT:
-                # raw MEP from the stim data, and smoothed (post-Gaussian filter), needed to normalize patient heatmap
-                results_ps_hotspot = np.unravel_index(np.argmax(map_heatmap_masked), map_heatmap_masked.shape)
-                
-                # CENTER OF MASS:
-                # convenient method from scipy / ndimage (imported as ndi)
-                results_ps_center_mass = ndi.measurements.center_of_mass(map_heatmap_masked)
-                
-                # MAP AREA:
-                #number of spots where a responsive MEP was observed
-                nonzero_responses = np.count_nonzero(map_samples)
-                ps_map_area = nonzero_responses * (grid_spacing ** 2)
-                
-                # MAP VOLUME:
-                ps_map_volume = 0
-                # for all non-zero values (non-zero MEPs) in our array of mapped regions
-                for i in map_samples[np.nonzero(map_samples)]:
-                    ps_map_volume = ps_map_volume + (i * (grid_spacing ** 2))
-    
-    
-                # ~~~~~~REPEAT RELEVANT STEPS IF DATA NORMALIZED~~~~~~        
-                # Note this has to come after saving the initial files, as warps are applied to the heatmap
-                if config_dict['normalize'].get() == 1:
-                    
-                    parent_logger.info('normalizing heatmap to standard space (SD)')
-                    
-                    # -- register and establish name of the warped map, for functions below
-                    parent_logger.info('atlas chosen: '+file_atlas)
-                    mos_warp_to_mni.main(tag, muscle, data_folder, save_dir, file_t1, file_heatmap_ps_weighted, file_atlas)
-                    
-                    # -- standard space mask application to heatmap
-                    parent_logger.info('applying brainmask to standard-space heatmap')
-                    mask_heatmap(file_heatmap_sd, str(config_dict['atlas mask']), file_heatmap_sd)
-                    
-                    # -- load in normalized heatmap to calculate some metrics
-                    data_heatmap_warped = nib.load(file_heatmap_sd)
-                    map_heatmap_warped = data_heatmap_warped.get_fdata()
-                    
-                    # -- calculate standard space (sd) hotspot
-                    results_sd_hotspot = np.unravel_index(np.argmax(map_heatmap_warped), map_heatmap_warped.shape)
-                    MEP_sd_smoothed = map_heatmap_warped[results_sd_hotspot]
-                    
-                    # -- calculate standard space center of gravity
-                    results_sd_center_mass = ndi.measurements.center_of_mass(map_heatmap_warped)
-                    # Replace tuple with 
-                    ## Probably don't need this unrounded tuple bit, no changes made
-                    # rounded_sd_center_mass = (results_sd_center_mass[0],
-                    #                           results_sd_center_mass[1],
-                    #                           results_sd_center_mass[2])
-                    
-                    # results_sd_center_mass = (round(results_sd_center_mass[0]),
-                    #                           round(results_sd_center_mass[1]),
-                    #                           round(results_sd_center_mass[2]))
-                    
-                    
-                    # -- Convert standard space hotspot / COM from voxel coordinates to SD anatomical coords (mm)
-                    atlas_affine = nib.load(file_atlas)
-                    atlas_affine = atlas_affine.affine
-                    ## Hotspot
-                    results_sd_hotspot = apply_affine(atlas_affine, results_sd_hotspot)
-                    ## COM
-                    results_sd_center_mass = apply_affine(atlas_affine, results_sd_center_mass)
-                    
-                    rounded_sd_center_mass = list()
-                    rounded_sd_center_mass.append(round(results_sd_center_mass[0],2))
-                    rounded_sd_center_mass.append(round(results_sd_center_mass[1],2))
-                    rounded_sd_center_mass.append(round(results_sd_center_mass[2],2))
-                    
-                    # normalize MEPs / intensity values for standard space heatmap
-                    map_heatmap_sd_normal = (map_heatmap_warped / MEP_sd_smoothed) * 100
-                    
-                    # Overwrite previously warped, masked heatmap with a new, weighted MEP version
-                    # parent_logger.info('weighting MEPs of standard-space heatmap')
-                    file_heatmap_sd_normal = os.path.join(save_dir,tag+'_warped_heatmap.nii.gz')
-                    nii_heatmap_sd_normal = nib.Nifti1Image(map_heatmap_sd_normal, data_heatmap_warped.affine)
-                    nib.save(nii_heatmap_sd_normal, file_heatmap_sd_normal)
-                    
-                    # standard space values are added to dict below, on line 292
-                else:
-                    # put n/a values in correct dict locations
-                    results_sd_hotspot = ('-','-','-')
-                    results_sd_center_mass = ('-','-','-')
-                    rounded_sd_center_mass = ('-','-','-')
+    # ~~~~~~CACHE: SKIP MUSCLE IF ITS MAPS ARE UP TO DATE~~~~~~
+    # the metrics row is kept in the cache manifest. A debug dump always recomputes, to write the intermediates
+    cache_stage = 'muscle '+muscle
+    if use_cache and not debug_dump:
+        cache_key = muscle_key(settings, file_t1, ps_brainmask, file_nibs_map, save_dir, tag, muscle)
+        if mos_cache.stage_status(save_dir, cache_stage, cache_key) == 'current':
+            parent_logger.info(tag+' '+muscle+' maps are up to date, using cached results')
+            measures_list = mos_cache.stage_extra(save_dir, cache_stage)
+            # journaled as a computed muscle is, so a resumed run finds every muscle done so far
+            if 'journal' in settings:
+                mos_journal.record_muscle(settings['journal'], subject_dict['journal_key'], muscle, measures_list)
+            return measures_list
+    
+    if batch_muscles:
+        # ~~~~~~MAPS FROM THE BATCHED (ALL MUSCLES) PASS~~~~~~
+        # every map and metric below was produced for all muscles at once, before this loop
+        roi = batch_roi
+        map_grid, map_samples, map_responses, map_heatmap_ps_initial, map_responses_weighted, \
+            map_heatmap_ps_weighted, map_heatmap_masked = [batch_map[muscle_index] for batch_map in batch_maps]
+        MEP_ps_max = batch_MEP_ps_max[muscle_index]
+        results_ps_hotspot = batch_hotspots[muscle_index]
+        results_ps_center_mass = batch_centers_mass[muscle_index]
+        if debug_dump:
+            # samples are dumped before the AP flip, as in the per-muscle path
+            map_samples_dump = embed_roi(map_samples, roi, data_T1.shape)
+            if settings['stim_coords'] == "Brainsight":
+                map_samples_dump = np.flip(map_samples_dump,1)
+            save_map(file_samples, map_samples_dump, data_T1)
+    else:
+        # ~~~~~~SET UP STIM DATA ARRAYS~~~~~~
+        # Create an array of zeroes equal to size of T1 image, to initialize our output images
+    
+        # What are these maps (below)?
+        #     - map_responses = MEP amplitude overlayed in an array the same size as the T1 image, dilated across 5 voxels
+        #       (so 5mm isotropic) in the script
+        #     - map_samples = the same as responses, but no dilation, so 1mm isotropic?
+        #     - map_grid = 'binary' mask, 0 or 99, which points had a stim? Originally 
+        #       also points orthogonally adjacent to each stim point are 1 instead of 99.
+    
+        # roi = the block of the T1 volume these arrays cover (the whole volume unless cropping)
+        if crop_roi:
+            roi = stim_roi(data_T1.shape, site_dict['coords'], site_dict['responsive'][:, muscle_index], roi_pad)
+        else:
+            roi = full_roi(data_T1.shape)
     
+        # the dict, map_outputs, contains the matrix arrays for each image
+        #map_outputs = initialize_stim_arrays(data_T1, data_nibs_map, MEP_thresh)
+        map_outputs = initialize_stim_arrays(data_T1, site_dict, muscle_index, MEP_thresh, roi, memory_lean)
+        map_grid = map_outputs['grid']
+        map_samples = map_outputs['samples']
+        map_responses = map_outputs['responses']
+        del map_outputs
+
+        # ~~~~~~SAVE RESPONSE MAP SO WE CAN DILATE~~~~~~
+        # (only fslmaths needs the samples on disk, the native backend dilates the array directly)
+        # save_map(file_responses, map_responses, data_T1)
+        if not native_ops or debug_dump:
+            save_map(file_samples, embed_roi(map_samples, roi, data_T1.shape), data_T1)
+
+        """
+        --- DEV NOTE ---
+        Need to ensure that borders between MEPs are maintained, no values are overwritten if dilation is too large
+            - if user inputs resolution in configure GUI, we can check if dilation is too large for the voxel size?
+        """
+    
+        # ~~~~~~RESLICE STRUCTURAL AND STIM IMAGES~~~~~~
+        # nibabel.processing.conform(data_T1) produces a 1mm isotropic, 256x256x256 image
+        #   above also reorients the image to RAS which is something I guess.
+    
+        #   - Not implemented yet. Helen has notes in Slack I have not read yet.
+        
+        # ~~~~~~DILATE STIMULATION DATA (MAP_RESPONSES)~~~~~~
+        parent_logger.info('dilating stimulation coordinates by '+str(settings['dilate'])+' voxels')
+    
+        if native_ops:
+            map_responses = mos_operators.dilate_max_sphere(map_samples, dilate, data_T1.header.get_zooms(), map_dtype)
+        else:
+            # (with the cache on, the muscle is only here because something changed, and the responses file
+            # left by an earlier run holds the weighted map rather than the dilated samples, so always redo it)
+            if not os.path.isfile(file_responses) or use_cache:
+                map_responses_dilate = fsl.DilateImage()
+                map_responses_dilate.inputs.in_file = file_samples
+                map_responses_dilate.inputs.operation = 'max'
+                map_responses_dilate.inputs.kernel_shape = 'sphere'
+                map_responses_dilate.inputs.kernel_size = dilate
+                map_responses_dilate.inputs.out_file = mos_writer.temporary_file(file_responses)
+                map_responses_temp = map_responses_dilate.run()
+                os.replace(mos_writer.temporary_file(file_responses), file_responses)
+            else:
+                parent_logger.info('dilation already done, skipping this step')
         
-                # ~~~~~~OUTPUT SUBJECT METRICS TO RESULTS SPREADSHEET~~~~~~
-                # Make a list of this subject's values, then append it to the overall results list
-                # Variable order set on line 69 above (results_column_names):
-                # Participant, Image File, Stim file, MEP threshold, Hotspot X, Y, Z, Hotspot MEP, COG X, Y, Z, 
-                # Standard hotspot X, Y, Z, Standard COG X, Y, Z
-                    
-                measures_list = [tag,
-                                 muscle,
-                                results_ps_hotspot[0],
-                                results_ps_hotspot[1],
-                                results_ps_hotspot[2],
-                                MEP_ps_max,
-                                round(results_ps_center_mass[0],2),
-                                round(results_ps_center_mass[1],2),
-                                round(results_ps_center_mass[2],2),
-                                ps_map_area,
-                                ps_map_volume,
-                                results_sd_hotspot[0],
-                                results_sd_hotspot[1],
-                                results_sd_hotspot[2],
-                                rounded_sd_center_mass[0],
-                                rounded_sd_center_mass[1],
-                                rounded_sd_center_mass[2],
-                                data_dict['stim_coords'].get(),
-                                str(dilate),
-                                str(smooth),
-                                str(MEP_thresh)]
-                results_metrics_list.append(measures_list)        
-                
-                #clean up files, put into a separate function, see if that helps track everything
-                file_cleanup(file_heatmap_ps_initial, file_heatmap_ps_weighted, save_dir, tag)
-                
-                parent_logger.info('analysis completed for '+tag+' '+muscle)
-                print()
+            # Re-load the responses map, to receive the dilated version of the map
+            map_responses = nib.load(file_responses).get_fdata(dtype=map_dtype)
+
+
+        # ~~~~~~FLIP MAPS ANTERIOR/POSTERIOR IF BRAINSIGHT COORDINATES USED~~~~~~   
+        # Rotate matrices in the y dimension (AP) to convert from RPS (Brainsight) to RAS (Nifti)
+        # RPS = +x is right, +y is posterior, +z is superior
+        # RAS = +x is right, +y is anterior, +z is superior
+        if settings['stim_coords'] == "Brainsight":
+            parent_logger.info('flipping coordinates of stimulations along anterior-posterior axis')
+            map_responses = np.flip(map_responses,1)
+            map_samples = np.flip(map_samples,1)
+            map_grid = np.flip(map_grid,1)
+            roi = flip_roi(roi, data_T1.shape, 1)
+
+
+        # ~~~~~~PRODUCE HEATMAP~~~~~~
+        # Smooth the hotspot map using a 3D Gaussian
+        # Interestingly, FWHM = 2.355 * s.d. for Gaussian distribution, so divide smooth by 2.355 to get s.d.
+        parent_logger.info('producing heatmap of responsive sites')
+        stdev_gaussian = smooth/2.355
+        if splat_heatmap:
+            stim_coords, stim_MEPs = stim_points(site_dict, muscle_index, data_T1.shape, roi,
+                                                 settings['stim_coords'] == "Brainsight")
+            map_heatmap_ps_initial = mos_splat.splat_heatmap(map_responses, stim_coords, stim_MEPs, dilate,
+                                                             stdev_gaussian, data_T1.header.get_zooms())
+            map_heatmap_ps_initial = map_heatmap_ps_initial.astype(map_dtype, copy=False)
+        else:
+            map_heatmap_ps_initial = ndi.gaussian_filter(map_responses,stdev_gaussian,0,output=map_dtype,mode='reflect')
+
+        # written before weighting, which memory-lean runs do in the same buffer
+        if not in_memory or debug_dump:
+            save_map(file_heatmap_ps_initial, embed_roi(map_heatmap_ps_initial, roi, data_T1.shape), data_T1)
+
+
+        # ~~~~~~WEIGHT MEPs~~~~~~
+        parent_logger.info('normalizing response map (by hotspot MEP)')
     
+        MEP_ps_max, map_responses_weighted, map_heatmap_ps_weighted =\
+            normalize_ps_heatmap(map_heatmap_ps_initial, map_samples, map_responses, memory_lean)
+        del map_responses, map_heatmap_ps_initial
+
+
+    # ~~~~~~SAVE PATIENT SPACE FILES~~~~~~
+    # Stimulations: MEP amplitudes within a matrix sized to match structural image.
+    #               Stimulations from experiment have been uniformaly dilated by the 'dilate' integer.
+    # Heatmap:      Stimulations map with a gaussian filter applied to smooth the data
     
-        # ~~~~~~print values to spreadsheet after the loop has completed~~~~~~
-        metrics_dataframe = pd.DataFrame(results_metrics_list, columns=results_column_names)    
-        measures_file = os.path.join(save_dir_parent,'mapping_results.xlsx')
-        metrics_dataframe.to_excel(measures_file)
+    parent_logger.info('saving stimulation sites (grid), responsive sites (responses), and heatmap (heatmap)')
+    # final outputs are compressed in the background, written = the ones still being written (mos_writer)
+    written = list()
+    written.append(save_map(file_grid, embed_roi(map_grid, roi, data_T1.shape), data_T1, 'grid', storage))
+    written.append(save_map(file_responses, embed_roi(map_responses_weighted, roi, data_T1.shape), data_T1,
+                            'responses', storage))
+    if not in_memory or debug_dump:
+        if batch_muscles:
+            save_map(file_heatmap_ps_initial, embed_roi(map_heatmap_ps_initial, roi, data_T1.shape), data_T1)
+        save_map(file_heatmap_ps_weighted, embed_roi(map_heatmap_ps_weighted, roi, data_T1.shape), data_T1)
+
+    # remove samples map as we don't actually want the users to see it, only useful for development
+    if os.path.exists(file_samples) and not debug_dump:
+        os.remove(file_samples)
+
+
+    # ~~~~~~MASK HEATMAP MAPS IN PATIENT SPACE~~~~~~
+    # Heatmap: apply brain mask to limit smoothing into skull / scalp
+    # native space mask application
+    parent_logger.info('applying brainmask to patient-space heatmap')
+    if in_memory:
+        if not batch_muscles:
+            # (in place when lean, unless FLIRT still needs the unmasked map below)
+            map_heatmap_masked = mos_operators.apply_mask(map_heatmap_ps_weighted, map_ps_brainmask[roi],
+                                                          memory_lean and settings['normalize'] != 1)
+        written.append(save_map(file_heatmap_ps_final, embed_roi(map_heatmap_masked, roi, data_T1.shape), data_T1,
+                                'heatmap', storage))
+    else:
+        mask_heatmap(file_heatmap_ps_weighted, ps_brainmask, file_heatmap_ps_final, native_ops, storage)
+
     
-        parent_logger.info('MOSAICS main analysis completed successfully!')
+    # ~~~~~~CALCULATE METRICS (patient space)~~~~~~
+    
+    # load back in masked heatmap to calculate metrics
+    if not in_memory:
+        map_heatmap_masked = nib.load(file_heatmap_ps_final).get_fdata()        
+    
+    # HOTSPOT:
+    # raw MEP from the stim data, and smoothed (post-Gaussian filter), needed to normalize patient heatmap
+    if not batch_muscles:
+        results_ps_hotspot = roi_hotspot(map_heatmap_masked, roi)
+    
+    # CENTER OF MASS:
+    # convenient method from scipy / ndimage (imported as ndi)
+    if not batch_muscles:
+        results_ps_center_mass = roi_center_of_mass(map_heatmap_masked, roi)
+    
+    # MAP AREA:
+    #number of spots where a responsive MEP was observed
+    nonzero_responses = np.count_nonzero(map_samples)
+    ps_map_area = nonzero_responses * (grid_spacing ** 2)
+    
+    # MAP VOLUME:
+    ps_map_volume = 0
+    # for all non-zero values (non-zero MEPs) in our array of mapped regions
+    for i in map_samples[np.nonzero(map_samples)]:
+        ps_map_volume = ps_map_volume + (i * (grid_spacing ** 2))
+
+
+    # ~~~~~~REPEAT RELEVANT STEPS IF DATA NORMALIZED~~~~~~        
+    # Note this has to come after saving the initial files, as warps are applied to the heatmap
+    if settings['normalize'] == 1:
+        
+        parent_logger.info('normalizing heatmap to standard space (SD)')
+        
+        # -- register and establish name of the warped map, for functions below
+        parent_logger.info('atlas chosen: '+file_atlas)
+        # FLIRT reads the unmasked heatmap from disk, so it is written here when kept in memory
+        if in_memory and not debug_dump:
+            save_map(file_heatmap_ps_weighted, embed_roi(map_heatmap_ps_weighted, roi, data_T1.shape), data_T1)
+        mos_warp_to_mni.main(tag, muscle, data_folder, save_dir, file_t1, file_heatmap_ps_weighted, file_atlas)
+        
+        # -- standard space mask application to heatmap
+        parent_logger.info('applying brainmask to standard-space heatmap')
+        if in_memory:
+            data_heatmap_warped = nib.load(file_heatmap_sd)
+            map_heatmap_warped = mos_operators.apply_mask(data_heatmap_warped.get_fdata(), load_mask(str(settings['atlas mask'])))
+            written.append(mos_writer.save(mos_storage.nifti_image(map_heatmap_warped, data_heatmap_warped.affine,
+                                                                   'heatmap', storage, data_heatmap_warped.header),
+                                           file_heatmap_sd))
+        else:
+            mask_heatmap(file_heatmap_sd, str(settings['atlas mask']), file_heatmap_sd, native_ops, storage)
+            
+            # -- load in normalized heatmap to calculate some metrics
+            data_heatmap_warped = nib.load(file_heatmap_sd)
+            map_heatmap_warped = data_heatmap_warped.get_fdata()
         
+        # -- calculate standard space (sd) hotspot
+        results_sd_hotspot = np.unravel_index(np.argmax(map_heatmap_warped), map_heatmap_warped.shape)
+        MEP_sd_smoothed = map_heatmap_warped[results_sd_hotspot]
+        
+        # -- calculate standard space center of gravity
+        results_sd_center_mass = ndi.measurements.center_of_mass(map_heatmap_warped)
+        # Replace tuple with 
+        ## Probably don't need this unrounded tuple bit, no changes made
+        # rounded_sd_center_mass = (results_sd_center_mass[0],
+        #                           results_sd_center_mass[1],
+        #                           results_sd_center_mass[2])
+        
+        # results_sd_center_mass = (round(results_sd_center_mass[0]),
+        #                           round(results_sd_center_mass[1]),
+        #                           round(results_sd_center_mass[2]))
+        
+        
+        # -- Convert standard space hotspot / COM from voxel coordinates to SD anatomical coords (mm)
+        atlas_affine = nib.load(file_atlas)
+        atlas_affine = atlas_affine.affine
+        ## Hotspot
+        results_sd_hotspot = apply_affine(atlas_affine, results_sd_hotspot)
+        ## COM
+        results_sd_center_mass = apply_affine(atlas_affine, results_sd_center_mass)
+        
+        rounded_sd_center_mass = list()
+        rounded_sd_center_mass.append(round(results_sd_center_mass[0],2))
+        rounded_sd_center_mass.append(round(results_sd_center_mass[1],2))
+        rounded_sd_center_mass.append(round(results_sd_center_mass[2],2))
+        
+        # normalize MEPs / intensity values for standard space heatmap
+        map_heatmap_sd_normal = (map_heatmap_warped / MEP_sd_smoothed) * 100
+        
+        # Overwrite previously warped, masked heatmap with a new, weighted MEP version
+        # parent_logger.info('weighting MEPs of standard-space heatmap')
+        # (one file per subject: the last muscle's map is the one kept, whatever order threads finish in)
+        if muscle_index == len(muscles) - 1:
+            file_heatmap_sd_normal = os.path.join(save_dir,tag+'_warped_heatmap.nii.gz')
+            nii_heatmap_sd_normal = mos_storage.nifti_image(map_heatmap_sd_normal, data_heatmap_warped.affine, 'heatmap', storage)
+            written.append(mos_writer.save(nii_heatmap_sd_normal, file_heatmap_sd_normal))
+        
+        # standard space values are added to dict below, on line 292
     else:
+        # put n/a values in correct dict locations
+        results_sd_hotspot = ('-','-','-')
+        results_sd_center_mass = ('-','-','-')
+        rounded_sd_center_mass = ('-','-','-')
+
+
+    # ~~~~~~OUTPUT SUBJECT METRICS TO RESULTS SPREADSHEET~~~~~~
+    # Make a list of this subject's values, then append it to the overall results list
+    # Variable order set on line 69 above (results_column_names):
+    # Participant, Image File, Stim file, MEP threshold, Hotspot X, Y, Z, Hotspot MEP, COG X, Y, Z, 
+    # Standard hotspot X, Y, Z, Standard COG X, Y, Z
         
-        parent_logger.error('No subjects found for processing, MOSAICS processing not run')
+    measures_list = [tag,
+                     muscle,
+                    results_ps_hotspot[0],
+                    results_ps_hotspot[1],
+                    results_ps_hotspot[2],
+                    MEP_ps_max,
+                    round(results_ps_center_mass[0],2),
+                    round(results_ps_center_mass[1],2),
+                    round(results_ps_center_mass[2],2),
+                    ps_map_area,
+                    ps_map_volume,
+                    results_sd_hotspot[0],
+                    results_sd_hotspot[1],
+                    results_sd_hotspot[2],
+                    rounded_sd_center_mass[0],
+                    rounded_sd_center_mass[1],
+                    rounded_sd_center_mass[2],
+                    settings['stim_coords'],
+                    str(dilate),
+                    str(smooth),
+                    str(MEP_thresh)]
+    
+    #clean up files, put into a separate function, see if that helps track everything
+    if not debug_dump:
+        file_cleanup(file_heatmap_ps_initial, file_heatmap_ps_weighted, save_dir, tag)
+    
+    if use_cache and not debug_dump:
+        # recorded once the outputs are in place, as their contents are hashed
+        mos_writer.after_writes(written, mos_cache.record_stage, save_dir, cache_stage, cache_key,
+                                final_outputs(save_dir, tag, muscle, settings), measures_list)
+    if 'journal' in settings:
+        mos_writer.after_writes(written, mos_journal.record_muscle, settings['journal'], subject_dict['journal_key'],
+                                muscle, measures_list)
+    
+    parent_logger.info('analysis completed for '+tag+' '+muscle)
+    print()
+    
+    return measures_list
+
+def dry_run(data_dict, config_dict):
+    # Reports what main() would recompute with the current settings, from each subject's cache manifest.
+    # Nothing is processed or written. Returns [subject, stage, status] rows, which are also logged
+    settings = analysis_settings(data_dict, config_dict)
+    native_ops = mos_operators.use_native(settings)
+    report = list()
+    
+    for subject in settings['data list']:
+        tag = subject[0]
+        file_t1 = os.path.join(settings['data folder'],subject[1])
+        file_nibs_map = os.path.join(settings['data folder'],subject[2])
+        save_dir = str(settings['save_dir']+'/'+tag)
+        # a stage whose inputs will be regenerated makes everything after it recompute
+        upstream_changes = False
+        
+        ps_brainmask = existing_brainmask(tag, os.path.dirname(file_t1), save_dir, settings['brainmask suffix'],
+                                          t1_name=os.path.basename(file_t1).split('.nii')[0])
+        if ps_brainmask is None:
+            report.append([tag, 'brainmask', 'recompute (no brainmask, BET will be run)'])
+            upstream_changes = True
+        elif os.path.dirname(ps_brainmask) == os.path.abspath(save_dir):
+            status = mos_cache.stage_status(save_dir, 'brainmask', brainmask_key(file_t1))
+            report.append([tag, 'brainmask', dry_run_status(status, reuses_untracked=True)])
+            upstream_changes = status == 'changed'
+        
+        if settings['normalize'] == 1:
+            status = mos_cache.stage_status(save_dir, 'T1 registration', registration_key(file_t1, str(settings['atlas'])))
+            if status == 'new' and not os.path.isfile(os.path.join(save_dir,tag+'_warped.nii.gz')):
+                status = 'missing'
+            report.append([tag, 'T1 registration', dry_run_status(status, reuses_untracked=True)])
+            upstream_changes = upstream_changes or status in ['changed', 'missing']
+        
+        for muscle in mos_load_data_multi_muscle.main(file_nibs_map)['muscles']:
+            if upstream_changes:
+                status = 'upstream'
+            elif settings['debug dump'] == 1:
+                status = 'debug dump'
+            else:
+                status = mos_cache.stage_status(save_dir, 'muscle '+muscle,
+                                                muscle_key(settings, file_t1, ps_brainmask, file_nibs_map, save_dir, tag, muscle))
+            report.append([tag, 'muscle '+muscle, dry_run_status(status)])
+    
+    parent_logger.info('dry run, cache report ('+mos_cache.backend_version(native_ops)+'):')
+    for tag, stage, status in report:
+        parent_logger.info(tag+', '+stage+': '+status)
+    
+    return report
+
+def dry_run_status(status, reuses_untracked=False):
+    # stage_status() result in words. BET / FLIRT outputs from before the cache existed are reused as they are,
+    # as they were before it
+    if status == 'current':
+        return 'up to date'
+    elif status == 'changed':
+        return 'recompute (inputs, parameters or outputs changed)'
+    elif status == 'new' and reuses_untracked:
+        return 'reuse existing file (not in cache)'
+    elif status == 'new':
+        return 'recompute (not in cache)'
+    elif status == 'missing':
+        return 'recompute (not run yet)'
+    elif status == 'upstream':
+        return 'recompute (an earlier stage will be recomputed)'
+    elif status == 'debug dump':
+        return 'recompute (debug dump always recomputes)'
+
+def existing_brainmask(tag, data_folder, save_dir, brainmask_suffix, skip_save_dir=False, t1_name=None):
+    # brainmask in the data folder, then the save directory (unless its BET output is out of date), else None.
+    # In the data folder it may also be named after the T1 file (t1_name), as subjects in subfolders are tagged
+    # with the folder's path (mos_find_datasets)
+    for name in [tag, t1_name]:
+        if name is not None and os.path.isfile(os.path.join(data_folder, name+brainmask_suffix)):
+            return os.path.abspath(os.path.join(data_folder, name+brainmask_suffix))
+    if os.path.isfile(os.path.join(save_dir, tag+brainmask_suffix)) and not skip_save_dir:
+        return os.path.abspath(os.path.join(save_dir, tag+brainmask_suffix))
+    return None
+
+def brainmask_key(file_t1):
+    # cache key of the BET stage (mos_skullstrip)
+    return mos_cache.stage_key('brainmask', {'T1': file_t1}, {'BET frac': 0.5, 'backend': mos_cache.fsl_version()})
+
+def registration_key(file_t1, file_atlas):
+    # cache key of the T1 -> atlas FLIRT (mos_warp_to_mni.register_t1)
+    return mos_cache.stage_key('T1 registration', {'T1': file_t1, 'atlas': file_atlas},
+                               {'backend': mos_cache.fsl_version()})
+
+def muscle_key(settings, file_t1, ps_brainmask, file_nibs_map, save_dir, tag, muscle):
+    # cache key of one muscle's maps and metrics (process_muscle). in memory / crop / batch / threads are left out,
+    # they give the same outputs
+    input_files = {'T1': file_t1, 'brainmask': ps_brainmask, 'stim data': file_nibs_map}
+    if settings['normalize'] == 1:
+        input_files['atlas'] = str(settings['atlas'])
+        input_files['atlas mask'] = str(settings['atlas mask'])
+        input_files['registration'] = os.path.join(save_dir,tag+'_warped_omat.mat')
+    params = {'muscle': muscle,
+              'dilate': int(settings['dilate']),
+              'smooth': int(settings['smooth']),
+              'MEP_threshold': int(settings['MEP_threshold']),
+              'grid spacing': int(settings['grid spacing']),
+              'stim_coords': settings['stim_coords'],
+              'heatmap_engine': settings['heatmap_engine'],
+              'site_aggregation': settings.get('site_aggregation', mos_sites.SITE_AGGREGATIONS[0]),
+              'normalize': settings['normalize'],
+              'storage': mos_storage.storage_option(settings),
+              'memory lean': settings.get('memory lean', 0) == 1,
+              'backend': mos_cache.backend_version(mos_operators.use_native(settings))}
+    
+    return mos_cache.stage_key('muscle '+muscle, input_files, params)
+
+def analysis_settings(data_dict, config_dict):
+    # plain-value copy of data_dict and config_dict, with tk variables (IntVar, StringVar) resolved
+    # through .get(), so settings can be pickled and sent to worker processes
+    settings = dict()
+    for source_dict in [data_dict, config_dict]:
+        for key, value in source_dict.items():
+            if hasattr(value, 'get') and not isinstance(value, dict):
+                value = value.get()
+            settings[key] = value
+    return settings
+
+def init_worker(log_queue, log_level):
+    # worker processes send their 'main' logger records back to the parent process through log_queue
+    worker_logger = logging.getLogger('main')
+    worker_logger.handlers = [QueueHandler(log_queue)]
+    worker_logger.setLevel(log_level)
+
+class ParentLogForwarder(logging.Handler):
+    # re-emits records from worker processes through this process's 'main' logger handlers
+    def emit(self, record):
+        parent_logger.handle(record)
+
+@functools.lru_cache(maxsize=1)
+def load_mask(file_mask):
+    # standard space brainmask is the same for every subject, so it is only read once per process
+    return nib.load(file_mask).get_fdata()
 
 # SUB-FUNCTIONS USED IN MAIN (SEPARATED FOR READABILITY / CLEANLINESS)
 #def initialize_stim_arrays(data_T1, data_nibs_map, MEP_thresh):
-def initialize_stim_arrays(data_T1, locs_dict, muscles_dict, muscle, MEP_thresh):
+def initialize_stim_arrays(data_T1, site_dict, muscle_index, MEP_thresh, roi=None, lean=False):
 
-    map_responses = np.zeros(data_T1.shape)
-    map_samples = np.zeros(data_T1.shape)
-    map_grid = np.zeros(data_T1.shape)
-    
-    # create some in-scope variables to clarify use of MEP and responsive columns
-    MEP = muscles_dict[muscle][0]
-    responsive = muscles_dict[muscle][1]
+    # arrays cover the roi block of the T1 volume (whole volume by default), coordinates are shifted to match
+    if roi is None:
+        roi = full_roi(data_T1.shape)
+    roi_shape = tuple(block.stop - block.start for block in roi)
+
+    # lean: a uint8 grid and no responses array (it is replaced by the dilated samples anyway),
+    # samples stay float64 so max MEP / map volume are exact
+    map_samples = np.zeros(roi_shape)
+    if lean:
+        map_responses = None
+        map_grid = np.zeros(roi_shape, dtype=np.uint8)
+    else:
+        map_responses = np.zeros(roi_shape)
+        map_grid = np.zeros(roi_shape)
     
     # put all MEP values in the arrays at their corresponding x,y,z coordinates
-    for count, value in enumerate(responsive):
-        if value == 1:
-            map_responses[int(locs_dict['X'][count]),int(locs_dict['Y'][count]),int(locs_dict['Z'][count])] = MEP[count]
-            map_samples[int(locs_dict['X'][count]),int(locs_dict['Y'][count]),int(locs_dict['Z'][count])] = MEP[count]
-            map_grid[int(locs_dict['X'][count]),int(locs_dict['Y'][count]),int(locs_dict['Z'][count])] = 1
+    site_index, site_MEPs = stim_sites(site_dict, muscle_index, roi)
+    if map_responses is not None:
+        map_responses[site_index] = site_MEPs
+    map_samples[site_index] = site_MEPs
+    map_grid[site_index] = 1
     
     outputs_dict = dict()
     outputs_dict['grid'] = map_grid
@@ -426,7 +1081,107 @@ def initialize_stim_arrays(data_T1, locs_dict, muscles_dict, muscle, MEP_thresh)
     
     return outputs_dict
 
-def normalize_ps_heatmap(map_heatmap_ps_initial, map_samples, map_responses):
+def stim_sites(site_dict, muscle_index, roi):
+    # the sites mapped for a muscle (mos_sites.aggregate_sites), as an index into maps covering roi, and
+    # their aggregated MEPs
+    responsive = site_dict['responsive'][:, muscle_index]
+    site_coords = site_dict['coords'][responsive] - np.array([block.start for block in roi])
+    return tuple(site_coords.T), site_dict['MEPs'][responsive, muscle_index]
+
+def batch_muscle_maps(data_T1, site_dict, MEP_thresh, roi, dilate, stdev_gaussian, flip_AP,
+                      splat_heatmap, map_ps_brainmask):
+    # The per-muscle steps of main() for all muscles at once, on arrays with a leading muscle axis.
+    # Returns the stacked maps (grid, samples, responses, initial / weighted heatmaps, masked heatmap),
+    # the max MEP, hotspot and center of mass of each muscle, and the (possibly flipped) roi
+    muscles = site_dict['muscles']
+    roi_shape = tuple(block.stop - block.start for block in roi)
+    
+    # ~~~~~~SET UP STIM DATA ARRAYS (muscle x X x Y x Z)~~~~~~
+    map_samples = np.zeros((len(muscles),) + roi_shape)
+    map_grid = np.zeros((len(muscles),) + roi_shape)
+    for muscle_index in range(len(muscles)):
+        site_index, site_MEPs = stim_sites(site_dict, muscle_index, roi)
+        map_samples[(muscle_index,)+site_index] = site_MEPs
+        map_grid[(muscle_index,)+site_index] = 1
+    
+    # ~~~~~~DILATE, FLIP, SMOOTH~~~~~~
+    # dilation footprint and Gaussian are both size 1 / zero along the muscle axis
+    parent_logger.info('dilating stimulation coordinates by '+str(dilate)+' voxels')
+    map_responses = mos_operators.dilate_max_sphere(map_samples, dilate, data_T1.header.get_zooms())
+    
+    if flip_AP:
+        parent_logger.info('flipping coordinates of stimulations along anterior-posterior axis')
+        map_responses = np.flip(map_responses,2)
+        map_samples = np.flip(map_samples,2)
+        map_grid = np.flip(map_grid,2)
+        roi = flip_roi(roi, data_T1.shape, 1)
+    
+    parent_logger.info('producing heatmaps of responsive sites')
+    if splat_heatmap:
+        map_heatmap_ps_initial = np.stack([
+            mos_splat.splat_heatmap(map_responses[muscle_index],
+                                    *stim_points(site_dict, muscle_index, data_T1.shape, roi, flip_AP),
+                                    dilate, stdev_gaussian, data_T1.header.get_zooms())
+            for muscle_index in range(len(muscles))])
+    else:
+        map_heatmap_ps_initial = ndi.gaussian_filter(map_responses,(0,)+(stdev_gaussian,)*3,0,mode='reflect')
+    
+    # ~~~~~~WEIGHT MEPs, MASK~~~~~~
+    parent_logger.info('normalizing response maps (by hotspot MEP) and applying brainmask')
+    MEP_ps_max, map_responses_weighted, map_heatmap_ps_weighted =\
+        normalize_ps_heatmap(map_heatmap_ps_initial, map_samples, map_responses)
+    map_heatmap_masked = mos_operators.apply_mask(map_heatmap_ps_weighted, map_ps_brainmask[roi])
+    
+    # ~~~~~~HOTSPOT AND CENTER OF MASS, all muscles at once~~~~~~
+    flat_masked = map_heatmap_masked.reshape(len(muscles), -1)
+    hotspot_index = np.argmax(flat_masked, axis=1)
+    hotspot_max = flat_masked[np.arange(len(muscles)), hotspot_index]
+    hotspots = list()
+    for muscle_index, hotspot in enumerate(zip(*np.unravel_index(hotspot_index, roi_shape))):
+        # as roi_hotspot(): an empty map peaks at voxel 0 of the full volume
+        if not hotspot_max[muscle_index] > 0:
+            hotspots.append((0, 0, 0))
+        else:
+            hotspots.append(tuple(int(index + block.start) for index, block in zip(hotspot, roi)))
+    
+    # same sums as ndi.center_of_mass: sum(map * voxel index) / sum(map) along each axis
+    normalizer = flat_masked.sum(axis=1)
+    grids = np.ogrid[tuple(slice(0, dim) for dim in roi_shape)]
+    centers_mass = np.stack([(map_heatmap_masked * grid.astype(float)).reshape(len(muscles), -1).sum(axis=1) / normalizer + block.start
+                             for grid, block in zip(grids, roi)], axis=1)
+    
+    batch_maps = [map_grid, map_samples, map_responses, map_heatmap_ps_initial, map_responses_weighted,
+                  map_heatmap_ps_weighted, map_heatmap_masked]
+    
+    return batch_maps, MEP_ps_max, hotspots, [tuple(center_mass) for center_mass in centers_mass], roi
+
+def stim_points(site_dict, muscle_index, shape, roi, flip_AP):
+    # the sites of initialize_stim_arrays as a point list (N x 3 voxel coordinates and MEPs),
+    # in the coordinates of the (flipped, cropped) maps
+    responsive = site_dict['responsive'][:, muscle_index]
+    stim_coords = site_dict['coords'][responsive]
+    stim_MEPs = site_dict['MEPs'][responsive, muscle_index]
+    
+    if flip_AP:
+        stim_coords[:, 1] = shape[1] - 1 - stim_coords[:, 1]
+    stim_coords = stim_coords - np.array([block.start for block in roi])
+    
+    return stim_coords, stim_MEPs
+
+def normalize_ps_heatmap(map_heatmap_ps_initial, map_samples, map_responses, in_place=False):
+    # in_place (3D maps): the responses and heatmap are weighted in their own buffers, which are returned
+    # as the weighted maps (the unweighted ones are gone)
+    
+    # batched muscles (muscle x X x Y x Z): the same normalization, per muscle
+    if map_samples.ndim == 4:
+        muscle_range = np.arange(map_samples.shape[0])
+        flat_samples = map_samples.reshape(len(muscle_range), -1)
+        flat_heatmap = map_heatmap_ps_initial.reshape(len(muscle_range), -1)
+        MEP_ps_max = flat_samples[muscle_range, np.argmax(flat_samples, axis=1)]
+        MEP_ps_smoothed = flat_heatmap[muscle_range, np.argmax(flat_heatmap, axis=1)]
+        map_responses_weighted = (map_responses / MEP_ps_max[:, None, None, None]) * 100
+        map_heatmap_ps_weighted = (map_heatmap_ps_initial / MEP_ps_smoothed[:, None, None, None]) * 100
+        return MEP_ps_max, map_responses_weighted, map_heatmap_ps_weighted
     
     # First, we need to calculate the max MEPs observed in samples (initial coordinates) and heatmap arrays
     # numpy.argmax to get a linear index for the max value in the samples array, then
@@ -438,6 +1193,13 @@ def normalize_ps_heatmap(map_heatmap_ps_initial, map_samples, map_responses):
     MEP_ps_max = map_samples[np.unravel_index(np.argmax(map_samples), map_samples.shape)]
     MEP_ps_smoothed = map_heatmap_ps_initial[results_ps_hotspot]
     
+    if in_place:
+        map_responses /= MEP_ps_max
+        map_responses *= 100
+        map_heatmap_ps_initial /= MEP_ps_smoothed
+        map_heatmap_ps_initial *= 100
+        return MEP_ps_max, map_responses, map_heatmap_ps_initial
+    
     # need to normalize both the stimulations map (responses) and dilated stimulations as well (samples)
     map_responses_weighted = (map_responses / MEP_ps_max) * 100 
     ### map_samples_normalized = (map_samples / MEP_ps_max) * 100 #i don't think is used anywhere?
@@ -446,25 +1208,99 @@ def normalize_ps_heatmap(map_heatmap_ps_initial, map_samples, map_responses):
     
     return MEP_ps_max, map_responses_weighted, map_heatmap_ps_weighted
 
-def save_map(filename, map, structural_data):
+def full_roi(shape):
+    # roi covering the whole volume, i.e. no cropping
+    return tuple(slice(0, dim) for dim in shape[:3])
+
+def roi_padding(dilate, stdev_gaussian, voxel_size, truncate=4.0):
+    # voxels beyond the stimulation sites that can become non-zero: the dilation sphere half-width,
+    # plus the Gaussian filter radius (scipy truncates at int(truncate * sd + 0.5)), plus one spare voxel
+    # so the reflect / nearest boundary handling of the cropped arrays only ever sees zeroes
+    gaussian_radius = int(truncate * stdev_gaussian + 0.5)
+    dilate_radius = [(width - 1) // 2 for width in mos_operators.sphere_kernel(dilate, voxel_size).shape]
+    return [radius + gaussian_radius + 1 for radius in dilate_radius]
+
+def stim_roi(shape, coords, responsive, roi_pad):
+    # bounding box of the mapped stimulation sites (coords rows where responsive), padded and clipped
+    # to the volume
+    if not responsive.any():
+        return full_roi(shape)
+    
+    coords = coords[responsive]
+    roi_start = np.maximum(coords.min(axis=0) - np.array(roi_pad), 0)
+    roi_stop = np.minimum(coords.max(axis=0) + np.array(roi_pad) + 1, shape[:3])
+    return tuple(slice(int(start), int(stop)) for start, stop in zip(roi_start, roi_stop))
+
+def flip_roi(roi, shape, axis):
+    # where the roi block ends up after np.flip(full volume, axis)
+    roi = list(roi)
+    roi[axis] = slice(shape[axis] - roi[axis].stop, shape[axis] - roi[axis].start)
+    return tuple(roi)
+
+def embed_roi(map_roi, roi, shape):
+    # place a cropped map back into a full-size (zero) volume for saving
+    if map_roi.shape == tuple(shape[:3]):
+        return map_roi
+    map_full = np.zeros(shape[:3], dtype=map_roi.dtype)
+    map_full[roi] = map_roi
+    return map_full
+
+def roi_hotspot(map_roi, roi):
+    # argmax of the full volume: everything outside the roi is zero, so an empty map peaks at voxel 0 as before
+    if not map_roi.max() > 0:
+        return (0, 0, 0)
+    hotspot = np.unravel_index(np.argmax(map_roi), map_roi.shape)
+    return tuple(int(index + block.start) for index, block in zip(hotspot, roi))
+
+def roi_center_of_mass(map_roi, roi):
+    # center of mass of the full volume, shifted back from roi to volume coordinates
+    center_mass = ndi.measurements.center_of_mass(map_roi)
+    return tuple(index + block.start for index, block in zip(center_mass, roi))
+
+def save_map(filename, map, structural_data, kind=None, storage=mos_storage.STORAGE_LIST[0]):
+    # kind = 'grid', 'responses' or 'heatmap' for final outputs, stored as the storage option says (mos_storage)
+    # and compressed in the background (returns mos_writer's Future). Intermediate maps (kind None) keep the
+    # array's data type and are written straight away, as FSL reads them back
     
-    nifti = nib.Nifti1Image(map, structural_data.affine)
+    nifti = mos_storage.nifti_image(map, structural_data.affine, kind, storage)
     # if not os.path.exists(filename):
     # parent_logger.info('saving :'+filename)
-    nib.save(nifti, filename)
+    if kind is not None:
+        return mos_writer.save(nifti, filename)
+    mos_writer.save_now(nifti, filename)
 
-def mask_heatmap(input_map, brainmask, output_file):
+def final_outputs(save_dir, tag, muscle, settings):
+    # the maps process_muscle() keeps for a muscle
+    outputs = [os.path.join(save_dir,tag+'_'+muscle+'_grid.nii.gz'),
+               os.path.join(save_dir,tag+'_'+muscle+'_responses.nii.gz'),
+               os.path.join(save_dir,tag+'_'+muscle+'_heatmap.nii.gz')]
+    if settings['normalize'] == 1:
+        outputs.append(os.path.join(save_dir,tag+'_'+muscle+'_warped_heatmap.nii.gz'))
+    return outputs
+
+def mask_heatmap(input_map, brainmask, output_file, native_ops=False, storage=mos_storage.STORAGE_LIST[0]):
     # requires image map to mask, full path to brainmask, and the name of the output file to save
+    # (the masked heatmap is a final output, saved as the storage option says; fslmaths keeps its own data type)
+    if native_ops:
+        data_input = nib.load(input_map)
+        map_masked = mos_operators.apply_mask(data_input.get_fdata(), nib.load(brainmask).get_fdata())
+        mos_writer.save_now(mos_storage.nifti_image(map_masked, data_input.affine, 'heatmap', storage, data_input.header),
+                            output_file)
+        return
+    
     apply_mask = fsl.ApplyMask()
     apply_mask.inputs.in_file = input_map
     apply_mask.inputs.mask_file = brainmask
-    apply_mask.inputs.out_file = output_file
+    apply_mask.inputs.out_file = mos_writer.temporary_file(output_file)
     mask_result = apply_mask.run()
+    os.replace(mos_writer.temporary_file(output_file), output_file)
     
 def file_cleanup(file_heatmap_ps_initial, file_heatmap_ps_weighted, save_dir, tag):
     # ~~~~~~CLEAN UP UNNECESSARY FILES~~~~~~
-    os.remove(file_heatmap_ps_initial)
-    os.remove(file_heatmap_ps_weighted)
+    # (in-memory runs never write the initial heatmap, and only write the weighted one for warping)
+    for file_intermediate in [file_heatmap_ps_initial, file_heatmap_ps_weighted]:
+        if os.path.isfile(file_intermediate):
+            os.remove(file_intermediate)
     #os.remove(os.path.join(save_dir,tag+'_FLIRT_omat.mat'))
     if os.path.isfile(os.path.join(save_dir,tag+'_heatmap_flirt.mat')):
         os.remove(os.path.join(save_dir,tag+'_heatmap_flirt.mat'))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+deSCRIPTion:
+    - content-addressed record of the files each processing stage produced, so a rerun only redoes the stages
+      whose inputs, parameters or backend changed (instead of skipping a stage whenever its output file exists)
+    - a stage key is a hash of the stage name, CACHE_VERSION, the contents of the stage's input files, its
+      parameters and the backend version
+    - each subject's save directory keeps a manifest (MANIFEST) of stage -> key, output files (relative to the
+      save directory) with their content hashes, and any extra values the stage wants back (e.g. metrics)
+    - a stage is 'current' if its key matches the manifest and every output still has the recorded contents,
+      'changed' if the record no longer matches, and 'new' if the stage has never been recorded
+    - bump CACHE_VERSION whenever a change to the pipeline changes its outputs
+"""
+
+import os
+import json
+import hashlib
+import logging
+import functools
+import threading
+import numpy as np
+import scipy
+
+parent_logger = logging.getLogger('main')
+
+CACHE_VERSION = 1
+MANIFEST = 'mosaics_cache.json'
+
+# muscles of one subject may record stages from parallel threads
+manifest_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1024)
+def content_digest(path, size, mtime_ns):
+    # size and mtime are only part of the lru_cache key, so a file is re-hashed when it is rewritten
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def file_digest(path):
+    stat = os.stat(path)
+    return content_digest(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+@functools.lru_cache(maxsize=1)
+def fsl_version():
+    from nipype.interfaces import fsl
+    return 'FSL '+str(fsl.Info.version())
+
+def backend_version(native_ops):
+    if native_ops:
+        return 'native numpy '+np.__version__+' scipy '+scipy.__version__
+    return fsl_version()
+
+def stage_key(stage, input_files, params):
+    # input_files: dict of name -> path (hashed by content), params: dict of json-able values
+    description = {'stage': stage,
+                   'cache version': CACHE_VERSION,
+                   'inputs': {name: file_digest(path) for name, path in input_files.items()},
+                   'params': params}
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+def load_manifest(save_dir):
+    file_manifest = os.path.join(save_dir, MANIFEST)
+    if not os.path.isfile(file_manifest):
+        return dict()
+    try:
+        with open(file_manifest) as f:
+            return json.load(f)
+    except ValueError:
+        parent_logger.warning('cache manifest '+file_manifest+' could not be read, its stages will be recomputed')
+        return dict()
+
+def stage_status(save_dir, stage, key):
+    entry = load_manifest(save_dir).get(stage)
+    if entry is None:
+        return 'new'
+    if entry['key'] != key:
+        return 'changed'
+    for output, digest in entry['outputs'].items():
+        output = os.path.join(save_dir, output)
+        if not os.path.isfile(output) or file_digest(output) != digest:
+            return 'changed'
+    return 'current'
+
+def stage_extra(save_dir, stage):
+    return load_manifest(save_dir).get(stage, dict()).get('extra')
+
+def record_stage(save_dir, stage, key, output_files, extra=None):
+    # numpy scalars in extra are stored as plain numbers
+    entry = {'key': key,
+             'outputs': {os.path.relpath(output, save_dir): file_digest(output) for output in output_files},
+             'extra': extra}
+    with manifest_lock:
+        manifest = load_manifest(save_dir)
+        manifest[stage] = entry
+        # write to a temporary file and swap it in, so an interrupted run never leaves a truncated manifest
+        file_manifest = os.path.join(save_dir, MANIFEST)
+        with open(file_manifest+'.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1, default=lambda value: value.item() if hasattr(value, 'item') else str(value))
+        os.replace(file_manifest+'.tmp', file_manifest)
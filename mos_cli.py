@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+deSCRIPTion:
+    - headless entry point for compute nodes without a display: python -m mos_cli DATA_FOLDER SAVE_DIR [options]
+    - builds plain-value data / configure dicts (the GUI's defaults, overridden by a JSON config file whose keys
+      are the configure / data dict keys, e.g. {"dilate": 5, "normalize": 1, "workers": 4}), then runs dataset
+      discovery, the main analysis and (with --group) the group analysis
+    - job arrays: --shard-index I --shard-count N processes every N-th subject from I (of the sorted data list)
+      and saves a shard results file. The shard that finds every shard done merges them into mapping_results.xlsx
+      (and runs the group analysis with --group); --merge does the same by hand
+    - work queue: --queue runs a worker that claims subjects from a queue in SAVE_DIR until every subject is done
+      (mos_queue), start as many as wanted, on any nodes sharing SAVE_DIR, at any time during the run
+    - --resume continues a run that stopped part way: muscles in its run journal (mos_journal) are skipped and
+      mapping_results.xlsx is built from the journaled and new rows
+    - never imports tkinter, PIL or mos_gui
+    - exit codes (EXIT_CODES) tell a scheduler how the run went:
+        0 = every subject / output done, 1 = finished, but some subjects or outputs failed,
+        2 = bad arguments or config file, 3 = no datasets found, 4 = the run stopped on an error
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+import multiprocessing
+
+import mos_find_datasets
+import mos_analysis_main
+import mos_analysis_group
+import mos_options
+import mos_queue
+
+parent_logger = logging.getLogger('main')
+
+EXIT_CODES = {'complete': 0, 'incomplete': 1, 'usage': 2, 'no data': 3, 'error': 4}
+
+# include/ next to the scripts (the GUI resolves it from the working directory / app bundle)
+INCLUDE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'include')
+
+# option -> accepted values, for options the GUI sets from a drop-down
+OPTION_LISTS = {'stim_coords': mos_options.STIM_COORDS,
+                'backend': mos_options.BACKENDS,
+                'heatmap_engine': mos_options.HEATMAP_ENGINES,
+                'site_aggregation': mos_options.SITE_AGGREGATIONS,
+                'storage': mos_options.STORAGE_LIST}
+
+def default_dicts(data_folder, save_dir):
+    # the data_dict / configure_dict mos_gui starts with, as plain values
+    data_dict = {'brainmask check': 0,
+                 'brainmask suffix': '_brain_mask.nii.gz',
+                 'stim_coords': OPTION_LISTS['stim_coords'][0],
+                 'data folder': os.path.abspath(data_folder),
+                 'save_dir': os.path.abspath(save_dir),
+                 'save_prefix': 'outputs',
+                 'data list': list(),
+                 'recursive': 0,
+                 'grid spacing': 7}
+
+    config_dict = {'dilate': 3,
+                   'smooth': 7,
+                   'MEP_threshold': 0,
+                   'workers': 1,
+                   'muscle threads': 1,
+                   'memory limit': 0,
+                   'compression threads': 2,
+                   'gzip level': 1,
+                   'normalize': 0,
+                   'atlas': os.path.join(INCLUDE_DIR, 'MNI152_T1_1mm.nii.gz'),
+                   'atlas mask': os.path.join(INCLUDE_DIR, 'MNI152_T1_1mm_brain_mask.nii.gz'),
+                   'backend': OPTION_LISTS['backend'][0],
+                   'in memory': 1,
+                   'debug dump': 0,
+                   'crop to stimulations': 1,
+                   'batch muscles': 0,
+                   'memory lean': 0,
+                   'use cache': 1,
+                   'group concatenated': 0,
+                   'heatmap_engine': OPTION_LISTS['heatmap_engine'][0],
+                   'site_aggregation': OPTION_LISTS['site_aggregation'][0],
+                   'storage': OPTION_LISTS['storage'][0],
+                   'shard index': 0,
+                   'shard count': 1,
+                   'resume': 0}
+
+    return data_dict, config_dict
+
+def apply_config_file(file_config, data_dict, config_dict):
+    # overrides from a JSON object of option -> value. Raises ValueError for unknown options / values
+    with open(file_config) as f:
+        overrides = json.load(f)
+    if not isinstance(overrides, dict):
+        raise ValueError(file_config+' must hold a JSON object of option: value pairs')
+
+    for key, value in overrides.items():
+        if key in ['data folder', 'save_dir', 'data list']:
+            raise ValueError(key+' is set on the command line, not in the config file')
+        elif key in config_dict:
+            target_dict = config_dict
+        elif key in data_dict:
+            target_dict = data_dict
+        else:
+            raise ValueError('unknown option in '+file_config+': '+key)
+
+        if key in OPTION_LISTS and value not in OPTION_LISTS[key]:
+            raise ValueError(key+' must be one of '+', '.join(OPTION_LISTS[key]))
+        # same type as the default (so "3" or 3.0 for the dilation still works), paths kept as given
+        if isinstance(target_dict[key], bool) or not isinstance(target_dict[key], (int, float)):
+            target_dict[key] = value
+        elif isinstance(target_dict[key], int):
+            target_dict[key] = int(value)
+        else:
+            target_dict[key] = float(value)
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(prog='mosaics',
+                                     description='MOSAICS batch processing without the GUI')
+    parser.add_argument('data_folder', help='folder of T1 (.nii / .nii.gz) and stimulation (.xls / .xlsx / .csv / .tsv / '
+                        '.parquet / Brainsight .txt) files')
+    parser.add_argument('save_dir', help='output folder (one subfolder per subject, Group_analysis for --group)')
+    parser.add_argument('-c', '--config', help='JSON file of option: value pairs (configure / data dict keys)')
+    parser.add_argument('-g', '--group', action='store_true', help='run the group analysis after the main analysis')
+    parser.add_argument('--group-only', action='store_true', help='only run the group analysis on existing outputs')
+    parser.add_argument('-r', '--recursive', action='store_true', help='also search subfolders of data_folder (one '
+                        'folder per subject, or BIDS-style sub-*/ses-* folders)')
+    parser.add_argument('--dry-run', action='store_true', help='report what the cache would recompute, process nothing')
+    parser.add_argument('--shard-index', type=int, help='this job\'s shard, 0 to shard count - 1 (e.g. the array task id)')
+    parser.add_argument('--shard-count', type=int, help='number of shards the data list is split into')
+    parser.add_argument('--merge', action='store_true', help='only merge the shard results of a sharded run')
+    parser.add_argument('--resume', action='store_true', help='continue an interrupted run, skipping the muscles '
+                        'its journal records as done')
+    parser.add_argument('--queue', action='store_true', help='claim subjects from a work queue in save_dir, shared '
+                        'with any other --queue workers')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only log warnings and errors')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    # returns one of EXIT_CODES
+    args = parse_arguments(argv)
+
+    # log to stderr, as the GUI's terminal handler does
+    stderr_handler = logging.StreamHandler()
+    stderr_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    parent_logger.addHandler(stderr_handler)
+    parent_logger.setLevel(logging.WARNING if args.quiet else logging.INFO)
+
+    # ~~~~~~BUILD PLAIN-VALUE DICTS~~~~~~
+    if not os.path.isdir(args.data_folder):
+        parent_logger.error('data folder '+args.data_folder+' not found')
+        return EXIT_CODES['usage']
+    data_dict, config_dict = default_dicts(args.data_folder, args.save_dir)
+    if args.config is not None:
+        try:
+            apply_config_file(args.config, data_dict, config_dict)
+        except (OSError, ValueError) as error:
+            parent_logger.error('config file: '+str(error))
+            return EXIT_CODES['usage']
+    if args.shard_index is not None:
+        config_dict['shard index'] = args.shard_index
+    if args.shard_count is not None:
+        config_dict['shard count'] = args.shard_count
+    if config_dict['shard count'] < 1 or not 0 <= config_dict['shard index'] < config_dict['shard count']:
+        parent_logger.error('shard index must be between 0 and shard count - 1')
+        return EXIT_CODES['usage']
+    sharded = config_dict['shard count'] > 1
+    if args.resume:
+        config_dict['resume'] = 1
+    if args.recursive:
+        data_dict['recursive'] = 1
+    if args.queue and (sharded or args.merge or args.group_only or args.resume):
+        parent_logger.error('--queue cannot be combined with sharding, --merge, --group-only or --resume '
+                            '(a queue picks up where it stopped by itself)')
+        return EXIT_CODES['usage']
+    os.makedirs(data_dict['save_dir'], exist_ok=True)
+
+    # ~~~~~~FIND DATASETS, RUN~~~~~~
+    data_dict['data list'] = mos_find_datasets.main(data_dict, config_dict)
+    if len(data_dict['data list']) == 0:
+        parent_logger.error('no matching T1 / stimulation data found in '+data_dict['data folder'])
+        return EXIT_CODES['no data']
+    parent_logger.info(str(len(data_dict['data list']))+' subjects found in '+data_dict['data folder'])
+
+    try:
+        if args.dry_run:
+            mos_analysis_main.dry_run(data_dict, config_dict)
+            return EXIT_CODES['complete']
+        run_complete = True
+        if args.merge:
+            return EXIT_CODES['complete'] if merge_and_group(data_dict, config_dict, args.group) else EXIT_CODES['incomplete']
+        if args.queue:
+            return EXIT_CODES['complete'] if mos_queue.main(data_dict, config_dict, args.group) else EXIT_CODES['incomplete']
+        if not args.group_only:
+            run_complete = mos_analysis_main.main(data_dict, config_dict)
+        if sharded and not args.group_only:
+            # the shard to find every shard done merges them (nothing to do yet otherwise)
+            if mos_analysis_main.shards_done(data_dict, config_dict):
+                run_complete = merge_when_done(data_dict, config_dict, args.group) and run_complete
+        elif args.group or args.group_only:
+            run_complete = mos_analysis_group.main(data_dict, config_dict) and run_complete
+    except Exception:
+        parent_logger.exception('MOSAICS stopped on an error')
+        return EXIT_CODES['error']
+
+    return EXIT_CODES['complete'] if run_complete else EXIT_CODES['incomplete']
+
+def merge_and_group(data_dict, config_dict, run_group):
+    # merge the shard results, then the group analysis if asked for. True if both completed
+    merge_complete = mos_analysis_main.merge_shards(data_dict, config_dict)
+    if run_group and mos_analysis_main.shards_done(data_dict, config_dict):
+        merge_complete = mos_analysis_group.main(data_dict, config_dict) and merge_complete
+    return merge_complete
+
+def merge_when_done(data_dict, config_dict, run_group):
+    # merge_and_group() one shard at a time, when shards finish together: under the queue's merge lock, so a
+    # lock left by a killed shard goes stale, and a shard finding another one merging waits, then merges itself
+    file_lock = os.path.join(data_dict['save_dir'], 'mapping_results_merge.lock')
+    with mos_queue.merge_lock(file_lock, 'shard '+str(config_dict['shard index'])):
+        return merge_and_group(data_dict, config_dict, run_group)
+
+if __name__ == '__main__':
+    # (subject worker processes are spawned, so they re-import this module rather than re-running it)
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -15,66 +15,182 @@ RELEVANT VARS:
     data_dict vals used here:
         'data': the selected folder the user picks, full of data to process
     data_dict vals CREATED here:
-        'data list': list of all subjects with nii and xls to process
+        'data list': list of all subjects with nii and xls to process, sorted by file name so every machine
+        builds (and shard_indices() splits) the same list. With 'recursive', subfolders are searched too
+        and the nii / xls paths are relative to the data folder
     
 
 """
 
 import os
 import re
-import glob
+import bisect
 import logging
 
+import mos_options
+
 parent_logger = logging.getLogger('main')
 
-def main(data_dict, config_dict):
+# filenames must contain only alphanumeric characters, hyphens, and underscores
+valid_nii_regex = re.compile(r'^([A-Za-z0-9_-]+)(.nii|.nii.gz)$')
+valid_xl_regex = re.compile(r'^([A-Za-z0-9_-]+)('+'|'.join(re.escape(extension) for extension in mos_options.STIM_EXTENSIONS)+')$')
+# BIDS-style subject / session folders (sub-01/ses-1/anat/sub-01_ses-1_T1w.nii.gz)
+bids_folder_regex = re.compile(r'^(sub|ses)-[A-Za-z0-9]+$')
+
+def main(data_dict, config_dict, progress=None):
+    # data_dict['recursive'] (0 / 1, or a tk variable): also search subfolders, e.g. one folder per subject or
+    # a BIDS-style sub-*/ses-* layout. progress(folders, files) is called as folders are scanned (from the
+    # calling thread, which for the GUI is not the Tk thread)
     
     # initialize variables from input dicts
     data_dir = data_dict['data folder']
+    recursive = data_dict.get('recursive', 0)
+    if hasattr(recursive, 'get'):
+        recursive = recursive.get()
+    # (the default save directory is inside the data folder, its outputs are not searched)
+    skip_dirs = [os.path.abspath(str(data_dict['save_dir']))] if 'save_dir' in data_dict else []
     
-    # initialize empty list that will be filled here
-    data_dict['data list'] = list()
-        
-    # initialize regular expression to check whether filenames are valid
-    # i.e. contain only alphanumeric characters, hyphens, and underscores
-    valid_regex = re.compile(r'^[A-Za-z0-9._-]+$')
-    valid_nii_regex = re.compile(r'^([A-Za-z0-9_-]+)(.nii|.nii.gz)$')
-    valid_xl_regex = re.compile(r'^([A-Za-z0-9_-]+)(.xls|.xlsx)$')
-
-    # find all nii or nii.gz datasets
-    datasets = glob.glob(os.path.join(data_dict['data folder'],'*.nii*')) #returns a list, possibly too inclusive but hopefully not
-    # separate filename from full path (including parent folderz)
-    datasets = [os.path.basename(x) for x in datasets]
+    # one directory listing per folder, then T1 / stimulation pairs by lookups in that index
+    folder_index = scan_folder(data_dir, recursive == 1, skip_dirs, progress)
+    data_list = list()
+    # tag -> T1 it was first found for: the tag names the subject's save folder, cache and results rows, so
+    # a second T1 with the same tag (S1.nii next to S1.nii.gz, ...) is left out
+    tag_t1 = dict()
+    for (group, bids), (nii_list, stim_list) in sorted(group_files(folder_index).items()):
+        for subject in match_group(group, bids, nii_list, stim_list, data_dir):
+            if tag_t1.setdefault(subject[0], subject[1]) != subject[1]:
+                parent_logger.error(subject[1]+' has the same subject tag ('+subject[0]+') as '+tag_t1[subject[0]]+
+                                    ', leaving it out. Rename one of them')
+                continue
+            data_list.append(subject)
+            parent_logger.debug(''+subject[1]+', '+subject[2]+' are a matched pair. Added to processing list')
     
-    for nii in datasets:
+    # list of subjects to process, paths relative to the data folder
+    data_dict['data list'] = data_list
+    return data_dict['data list']
+
+def scan_folder(data_dir, recursive=False, skip_dirs=(), progress=None):
+    # relative folder ('' = data_dir) -> sorted file names, one os.scandir() per folder (file types come with
+    # the listing, so no file is stat'ed). Hidden folders and skip_dirs are not searched
+    folder_index = dict()
+    folders = ['']
+    n_files = 0
+    while folders:
+        folder = folders.pop()
+        names = list()
+        with os.scandir(os.path.join(data_dir, folder)) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    names.append(entry.name)
+                elif recursive and entry.is_dir() and not entry.name.startswith('.') and \
+                        os.path.abspath(entry.path) not in skip_dirs:
+                    folders.append(os.path.join(folder, entry.name))
+        folder_index[folder] = sorted(names)
+        n_files += len(names)
+        if progress is not None:
+            progress(len(folder_index), n_files)
+    return folder_index
+
+def pairing_folder(folder):
+    # (folder, BIDS) whose T1 and stimulation files pair up: the file's own folder, or in a BIDS-style layout
+    # the deepest sub-* / ses-* folder above it, so sub-01/ses-1/anat and sub-01/ses-1/tms pair up
+    parts = folder.split(os.sep) if folder != '' else []
+    bids_depth = 0
+    for depth, part in enumerate(parts):
+        if bids_folder_regex.match(part):
+            bids_depth = depth + 1
+    if bids_depth > 0:
+        return os.sep.join(parts[:bids_depth]), True
+    return folder, False
+
+def stim_extension(name):
+    # True if the file name ends in a stimulation data extension and is not a BIDS sidecar table
+    if os.path.splitext(name)[1].lower() not in mos_options.STIM_EXTENSIONS:
+        return False
+    return not any(name == sidecar or name.endswith('_'+sidecar) for sidecar in mos_options.BIDS_SIDECARS)
+
+def stim_header(file_stim):
+    # True if a text stimulation file (.csv / .tsv / .txt) starts like one: a Brainsight export (.txt), or a
+    # header with X, Y, Z (or Loc. X ...) and MEP columns. Other files are always taken
+    extension = os.path.splitext(file_stim)[1].lower()
+    if extension not in ['.csv', '.tsv', '.txt']:
+        return True
+    try:
+        with open(file_stim, encoding='utf-8-sig', errors='replace') as f:
+            first_line = f.readline()
+    except OSError:
+        return False
+    if extension == '.txt' and first_line.startswith(mos_options.BRAINSIGHT_HEADER):
+        return True
+    columns = [column.strip().strip('"') for column in first_line.rstrip('\r\n').split(',' if extension == '.csv' else '\t')]
+    has_locs = all(axis in columns or 'Loc. '+axis in columns for axis in ['X', 'Y', 'Z'])
+    return has_locs and any('MEP' in column for column in columns)
+
+def group_files(folder_index):
+    # (pairing folder, BIDS) -> ([.nii* files], [(stimulation file name, relative path)], sorted by name)
+    groups = dict()
+    for folder, names in folder_index.items():
+        key = pairing_folder(folder)
+        for name in names:
+            if '.nii' in name:
+                groups.setdefault(key, (list(), list()))[0].append(os.path.join(folder, name))
+            elif stim_extension(name):
+                groups.setdefault(key, (list(), list()))[1].append((name, os.path.join(folder, name)))
+    for nii_list, stim_list in groups.values():
+        nii_list.sort(key=os.path.basename)
+        stim_list.sort()
+    return groups
+
+def match_group(group, bids, nii_list, stim_list, data_dir):
+    # [tag, nii, xls] entries of one pairing folder. Stimulation files match a T1 whose name (tag) they start
+    # with, found by bisecting the sorted names; in a BIDS-style folder the *_T1w image pairs with every
+    # spreadsheet, its tag being the image name without _T1w (sub-01_ses-1). Text files are only paired if
+    # their header looks like stimulation data (stim_header). A subfolder's subjects are tagged with its path
+    # (subjA/T1.nii.gz -> subjA_T1), so T1s named alike in different folders stay apart
+    subjects = list()
+    folder_prefix = re.sub(r'[^A-Za-z0-9_-]', '-', group.replace(os.sep, '_'))
+    stim_names = [name for name, path in stim_list]
+    for nii in nii_list:
         # check if filename has alphanumerics, underscores, hyphens, and ends with .nii or .nii.gz
-        nii_match = valid_nii_regex.search(nii)
-        #if we find a match
-        if nii_match != None:
-            # tag = everything before the dot
-            tag = nii_match.group(1)
-            # find all xls or xlsx files that match the tag
-            stim_list = glob.glob(os.path.join(data_dir,tag+'*.xls*'))
-            stim_list = [os.path.basename(x) for x in stim_list]
-            if stim_list != []:
-                for stim_data in stim_list:
-                    # probably unnecessary: check if xls* file has only alphanumeric, _, or -
-                    stim_match = valid_xl_regex.search(stim_data)
-                    if stim_match != None:
-                        # if we have valid nii and xl files, append the info of this pair to a data processing list
-                        data_dict['data list'].append([tag, nii_match.string, stim_match.string])
-                        parent_logger.debug(''+nii_match.string+', '+stim_match.string+' are a matched pair. Added to processing list')
-                    else:
-                        parent_logger.debug(''+str(stim_data)+' name invalid, must contain only A-Z, 0-9, _, and -')
-            else:
-                parent_logger.debug('no stimulation data found that matches '+nii_match.string+', moving on')
+        nii_match = valid_nii_regex.search(os.path.basename(nii))
+        if nii_match is None:
+            parent_logger.debug(''+nii+' name invalid, must contain only A-Z, 0-9, _, and -')
+            continue
+        tag = nii_match.group(1)
+        if bids:
+            if not tag.endswith('_T1w'):
+                continue
+            tag = tag[:-len('_T1w')]
+            matches = stim_list
         else:
-            parent_logger.debug(''+str(nii)+' name invalid, must contain only A-Z, 0-9, _, and -')
-    
-    return data_dict['data list']
-    
-    # return list of subjects to process
-    # this final step is already done because data_dict['data list'] has been constructed
+            first = bisect.bisect_left(stim_names, tag)
+            last = first
+            while last < len(stim_names) and stim_names[last].startswith(tag):
+                last += 1
+            matches = stim_list[first:last]
+            if folder_prefix != '' and not tag.startswith(folder_prefix):
+                tag = folder_prefix+'_'+tag
+        if len(matches) == 0:
+            parent_logger.debug('no stimulation data found that matches '+nii+', moving on')
+        for stim_name, stim_data in matches:
+            # probably unnecessary: check if xls* file has only alphanumeric, _, or -
+            if valid_xl_regex.search(stim_name) is not None:
+                if not stim_header(os.path.join(data_dir, stim_data)):
+                    parent_logger.debug(''+stim_data+' does not look like stimulation data (no Brainsight header or '
+                                        'X, Y, Z and MEP columns), not paired with '+nii)
+                    continue
+                # if we have valid nii and xl files, append the info of this pair to a data processing list
+                subjects.append([tag, nii, stim_data])
+            else:
+                parent_logger.debug(''+stim_data+' name invalid, must contain only A-Z, 0-9, _, and -')
+    return subjects
+
+def shard_indices(n_subjects, shard_index, shard_count):
+    # data list indices of one shard (0 <= shard_index < shard_count) of a run split across machines:
+    # every shard_count-th subject, starting at shard_index, so shards stay balanced however subjects are ordered
+    if not 0 <= shard_index < shard_count:
+        raise ValueError('shard index must be between 0 and shard count - 1, got '+str(shard_index)+' of '+str(shard_count))
+    return list(range(shard_index, n_subjects, shard_count))
     
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -10,6 +10,7 @@ Toolbox version: α - v1.2.2
 
 import os, sys
 import logging
+import multiprocessing
 import tkinter as tk
 import tkinter.filedialog as filedialog
 import tkinter.messagebox as messagebox
@@ -20,9 +21,10 @@ import subprocess
 from queue import Queue, Empty
 from threading import Thread
 
-import mos_analysis_main
+# the analysis modules (nipype, pandas, scipy, nibabel) are imported when an analysis starts, not here,
+# so the window opens without waiting for them (python mos_startup_benchmark.py measures this)
 import mos_find_datasets
-import mos_analysis_group
+import mos_options
 
 main_logger = logging.getLogger('main')
 
@@ -113,6 +115,12 @@ class MOSAICSapp(tk.Tk):
                                          pady=5,
                                          width=15,
                                          command=self.call_main_analysis_threaded)
+        # report which stages a MOSAICS analysis would recompute, without running it
+        self.button_dry_run = tk.Button(self.buttons,
+                                        text="Dry run (cache)",
+                                        pady=5,
+                                        width=15,
+                                        command=self.call_dry_run_threaded)
         self.button_analysis_group = tk.Button(self.buttons,
                                                text="Group-wise analysis",
                                                pady=5,
@@ -133,12 +141,13 @@ class MOSAICSapp(tk.Tk):
         self.button_select.grid(row=1,pady=10)
         self.button_configure_analysis.grid(row=2,pady=10)
         self.button_analysis_main.grid(row=3,pady=10)
-        self.button_analysis_group.grid(row=4,pady=10)
-        self.button_view.grid(row=5,pady=10)
-        self.button_close.grid(row=6,pady=10)
+        self.button_dry_run.grid(row=4,pady=10)
+        self.button_analysis_group.grid(row=5,pady=10)
+        self.button_view.grid(row=6,pady=10)
+        self.button_close.grid(row=7,pady=10)
         # center buttons with empty top and bottom rows that are greedy for space.
         self.buttons.grid_rowconfigure(0, weight=1)
-        self.buttons.grid_rowconfigure(7, weight=1)        
+        self.buttons.grid_rowconfigure(8, weight=1)        
         
         # ~~~~~~ LOGGING FRAME ~~~~~~
         self.logger_text = tk.Text(self.logger,
@@ -161,12 +170,13 @@ class MOSAICSapp(tk.Tk):
         # self.data_dict['stim_flip'] = tk.IntVar(self) # tk.Checkbutton in gui_select
         self.data_dict['brainmask check'] = tk.IntVar(self) # default is 0
         self.data_dict['brainmask suffix'] = '_brain_mask.nii.gz'
-        self.data_dict['stim_coords_list'] = ["Brainsight", "Nifti"]
+        self.data_dict['stim_coords_list'] = mos_options.STIM_COORDS
         self.data_dict['stim_coords'] = tk.StringVar(self)
         self.data_dict['stim_coords'].set(self.data_dict['stim_coords_list'][0])
         self.data_dict['save_dir'] = os.getcwd()
         self.data_dict['save_prefix'] = 'outputs'
         self.data_dict['data list'] = list()
+        self.data_dict['recursive'] = tk.IntVar(self) # default is 0, search subfolders (per subject / BIDS) too
         self.data_dict['select gui open'] = None
         self.data_dict['grid spacing'] = 7
         
@@ -175,9 +185,33 @@ class MOSAICSapp(tk.Tk):
         self.configure_dict['dilate'] = 3
         self.configure_dict['smooth'] = 7
         self.configure_dict['MEP_threshold'] = 0
+        self.configure_dict['workers'] = 1
+        self.configure_dict['muscle threads'] = 1
+        self.configure_dict['memory limit'] = 0 # GB, 0 = no limit
+        self.configure_dict['compression threads'] = 2 # 0 = compress each output as it is saved
+        self.configure_dict['gzip level'] = 1 # nibabel's default
         self.configure_dict['normalize'] = tk.IntVar(self) # default is 0
         self.configure_dict['atlas'] = resource_path('include/MNI152_T1_1mm.nii.gz')
         self.configure_dict['atlas mask'] = resource_path('include/MNI152_T1_1mm_brain_mask.nii.gz')
+        self.configure_dict['backend_list'] = mos_options.BACKENDS
+        self.configure_dict['backend'] = tk.StringVar(self)
+        self.configure_dict['backend'].set(self.configure_dict['backend_list'][0])
+        self.configure_dict['in memory'] = tk.IntVar(self, value=1) # default is 1
+        self.configure_dict['debug dump'] = tk.IntVar(self) # default is 0
+        self.configure_dict['crop to stimulations'] = tk.IntVar(self, value=1) # default is 1
+        self.configure_dict['batch muscles'] = tk.IntVar(self) # default is 0
+        self.configure_dict['memory lean'] = tk.IntVar(self) # default is 0
+        self.configure_dict['use cache'] = tk.IntVar(self, value=1) # default is 1
+        self.configure_dict['group concatenated'] = tk.IntVar(self) # default is 0
+        self.configure_dict['heatmap_engine_list'] = mos_options.HEATMAP_ENGINES
+        self.configure_dict['heatmap_engine'] = tk.StringVar(self)
+        self.configure_dict['heatmap_engine'].set(self.configure_dict['heatmap_engine_list'][0])
+        self.configure_dict['site_aggregation_list'] = mos_options.SITE_AGGREGATIONS
+        self.configure_dict['site_aggregation'] = tk.StringVar(self)
+        self.configure_dict['site_aggregation'].set(self.configure_dict['site_aggregation_list'][0])
+        self.configure_dict['storage_list'] = mos_options.STORAGE_LIST
+        self.configure_dict['storage'] = tk.StringVar(self)
+        self.configure_dict['storage'].set(self.configure_dict['storage_list'][0])
         self.configure_dict['config gui open'] = None
     
     # ~~~~~~ Methods for MOSAICS functions ~~~~~~
@@ -213,6 +247,14 @@ class MOSAICSapp(tk.Tk):
             main_processing_thread.start()
             self.monitor_thread_main(main_processing_thread)
         
+    def call_dry_run_threaded(self):
+        
+        dry_run_thread = MainAsyncProcessing(self.data_dict, self.configure_dict, dry_run=True)
+        if dry_run_thread.running == False:
+            self.button_dry_run['state'] = tk.DISABLED
+            dry_run_thread.start()
+            self.monitor_thread_dry_run(dry_run_thread)
+        
     def call_group_analysis_threaded(self):
         group_processing_thread = GroupAsyncProcessing(self.data_dict, self.configure_dict)
         if group_processing_thread.running == False:
@@ -233,6 +275,12 @@ class MOSAICSapp(tk.Tk):
         else:
             self.button_analysis_main['state'] = tk.NORMAL
             
+    def monitor_thread_dry_run(self, thread):
+        if thread.is_alive():
+            self.after(100, lambda: self.monitor_thread_dry_run(thread))
+        else:
+            self.button_dry_run['state'] = tk.NORMAL
+            
     def monitor_thread_group(self, thread):
         if thread.is_alive():
             self.after(100, lambda: self.monitor_thread_group(thread))
@@ -364,6 +412,16 @@ class guiSelect(tk.Toplevel):
                                 text="Change save directory",
                                 command = self.set_save_dir)
         
+        # search subfolders too: one folder per subject, or BIDS-style sub-*/ses-* folders
+        self.recursive_label = tk.Label(self.frame,
+                                        text="Subfolders: ")
+        self.recursive_check = tk.Checkbutton(self.frame,
+                                              text="Search subfolders (per subject / BIDS)",
+                                              variable=self.local_data['recursive'])
+        # datasets found, or the progress of the search
+        self.discovery_status = tk.Label(self.frame,
+                                         text="")
+        
         self.close_button = tk.Button(self.frame,
                                   text="Save",
                                   command = self.save_and_close)
@@ -382,10 +440,13 @@ class guiSelect(tk.Toplevel):
         self.save_label.grid(row=4, column=0, columnspan=1, pady=2, sticky="e")
         self.path_save.grid(row=4, column=1, columnspan=2, pady=2, sticky="w")
         self.select_save.grid(row=4,column=3, columnspan=1, sticky="w")
-        self.close_button.grid(row=5, column=3, columnspan=1, pady=(8,0), sticky="w")
+        self.recursive_label.grid(row=5, column=0, columnspan=1, sticky="e")
+        self.recursive_check.grid(row=5, column=1, columnspan=3, sticky="w")
+        self.discovery_status.grid(row=6, column=0, columnspan=3, pady=(8,0), sticky="w")
+        self.close_button.grid(row=6, column=3, columnspan=1, pady=(8,0), sticky="w")
 
         # configure the grid
-        for r in range(6):
+        for r in range(7):
             self.frame.rowconfigure(r, weight=1)
         for c in range(4):
             self.frame.columnconfigure(c, weight=1)
@@ -395,6 +456,9 @@ class guiSelect(tk.Toplevel):
         # Path.home() used here to get home directory for osx and windows, both
         data_folder = filedialog.askdirectory(initialdir=str(Path.home()),
                                           title="Select a folder of files to process")
+        if data_folder == '':
+            # (dialogue cancelled, keep the current selection)
+            return
         
         # update the text field to reflect user chosen folder
         p = PurePath(data_folder)
@@ -408,10 +472,36 @@ class guiSelect(tk.Toplevel):
         # bring this value back to the main GUI right away, so it's not lost due to scope
         self.local_data['data folder'] = data_folder
         
-        # make a list of all datasets in this folder, stored as data_dict['data list'] within this function
-        self.local_data['data list'] = mos_find_datasets.main(self.local_data, self.config_dict)
-        
-        main_logger.info(''+str(len(self.local_data['data list']))+' subjects found for processing in your chosen folder.')
+        # make a list of all datasets in this folder, stored as data_dict['data list'] (in a thread, so large
+        # or network folders don't freeze the window)
+        self.discover_data(lambda: main_logger.info(''+str(len(self.local_data['data list']))+
+                                                    ' subjects found for processing in your chosen folder.'))
+
+    def discover_data(self, when_done):
+        # mos_find_datasets in a DiscoveryAsyncProcessing thread, then when_done() (in the Tk thread)
+        discovery_thread = DiscoveryAsyncProcessing(self.local_data, self.config_dict)
+        self.data_select['state'] = tk.DISABLED
+        self.close_button['state'] = tk.DISABLED
+        discovery_thread.start()
+        self.monitor_discovery(discovery_thread, when_done)
+    
+    def monitor_discovery(self, thread, when_done):
+        if not self.window.winfo_exists():
+            # (window closed during the search)
+            return
+        if thread.is_alive():
+            self.discovery_status.config(text='searching: '+str(thread.progress[0])+' folders, '+
+                                         str(thread.progress[1])+' files')
+            self.window.after(100, lambda: self.monitor_discovery(thread, when_done))
+        else:
+            self.data_select['state'] = tk.NORMAL
+            self.close_button['state'] = tk.NORMAL
+            if thread.error is not None:
+                self.discovery_status.config(text='search failed')
+                main_logger.error('searching the data folder failed: '+str(thread.error))
+                return
+            self.discovery_status.config(text=str(len(self.local_data['data list']))+' subjects found')
+            when_done()
 
     def mask_check(self):
         if self.local_data['brainmask check'].get() == 1:
@@ -442,13 +532,14 @@ class guiSelect(tk.Toplevel):
             messagebox.showerror('Input Error','Data not found, please select a folder.')
         
         if settings_error == False:
-            self.local_data['data list'] = mos_find_datasets.main(self.local_data, self.config_dict)
-            main_logger.info('double checking data folder, '+str(len(self.local_data['data list']))+' subjects found for processing.')
-            
             self.local_data['grid spacing'] = self.gridspace_form.get()
-            
-            self.window.destroy()
-            self.local_data['select gui open'] = None
+            # (searched again, as the subfolder option may have changed)
+            self.discover_data(self.close_after_discovery)
+
+    def close_after_discovery(self):
+        main_logger.info('double checking data folder, '+str(len(self.local_data['data list']))+' subjects found for processing.')
+        self.window.destroy()
+        self.local_data['select gui open'] = None
         
 class guiConfigure(tk.Toplevel):
     
@@ -500,6 +591,49 @@ class guiConfigure(tk.Toplevel):
                                  justify='center')
         self.MEP_form.insert(0,str(self.local_data['MEP_threshold']))
         
+        # entry field for number of subjects processed in parallel
+        self.workers_label = tk.Label(self.frame,
+                                      text="Subjects processed in parallel:")
+        self.workers_form = tk.Entry(self.frame,
+                                     width=5,
+                                     relief="groove",
+                                     justify='center')
+        self.workers_form.insert(0,str(self.local_data['workers']))
+        
+        # entry field for number of muscles (of one subject) processed in parallel threads
+        self.muscle_threads_label = tk.Label(self.frame,
+                                             text="Muscles processed in parallel:")
+        self.muscle_threads_form = tk.Entry(self.frame,
+                                            width=5,
+                                            relief="groove",
+                                            justify='center')
+        self.muscle_threads_form.insert(0,str(self.local_data['muscle threads']))
+        
+        # entry field for the peak memory the run may use (GB), subjects / muscle threads are held back to fit
+        self.memory_limit_label = tk.Label(self.frame,
+                                           text="Memory limit (GB, 0 = none):")
+        self.memory_limit_form = tk.Entry(self.frame,
+                                          width=5,
+                                          relief="groove",
+                                          justify='center')
+        self.memory_limit_form.insert(0,str(self.local_data['memory limit']))
+        
+        # entry fields for background compression of the .nii.gz outputs (mos_writer)
+        self.compression_threads_label = tk.Label(self.frame,
+                                                  text="Compression threads (0 = none):")
+        self.compression_threads_form = tk.Entry(self.frame,
+                                                 width=5,
+                                                 relief="groove",
+                                                 justify='center')
+        self.compression_threads_form.insert(0,str(self.local_data['compression threads']))
+        self.gzip_level_label = tk.Label(self.frame,
+                                         text="Compression level (1-9):")
+        self.gzip_level_form = tk.Entry(self.frame,
+                                        width=5,
+                                        relief="groove",
+                                        justify='center')
+        self.gzip_level_form.insert(0,str(self.local_data['gzip level']))
+        
         # checkbox for normalise or no?
         self.normalise_bool = tk.Checkbutton(self.frame,
                                              text="Warp to standard atlas?",
@@ -533,6 +667,48 @@ class guiConfigure(tk.Toplevel):
                                                 state='disabled',
                                                 command = self.select_atlas_mask)
         
+        # image operators (dilation, masking, merge / mean) run natively in numpy or through fslmaths
+        self.backend_label = tk.Label(self.frame, text="Image operator backend:")
+        self.backend_opts = tk.OptionMenu(self.frame, self.local_data['backend'], *self.local_data['backend_list'])
+        self.backend_opts.config(width=8)
+        # heatmap produced by filtering the responses volume, or by summing a blurred sphere per stimulation
+        self.engine_label = tk.Label(self.frame, text="Heatmap engine:")
+        self.engine_opts = tk.OptionMenu(self.frame, self.local_data['heatmap_engine'], *self.local_data['heatmap_engine_list'])
+        self.engine_opts.config(width=14)
+        # value mapped at a site stimulated more than once (mos_sites)
+        self.aggregation_label = tk.Label(self.frame, text="Repeated stimulations of a site:")
+        self.aggregation_opts = tk.OptionMenu(self.frame, self.local_data['site_aggregation'], *self.local_data['site_aggregation_list'])
+        self.aggregation_opts.config(width=18)
+        # data types of the saved maps: float64 as computed, or compact float32 heatmaps / uint8 grids / int16 responses
+        self.storage_label = tk.Label(self.frame, text="Output storage:")
+        self.storage_opts = tk.OptionMenu(self.frame, self.local_data['storage'], *self.local_data['storage_list'])
+        self.storage_opts.config(width=26)
+        # keep intermediate maps in memory (native backend), and optionally write them out for debugging
+        self.in_memory_bool = tk.Checkbutton(self.frame,
+                                             text="Keep intermediate maps in memory?",
+                                             variable=self.local_data['in memory'])
+        self.crop_bool = tk.Checkbutton(self.frame,
+                                        text="Crop computation to stimulated region?",
+                                        variable=self.local_data['crop to stimulations'])
+        self.batch_bool = tk.Checkbutton(self.frame,
+                                         text="Process all muscles in one batch?",
+                                         variable=self.local_data['batch muscles'])
+        # float32 maps, computed in place in reused buffers (per-muscle path only)
+        self.lean_bool = tk.Checkbutton(self.frame,
+                                        text="Memory-lean maps (float32, in place)?",
+                                        variable=self.local_data['memory lean'])
+        self.debug_dump_bool = tk.Checkbutton(self.frame,
+                                              text="Save intermediate maps (debugging)?",
+                                              variable=self.local_data['debug dump'])
+        # only recompute stages whose inputs / parameters changed since the last run (mos_cache)
+        self.cache_bool = tk.Checkbutton(self.frame,
+                                         text="Reuse up-to-date results from earlier runs?",
+                                         variable=self.local_data['use cache'])
+        # group analysis: the 4D file of all subject heatmaps is not needed for the group maps
+        self.concatenated_bool = tk.Checkbutton(self.frame,
+                                                text="Save concatenated group heatmaps (4D)?",
+                                                variable=self.local_data['group concatenated'])
+        
         self.bg_init = self.normalise_atlas_select.cget("background")
         self.close_button = tk.Button(self.frame,
                                       text="Save",
@@ -553,10 +729,35 @@ class guiConfigure(tk.Toplevel):
         self.normalise_atlas.grid(row=5,column=1, columnspan=1, sticky="w")
         self.atlas_mask_select.grid(row=6, column=0, columnspan=1, padx=2, sticky="e")
         self.atlas_mask.grid(row=6,column=1,pady=5, columnspan=1, sticky="w")
-        self.close_button.grid(row=7,column=1, columnspan=1, sticky="w")
+        self.backend_label.grid(row=7, column=0, columnspan=1, sticky="e")
+        self.backend_opts.grid(row=7, column=1, columnspan=1, sticky="w")
+        self.engine_label.grid(row=8, column=0, columnspan=1, sticky="e")
+        self.engine_opts.grid(row=8, column=1, columnspan=1, sticky="w")
+        self.aggregation_label.grid(row=9, column=0, columnspan=1, sticky="e")
+        self.aggregation_opts.grid(row=9, column=1, columnspan=1, sticky="w")
+        self.storage_label.grid(row=10, column=0, columnspan=1, sticky="e")
+        self.storage_opts.grid(row=10, column=1, columnspan=1, sticky="w")
+        self.in_memory_bool.grid(row=11, column=1, columnspan=1, sticky="w")
+        self.crop_bool.grid(row=12, column=1, columnspan=1, sticky="w")
+        self.batch_bool.grid(row=13, column=1, columnspan=1, sticky="w")
+        self.lean_bool.grid(row=14, column=1, columnspan=1, sticky="w")
+        self.debug_dump_bool.grid(row=15, column=1, columnspan=1, sticky="w")
+        self.cache_bool.grid(row=16, column=1, columnspan=1, sticky="w")
+        self.concatenated_bool.grid(row=17, column=1, columnspan=1, sticky="w")
+        self.workers_label.grid(row=18,column=0, columnspan=1, sticky="e")
+        self.workers_form.grid(row=18,column=1, columnspan=1, sticky="w")
+        self.muscle_threads_label.grid(row=19,column=0, columnspan=1, sticky="e")
+        self.muscle_threads_form.grid(row=19,column=1, columnspan=1, sticky="w")
+        self.memory_limit_label.grid(row=20,column=0, columnspan=1, sticky="e")
+        self.memory_limit_form.grid(row=20,column=1, columnspan=1, sticky="w")
+        self.compression_threads_label.grid(row=21,column=0, columnspan=1, sticky="e")
+        self.compression_threads_form.grid(row=21,column=1, columnspan=1, sticky="w")
+        self.gzip_level_label.grid(row=22,column=0, columnspan=1, sticky="e")
+        self.gzip_level_form.grid(row=22,column=1, columnspan=1, sticky="w")
+        self.close_button.grid(row=23,column=1, columnspan=1, sticky="w")
 
         # configure the grid
-        for r in range(8):
+        for r in range(24):
             self.frame.rowconfigure(r, weight=1)
         for c in range(2):
             self.frame.columnconfigure(c, weight=1)
@@ -613,6 +814,39 @@ class guiConfigure(tk.Toplevel):
         """
         # update MEP threshold
         self.local_data['MEP_threshold'] = self.MEP_form.get()
+        # update number of parallel subjects (worker processes)
+        if not self.workers_form.get().isdigit() or int(self.workers_form.get()) < 1:
+            settings_error = True
+            messagebox.showerror('Input Error','Subjects processed in parallel must be a positive integer.')
+        else:
+            self.local_data['workers'] = int(self.workers_form.get())
+        # update number of parallel muscles (threads within a subject)
+        if not self.muscle_threads_form.get().isdigit() or int(self.muscle_threads_form.get()) < 1:
+            settings_error = True
+            messagebox.showerror('Input Error','Muscles processed in parallel must be a positive integer.')
+        else:
+            self.local_data['muscle threads'] = int(self.muscle_threads_form.get())
+        # update memory limit (GB, decimals allowed)
+        try:
+            memory_limit = float(self.memory_limit_form.get())
+        except ValueError:
+            memory_limit = -1
+        if memory_limit < 0:
+            settings_error = True
+            messagebox.showerror('Input Error','Memory limit must be a number of GB (0 for no limit).')
+        else:
+            self.local_data['memory limit'] = memory_limit
+        # update background compression threads and gzip level
+        if not self.compression_threads_form.get().isdigit():
+            settings_error = True
+            messagebox.showerror('Input Error','Compression threads must be 0 or a positive integer.')
+        else:
+            self.local_data['compression threads'] = int(self.compression_threads_form.get())
+        if not self.gzip_level_form.get().isdigit() or not 1 <= int(self.gzip_level_form.get()) <= 9:
+            settings_error = True
+            messagebox.showerror('Input Error','Compression level must be an integer from 1 to 9.')
+        else:
+            self.local_data['gzip level'] = int(self.gzip_level_form.get())
         
         # ['normalize'] is already set each time the button is checked / unchecked
         # ['atlas'] already set, or updated when selected in self.select_atlas()
@@ -687,17 +921,45 @@ class LogHandler(logging.StreamHandler):
 
 class MainAsyncProcessing(Thread):
     
-    def __init__(self, root_data_dict, root_config_dict):
+    def __init__(self, root_data_dict, root_config_dict, dry_run=False):
         super().__init__()
         self.running = False
         
         self.local_data = root_data_dict
         self.local_config = root_config_dict
+        self.dry_run = dry_run
+        
+    def run(self):
+        self.running = True
+        import mos_analysis_main
+        if self.dry_run:
+            mos_analysis_main.dry_run(self.local_data, self.local_config)
+        else:
+            mos_analysis_main.main(self.local_data, self.local_config)
+        self.running = False
+
+class DiscoveryAsyncProcessing(Thread):
+    
+    def __init__(self, root_data_dict, root_config_dict):
+        super().__init__()
+        self.running = False
+        
+        self.local_data = root_data_dict
+        self.config_dict = root_config_dict
+        # [folders, files] searched so far, read by guiSelect.monitor_discovery
+        self.progress = [0, 0]
+        self.error = None
         
     def run(self):
         self.running = True
-        mos_analysis_main.main(self.local_data, self.local_config)
+        try:
+            mos_find_datasets.main(self.local_data, self.config_dict, self.report_progress)
+        except OSError as error:
+            self.error = error
         self.running = False
+    
+    def report_progress(self, folders, files):
+        self.progress = [folders, files]
 
 class GroupAsyncProcessing(Thread):
     
@@ -710,6 +972,7 @@ class GroupAsyncProcessing(Thread):
         
     def run(self):
         self.running = True
+        import mos_analysis_group
         mos_analysis_group.main(self.local_data, self.config_dict)
         self.running = False
 
@@ -745,6 +1008,9 @@ def CenterToWin(window):
     window.wm_deiconify()
 
 def main():
+    
+    # worker processes (parallel subjects) re-launch the frozen app, this hands them straight to multiprocessing
+    multiprocessing.freeze_support()
         
     MOS = MOSAICSapp()
 
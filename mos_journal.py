@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+deSCRIPTion:
+    - run journal: each muscle's metrics row is appended to JOURNAL in the save directory as soon as the muscle's
+      outputs are written, so a run that stops part way keeps everything it finished
+    - a resumed run (configure_dict['resume'] = 1, mos_cli --resume) skips every muscle journaled with the same
+      subject key whose outputs are still there (a subject with all its muscles journaled is skipped outright),
+      and builds mapping_results.xlsx from the journaled and newly computed rows. A run that does not resume
+      starts a new journal
+    - the subject key is a hash of the subject's data list entry, the size / modification time of its T1 and
+      stimulation files, and the settings that change the results (RESULT_SETTINGS), so rows are never reused
+      for different inputs or settings. (The cache, mos_cache, checks output contents, the journal only that
+      they exist: outputs are swapped into place complete, see mos_writer)
+    - one JSON line per muscle, each written with a single append (worker processes share the journal), a line
+      cut short by a crash is ignored
+"""
+
+import os
+import json
+import hashlib
+import logging
+
+parent_logger = logging.getLogger('main')
+
+JOURNAL = 'mosaics_journal.jsonl'
+
+# data_dict / configure_dict entries that change a muscle's outputs or metrics
+RESULT_SETTINGS = ['data folder', 'brainmask check', 'brainmask suffix', 'stim_coords', 'grid spacing', 'dilate',
+                   'smooth', 'MEP_threshold', 'normalize', 'atlas', 'atlas mask', 'backend', 'heatmap_engine',
+                   'site_aggregation', 'storage', 'memory lean']
+
+def journal_file(save_dir_parent, shard_index=0, shard_count=1):
+    # each shard of a sharded run keeps its own journal
+    if shard_count > 1:
+        return os.path.join(save_dir_parent, 'mosaics_journal_shard_'+str(shard_index)+'_of_'+str(shard_count)+'.jsonl')
+    return os.path.join(save_dir_parent, JOURNAL)
+
+def subject_key(subject, settings):
+    description = {'subject': list(subject),
+                   'settings': {key: settings.get(key) for key in RESULT_SETTINGS}}
+    for name, file_input in [['T1', subject[1]], ['stim', subject[2]]]:
+        stat = os.stat(os.path.join(settings['data folder'], file_input))
+        description[name] = [stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+def start(file_journal, resume):
+    # a resumed run keeps the journal, any other run starts a new one. Returns the number of journaled muscles
+    if not resume:
+        if os.path.isfile(file_journal):
+            os.remove(file_journal)
+        return 0
+    # rewritten without any line a crash cut short, so the lines appended next start on a line of their own
+    entries = load(file_journal)
+    with open(file_journal+'.tmp', 'w') as f:
+        for (key, muscle), row in entries.items():
+            f.write(json.dumps({'key': key, 'subject': row[0], 'muscle': muscle, 'row': row})+'\n')
+    os.replace(file_journal+'.tmp', file_journal)
+    parent_logger.info('resuming: '+str(len(entries))+' muscles in the run journal '+file_journal)
+    return len(entries)
+
+def load(file_journal):
+    # (subject key, muscle) -> metrics row of every journaled muscle
+    rows = dict()
+    if not os.path.isfile(file_journal):
+        return rows
+    with open(file_journal) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            rows[(entry['key'], entry['muscle'])] = entry['row']
+    return rows
+
+def record_muscle(file_journal, key, muscle, row):
+    # numpy scalars in row are stored as plain numbers
+    line = json.dumps({'key': key, 'subject': row[0], 'muscle': muscle, 'row': row},
+                      default=lambda value: value.item() if hasattr(value, 'item') else str(value))+'\n'
+    journal_fd = os.open(file_journal, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(journal_fd, line.encode())
+        os.fsync(journal_fd)
+    finally:
+        os.close(journal_fd)
@@ -6,151 +6,261 @@ Created on Fri Feb 26 14:25:09 2021
 @author: Bryce
 
 --- deSCRIPTION ---
+    - parses a stimulation spreadsheet into arrays (stim_arrays): N x 3 voxel coordinates, an N x muscles MEP
+      matrix and an N x muscles responsive mask, with the muscle names in column order
+    - missing coordinates raise ValueError, as do responsive stimulations outside the T1 volume (check_bounds,
+      run by mos_analysis_main once the T1 is loaded)
+    - reads Excel (.xls / .xlsx), CSV, TSV, Parquet (needs pyarrow or fastparquet) and Brainsight's text
+      exports (.txt, other .txt files are read as TSV), picked by extension (STIM_READERS)
+    - Brainsight exports: the sample table's Loc. X / Y / Z columns and one muscle per EMG channel
+      ('EMG Peak-to-peak 1' -> muscle EMG1), converted from microvolts to millivolts; the EMG waveforms are not read
+    - parsed results are cached on disk as NumPy arrays (STIM_CACHE_DIR), keyed by the spreadsheet's path,
+      size and modification time, so each spreadsheet only goes through pandas once
 """
 
+import os
+import hashlib
 import pandas as pd
 import numpy as np
 import logging
 
+from mos_options import BRAINSIGHT_HEADER
+
 parent_logger = logging.getLogger('main')
 
-def main(file_nibs_map):
+STIM_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.mosaics', 'stim_cache')
+# bump if parsing changes, so older cache files are no longer used
+STIM_CACHE_VERSION = 2
 
-    # Load in NIBS data spreadsheet
-    data_nibs_map = pd.read_excel(file_nibs_map)
+# Brainsight text export (first line BRAINSIGHT_HEADER): its sample table, and the EMG columns read from it
+BRAINSIGHT_SAMPLES = '# Sample Name'
+BRAINSIGHT_EMG = 'EMG Peak-to-peak '
 
-    muscles_dict = dict()
-    locs_dict = dict()
+def main(file_nibs_map, use_cache=True):
+    
+    if use_cache:
+        stim_dict = load_cached(file_nibs_map)
+        if stim_dict is not None:
+            return stim_dict
+    
+    stim_dict = parse_stim_data(file_nibs_map)
+    if use_cache and stim_dict is not None:
+        save_cached(file_nibs_map, stim_dict)
     
+    return stim_dict
+
+def parse_stim_data(file_nibs_map):
+
+    # Load in NIBS data spreadsheet
+    data_nibs_map = read_stim_table(file_nibs_map)
+
     # Parse the entered spreadsheet data for the information that we need
-    ## Simply: loop through the column names, if 'MEP' is anywhere in the name,
-    ## that's an MEP and we look for a corresponding responsive column. If not,
-    ## check if this could be one of our location columns, X, Y or Z
-    sort_columns(file_nibs_map, data_nibs_map, locs_dict, muscles_dict)
-
-    # Function below removes NA from all columns of interest (location cols and MEP cols),
-    # then crops each pandas.series column vector to the length of the shortest one.
-    # The intention here is to remove any extra data present at the end of SOME
-    # rows but not others.
+    ## Simply: if 'MEP' is anywhere in a column name, that's an MEP and we look
+    ## for a corresponding responsive column. If not, check if this could be one
+    ## of our location columns, X, Y or Z
+    loc_columns, muscle_columns = classify_columns(file_nibs_map, data_nibs_map)
+
+    # the columns of interest as arrays (one row per stimulation), checked for missing coordinates
+    stim_dict = stim_arrays(file_nibs_map, data_nibs_map, loc_columns, muscle_columns)
+
+    # Output a logging message so we know how many muscles we'll be processing
+    parent_logger.debug('Found data for '+str(len(stim_dict['muscles']))+' muscles to process')
+    parent_logger.debug(''+str(len(stim_dict['coords']))+' stimulation coordinate sets found')
+    return stim_dict
+
+def cache_file(file_nibs_map):
+    # one cache file per spreadsheet path
+    path_hash = hashlib.sha1(os.path.abspath(file_nibs_map).encode()).hexdigest()
+    return os.path.join(STIM_CACHE_DIR, path_hash+'.npz')
+
+def cache_stamp(file_nibs_map):
+    # the cache file is only used while the spreadsheet has the same path, size and modification time
+    stat = os.stat(file_nibs_map)
+    return np.array([STIM_CACHE_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+def load_cached(file_nibs_map):
+    # stim_dict from the cache, or None if there is no up to date cache file
+    file_cache = cache_file(file_nibs_map)
+    if not os.path.isfile(file_cache):
+        return None
+    try:
+        with np.load(file_cache, allow_pickle=False) as cached:
+            if str(cached['source']) != os.path.abspath(file_nibs_map) or \
+               not np.array_equal(cached['stamp'], cache_stamp(file_nibs_map)):
+                return None
+            stim_dict = {key: cached[key] for key in ['coords', 'MEPs', 'responsive', 'responsive built']}
+            stim_dict['muscles'] = [str(muscle) for muscle in cached['muscles']]
+    except (OSError, KeyError, ValueError) as error:
+        parent_logger.debug('stimulation data cache for '+file_nibs_map+' not used: '+repr(error))
+        return None
     
-    # I was having problems with just simply using a dropna() function when there
-    # happened to be empty columns full of NA at the end of the spreadsheet, so
-    # this is my compromise
-    crop_data(locs_dict, muscles_dict)
-
-    #check for errors:   
-    ## do all stims have 3 data points?
-    error_check = 0
-    if len(locs_dict['X']) == len(locs_dict['Y']) == len(locs_dict['Z']):
-        
-        # first error check good, proceed to second error check
-        ## do all MEP columns have a data point for each stim point?
-        for muscle in muscles_dict:
-            if len(muscles_dict[muscle][0]) == len(locs_dict['X']):
-                pass
-            else:
-                parent_logger.error(''+muscle+' MEP column length does not match stimulation coordinate column length')
-                error_check = 1
-    else:
-        parent_logger.error('X, Y, and Z stimulation coordinate columns do not have the same amount of data points')
-        error_check = 1
-        
-    if error_check == 0:
-        # Second error check good, too. Output a logging message so we know how many muscles we'll be processing
-        parent_logger.debug('Found data for '+str(len(muscles_dict))+' muscles to process')
-        parent_logger.debug(''+str(len(locs_dict['X']))+' stimulation coordinate sets found')
-
-        # Pass this list back to the main script?
-        stim_dict = dict()
-        stim_dict['locs'] = locs_dict
-        stim_dict['muscles'] = muscles_dict
-        return stim_dict
-
-def sort_columns(file_nibs_map, data_nibs_map, locs_dict, muscles_dict):
-
-    for column in data_nibs_map.columns:
-        
-        # future way to do this, when I'm looking back and look at the lazy, non-universal solution here:
-            # Just iterate over DataFrame.columns, now this is an example in which you will end up with a list of column names that match:
-            
-            # import pandas as pd
-            
-            # data = {'spike-2': [1,2,3], 'hey spke': [4,5,6], 'spiked-in': [7,8,9], 'no': [10,11,12]}
-            # df = pd.DataFrame(data)
-            
-            # spike_cols = [col for col in df.columns if 'spike' in col]
-            # print(list(df.columns))
-            # print(spike_cols)
-            # Output:
-            
-            # ['hey spke', 'no', 'spike-2', 'spiked-in']
-            # ['spike-2', 'spiked-in']
-        
-        # If this column name has MEP in it, store it and skip the rest
-        if 'MEP' in column:
-            
-            # MUSCLE NAME -- find name of the muscle
-            # first, delete '_MEP' or 'MEP_' from the name
-            if 'MEP_' in column:
-                muscle_name = column.replace('MEP_','')
-            elif '_MEP' in column:
-                muscle_name = column.replace('_MEP','')
+    # (the parser's warnings, again)
+    for muscle in np.array(stim_dict['muscles'], dtype=object)[stim_dict['responsive built']]:
+        parent_logger.warning('no column marking responsive MEP sites for '+file_nibs_map+': '+muscle+', making our own for non-zero MEPs')
+    parent_logger.debug('using cached stimulation data for '+file_nibs_map)
+    return stim_dict
+
+def save_cached(file_nibs_map, stim_dict):
+    arrays = {key: stim_dict[key] for key in ['coords', 'MEPs', 'responsive', 'responsive built']}
+    arrays['source'] = np.array(os.path.abspath(file_nibs_map))
+    arrays['stamp'] = cache_stamp(file_nibs_map)
+    arrays['muscles'] = np.array(stim_dict['muscles'], dtype=str)
+    try:
+        os.makedirs(STIM_CACHE_DIR, exist_ok=True)
+        # written under a temporary name and swapped in, as other subjects / processes may read it at any time
+        file_cache = cache_file(file_nibs_map)
+        file_temp = file_cache+'.'+str(os.getpid())+'.tmp'
+        with open(file_temp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(file_temp, file_cache)
+    except OSError as error:
+        parent_logger.debug('could not cache stimulation data for '+file_nibs_map+': '+repr(error))
+
+def read_stim_table(file_nibs_map):
+    # DataFrame of a stimulation file, read as its extension says
+    extension = os.path.splitext(file_nibs_map)[1].lower()
+    if extension not in STIM_READERS:
+        raise ValueError('unknown stimulation data format: '+file_nibs_map)
+    return STIM_READERS[extension](file_nibs_map)
+
+def read_tsv(file_nibs_map):
+    return pd.read_csv(file_nibs_map, sep='\t')
+
+def read_parquet(file_nibs_map):
+    try:
+        return pd.read_parquet(file_nibs_map)
+    except ImportError:
+        raise ImportError('reading '+file_nibs_map+' needs pyarrow or fastparquet (pip install pyarrow)')
+
+def read_text_export(file_nibs_map):
+    # Brainsight export, or else a tab-separated table
+    with open(file_nibs_map, encoding='utf-8', errors='replace') as f:
+        first_line = f.readline()
+    if first_line.startswith(BRAINSIGHT_HEADER):
+        return read_brainsight(file_nibs_map)
+    return read_tsv(file_nibs_map)
+
+def read_brainsight(file_nibs_map):
+    # the sample table of a Brainsight export (header '# Sample Name ...', up to the next '#' line), as the
+    # X, Y, Z and <channel>_MEP columns of a stimulation spreadsheet
+    
+    # where the table is (a first pass over the lines, without decoding them), then pandas reads just
+    # those rows and columns, the EMG waveforms being most of the file
+    header_line = None
+    n_samples = 0
+    with open(file_nibs_map, 'rb') as f:
+        for count, line in enumerate(f):
+            if header_line is None:
+                if line.startswith(BRAINSIGHT_SAMPLES.encode()):
+                    header_line = count
+            elif line.startswith(b'#'):
+                break
             else:
-                muscle_name = column.replace('MEP','')
-                
-            # MEP COLUMN -- pull the MEP data from the column
-            MEP_column = data_nibs_map[column]
-                
-            # RESPONSIVE COLUMN -- pull or construct (see else: )
-            if muscle_name+'_responsive' in data_nibs_map.columns:
-                # responsive_colname = muscle_name+'_responsive'
-                responsive_column = data_nibs_map[muscle_name+'_responsive']
-            elif 'responsive_'+muscle_name in data_nibs_map.columns:
-                # responsive_colname = 'responsive_'+muscle_name
-                responsive_column = data_nibs_map['responsive_'+muscle_name]
+                n_samples += 1
+    if header_line is None:
+        raise ValueError('no sample table ('+BRAINSIGHT_SAMPLES+') in Brainsight export '+file_nibs_map)
+    
+    with open(file_nibs_map, encoding='utf-8', errors='replace') as f:
+        for count in range(header_line):
+            f.readline()
+        columns = f.readline()[2:].rstrip('\r\n').split('\t')
+        emg_columns = [column for column in columns if column.startswith(BRAINSIGHT_EMG)]
+        data_samples = pd.read_csv(f, sep='\t', header=None, names=columns, nrows=n_samples,
+                                   usecols=['Loc. X', 'Loc. Y', 'Loc. Z']+emg_columns, na_values=['(null)'])
+    # microvolts -> millivolts, as MEPs are given in spreadsheets
+    data_samples[emg_columns] = data_samples[emg_columns] / 1000
+    return data_samples.rename(columns={column: 'EMG'+column[len(BRAINSIGHT_EMG):]+'_MEP' for column in emg_columns})
+
+# extension -> reader (mos_options.STIM_EXTENSIONS are the files mos_find_datasets pairs with T1s)
+STIM_READERS = {'.xls': pd.read_excel,
+                '.xlsx': pd.read_excel,
+                '.csv': pd.read_csv,
+                '.tsv': read_tsv,
+                '.txt': read_text_export,
+                '.parquet': read_parquet}
+
+def classify_columns(file_nibs_map, data_nibs_map):
+    # loc_columns (X, Y, Z -> column, named X or Loc. X etc.) and muscle_columns (muscle -> [MEP column,
+    # responsive column]) of a stimulation table. Column names are classified as one string array; a muscle
+    # without a responsive column gets None, stim_arrays() then marks its non-zero MEPs responsive
+    loc_columns = dict()
+    muscle_columns = dict()
+    columns = list(data_nibs_map.columns)
+    names = pd.Index(columns).astype(str)
+    column_of_name = dict(zip(names, columns))
+    
+    # MUSCLE NAME -- the name of an MEP column without '_MEP' or 'MEP_' (or 'MEP')
+    is_MEP = names.str.contains('MEP', regex=False)
+    muscle_names = np.select([names.str.contains('MEP_', regex=False), names.str.contains('_MEP', regex=False)],
+                             [names.str.replace('MEP_', '', regex=False), names.str.replace('_MEP', '', regex=False)],
+                             names.str.replace('MEP', '', regex=False))
+    # location columns (a column with MEP in its name is never one)
+    loc_names = pd.Series(names).map({'X': 'X', 'Loc. X': 'X', 'Y': 'Y', 'Loc. Y': 'Y', 'Z': 'Z', 'Loc. Z': 'Z'})
+    
+    for count, column in enumerate(columns):
+        if is_MEP[count]:
+            muscle_name = str(muscle_names[count])
+            # RESPONSIVE COLUMN -- pull or construct
+            if muscle_name+'_responsive' in column_of_name:
+                responsive_column = column_of_name[muscle_name+'_responsive']
+            elif 'responsive_'+muscle_name in column_of_name:
+                responsive_column = column_of_name['responsive_'+muscle_name]
             else:
-                # build a column of responsive or not
-                # start with all zeroes
                 parent_logger.warning('no column marking responsive MEP sites for '+file_nibs_map+': '+muscle_name+', making our own for non-zero MEPs')
-                responsive_column = np.zeros(len(MEP_column))
-                # for each stimulated point, if the MEP is not zero, responsiveness column is 1
-                for count, value in enumerate(MEP_column):
-                    if value != 0 and not np.isnan(value):
-                        responsive_column[count] = 1        
-            
+                responsive_column = None
             # order = muscle name, MEP column name, MEP responsive column)
-            muscles_dict[muscle_name] = [MEP_column, responsive_column]
-            continue
-        
-        # Fill the dict for location data with the correct column names
-        # Find X
-        if column=='X' or column=='Loc. X':
-            locs_dict['X'] = data_nibs_map[column]
-        # Find Y
-        if column=='Y' or column=='Loc. Y':
-            locs_dict['Y'] = data_nibs_map[column]
-        # Find Z
-        if column=='Z' or column=='Loc. Z':
-            locs_dict['Z'] = data_nibs_map[column]
-
-def crop_data(locs_dict, muscles_dict):
+            muscle_columns[muscle_name] = [column, responsive_column]
+        elif isinstance(loc_names[count], str):
+            # (a later X / Loc. X column replaces an earlier one)
+            loc_columns[loc_names[count]] = column
     
-    column_lengths = list()
+    return loc_columns, muscle_columns
+
+def stim_arrays(file_nibs_map, data_nibs_map, loc_columns, muscle_columns):
+    # the stimulations as arrays, one row each:
+    #     muscles             muscle names (MEP / responsive column order)
+    #     coords              N x 3 voxel coordinates (int64, truncated as int() would)
+    #     MEPs                N x muscles MEPs (float64, NaN where none was recorded)
+    #     responsive          N x muscles, True where the responsive column is 1 (or, without one, the MEP is
+    #                         non-zero), never where the MEP is missing
+    #     responsive built    per muscle, True if its responsive column was made from its MEPs
+    # Rows after the last one with all three coordinates (extra data at the end of some columns) are dropped.
+    # Raises ValueError for missing coordinate columns, or coordinates missing in between
+    missing_locs = [key for key in ['X', 'Y', 'Z'] if key not in loc_columns]
+    if len(missing_locs) > 0:
+        raise ValueError('no '+', '.join(missing_locs)+' stimulation coordinate column in '+file_nibs_map)
+    muscles = list(muscle_columns)
+    locs = data_nibs_map[[loc_columns[key] for key in ['X', 'Y', 'Z']]].to_numpy(dtype=np.float64)
+    MEPs = data_nibs_map[[muscle_columns[muscle][0] for muscle in muscles]].to_numpy(dtype=np.float64)
     
-    for key in locs_dict:
-        locs_dict[key] = locs_dict[key].dropna()
-        column_lengths.append(len(locs_dict[key]))    
-    for key in muscles_dict:
-        muscles_dict[key][0] = muscles_dict[key][0].dropna()
-        column_lengths.append(len(muscles_dict[key][0]))
-        
-    crop = min(column_lengths)
+    # crop to the last stimulation with coordinates, then every row in between must have them
+    located = ~np.isnan(locs).any(axis=1)
+    n_stims = np.flatnonzero(located)[-1] + 1 if located.any() else 0
+    unlocated = np.flatnonzero(~located[:n_stims])
+    if len(unlocated) > 0:
+        raise ValueError('stimulations '+', '.join(str(row + 1) for row in unlocated[:10])+
+                         (' ...' if len(unlocated) > 10 else '')+' of '+file_nibs_map+' are missing X, Y or Z coordinates')
+    MEPs = MEPs[:n_stims].reshape(n_stims, len(muscles))
     
-    for key in locs_dict:
-        locs_dict[key] = locs_dict[key][0:crop]
-    for key in muscles_dict:
-        muscles_dict[key][0] = muscles_dict[key][0][0:crop]
-        muscles_dict[key][1] = muscles_dict[key][1][0:crop]
+    built = np.array([muscle_columns[muscle][1] is None for muscle in muscles], dtype=bool)
+    responsive = MEPs != 0
+    for muscle_index in np.flatnonzero(~built):
+        responsive[:, muscle_index] = data_nibs_map[muscle_columns[muscles[muscle_index]][1]].to_numpy()[:n_stims] == 1
+    responsive &= ~np.isnan(MEPs)
     
+    return {'muscles': muscles, 'coords': locs[:n_stims].astype(np.int64), 'MEPs': MEPs,
+            'responsive': responsive, 'responsive built': built}
+
+def check_bounds(stim_dict, shape, file_nibs_map):
+    # raises ValueError if a responsive stimulation lies outside a volume of this shape (e.g. coordinates
+    # in another space than the T1's voxels, see the stim_coords setting)
+    coords = stim_dict['coords']
+    outside = ((coords < 0) | (coords >= np.array(shape[:3]))).any(axis=1) & stim_dict['responsive'].any(axis=1)
+    if outside.any():
+        rows = np.flatnonzero(outside)
+        raise ValueError(str(len(rows))+' responsive stimulations of '+file_nibs_map+' lie outside the T1 volume '+
+                         str(tuple(shape[:3]))+' (stimulations '+', '.join(str(row + 1) for row in rows[:10])+
+                         (' ...' if len(rows) > 10 else '')+')')
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+deSCRIPTion:
+    - in-process (NumPy / SciPy) replacements for the fslmaths operators used by MOSAICS
+    - each function mirrors one FSL call made through nipype, so results match the FSL backend:
+        dilate_max_sphere() = fsl.DilateImage(operation='max', kernel_shape='sphere')  (fslmaths -kernel sphere -dilF)
+        apply_mask()        = fsl.ApplyMask()                                          (fslmaths -mas)
+        merge()             = fsl.Merge(dimension='t')                                 (fslmerge -t)
+        mean_image()        = fsl.MeanImage(dimension='T')                             (fslmaths -Tmean)
+    - BACKENDS lists the values accepted by configure_dict['backend']
+"""
+
+import logging
+import numpy as np
+from scipy import ndimage as ndi
+
+from mos_options import BACKENDS
+
+parent_logger = logging.getLogger('main')
+
+def use_native(config_dict):
+    # configure_dict['backend'] is a tk.StringVar set from the configure dialogue,
+    # older dicts without the key fall back to the native backend
+    backend = config_dict.get('backend', 'native')
+    if hasattr(backend, 'get'):
+        backend = backend.get()
+    return str(backend) != 'FSL'
+
+def sphere_kernel(radius, voxel_size=(1.0, 1.0, 1.0)):
+    # Same construction as FSL's spherical_kernel(): the box is round(radius/voxel dim)*2+1 voxels wide
+    # in each dimension, and a voxel is included if its centre is within radius (mm) of the box centre
+    half_widths = [int(np.floor(radius / dim + 0.5)) for dim in voxel_size[:3]]
+    grids = np.ogrid[tuple(slice(-half, half + 1) for half in half_widths)]
+    distance_sq = sum((grid * dim) ** 2 for grid, dim in zip(grids, voxel_size[:3]))
+
+    return distance_sq <= radius ** 2
+
+def dilate_max_sphere(map_in, radius, voxel_size=(1.0, 1.0, 1.0), output=None):
+    # fslmaths -dilF: maximum of all in-bounds voxels under the kernel.
+    # mode='nearest' only repeats edge voxels that are already inside the (convex) sphere, so
+    # it is identical to ignoring out-of-bounds voxels and never introduces a new maximum.
+    # 4D input = maps stacked along a leading (muscle) axis, each dilated separately.
+    # output = data type of the result (default: the input's), a maximum is exact in any float type
+    footprint = sphere_kernel(radius, voxel_size)
+    if np.ndim(map_in) == 4:
+        footprint = footprint[np.newaxis]
+
+    return ndi.grey_dilation(map_in, footprint=footprint, output=output, mode='nearest')
+
+def apply_mask(map_in, map_mask, in_place=False):
+    # fslmaths -mas: voxels where the mask is not > 0 are set to zero.
+    # in_place zeroes them in map_in itself (an array), instead of returning a new map
+    if in_place:
+        map_in[~(np.asarray(map_mask) > 0)] = 0
+        return map_in
+    return np.where(np.asarray(map_mask) > 0, map_in, 0).astype(np.asarray(map_in).dtype, copy=False)
+
+def merge(maps_in):
+    # fslmerge -t: stack 3D maps along a 4th (time) dimension, 4D inputs are concatenated
+    maps_in = [np.asarray(m) for m in maps_in]
+    maps_in = [m if m.ndim == 4 else m[..., np.newaxis] for m in maps_in]
+
+    return np.concatenate(maps_in, axis=3)
+
+def mean_image(map_4d):
+    # fslmaths -Tmean: mean across the 4th (time) dimension
+    return np.mean(map_4d, axis=3)
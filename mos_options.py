@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+deSCRIPTion:
+    - values of the drop-down options in the configure / select windows, kept free of heavy imports (numpy, scipy,
+      nibabel, nipype, pandas) so the GUI can build its dicts without loading the analysis modules
+    - mos_operators.BACKENDS and mos_storage.STORAGE_LIST are these same lists
+"""
+
+# configure_dict['backend']: image operators in numpy / scipy, or fslmaths through nipype
+BACKENDS = ['native', 'FSL']
+
+# configure_dict['heatmap_engine']: Gaussian filter of the responses volume, or a blurred sphere per stimulation
+HEATMAP_ENGINES = ["Gaussian filter", "Kernel splatting"]
+
+# configure_dict['storage']: data types of the saved maps (mos_storage)
+STORAGE_LIST = ['Full precision (float64)', 'Compact (float32 / uint8 / int16)']
+
+# data_dict['stim_coords']: coordinate system of the stimulation spreadsheet
+STIM_COORDS = ["Brainsight", "Nifti"]
+
+# stimulation data files mos_find_datasets pairs with T1 images (read by mos_load_data_multi_muscle.STIM_READERS)
+STIM_EXTENSIONS = ['.xls', '.xlsx', '.csv', '.tsv', '.txt', '.parquet']
+
+# first line of a Brainsight text export (the only .txt stimulation files that are not plain tables)
+BRAINSIGHT_HEADER = '# Version'
+
+# BIDS tabular sidecars, never stimulation data (participants.tsv, sub-01_ses-1_scans.tsv, ...)
+# (matched as the whole name or after an underscore)
+BIDS_SIDECARS = ['participants.tsv', 'sessions.tsv', 'scans.tsv', 'events.tsv', 'channels.tsv', 'electrodes.tsv']
+
+# configure_dict['site_aggregation']: how repeated stimulations of one site are reduced to the value mapped (mos_sites)
+SITE_AGGREGATIONS = ['Last stimulation', 'Mean MEP', 'Median MEP', 'Max MEP', 'Proportion responsive']
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+deSCRIPTion:
+    - work queue mode: the data list becomes a queue of subjects in the shared save directory (QUEUE_DIR), and any
+      number of workers, on any machines that see the directory, claim subjects one at a time until none are left.
+      Workers can be started (or stopped) mid-run; cheap (cached) subjects no longer hold a node idle as fixed
+      shards do
+    - built from lock files rather than SQLite, whose locking is unreliable on network filesystems (NFS):
+        queue.json          the data list and the settings that change the results (mos_journal.RESULT_SETTINGS),
+                            written by the first worker; workers on another data list or settings refuse to run
+        <index>.claim       created with O_EXCL by the worker processing the subject (host, pid, time), its mtime
+                            refreshed every HEARTBEAT_SECONDS while the subject runs
+        <index>.done        the subject's result rows, written (atomically) once its outputs are all written
+        <index>.failed      the number of failed attempts at the subject so far
+    - a claim not refreshed for STALE_SECONDS (its worker died) is released by renaming it away (atomic, so only
+      one worker takes it over) and the subject is claimed again. Claim ages use the file server's mtimes against
+      this machine's clock, so STALE_SECONDS is kept well above any clock difference between nodes
+    - a subject that fails (an error, or outputs that could not be written) is released for another attempt, by
+      any worker, no sooner than RETRY_SECONDS later, so a transient error (network filesystem, node out of memory)
+      does not lose it. After MAX_ATTEMPTS failures it is marked done as incomplete (and left out of the results),
+      as in a normal run
+    - workers wait until every subject is done, then write mapping_results.xlsx in data list order (and run the
+      group analysis, if asked) one at a time, under merge.lock (merge_lock). The lock is refreshed and released as
+      stale as claims are, so a merger that was killed does not block later runs; a worker that finds another one
+      merging waits for it, then merges again itself (cheap, the group analysis only updates what changed), so its
+      result is always its own
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from logging.handlers import QueueListener
+
+import mos_analysis_main
+import mos_analysis_group
+import mos_writer
+import mos_journal
+
+parent_logger = logging.getLogger('main')
+
+QUEUE_DIR = 'mosaics_queue'
+HEARTBEAT_SECONDS = 30
+STALE_SECONDS = 600
+# how often an idle worker looks for released / stale subjects
+POLL_SECONDS = 15
+# attempts at a failing subject before it is given up, and the wait before a failed subject is tried again
+MAX_ATTEMPTS = 3
+RETRY_SECONDS = 60
+
+def job_file(queue_dir, index, kind):
+    # kind = 'claim', 'done' or 'failed'
+    return os.path.join(queue_dir, str(index)+'.'+kind)
+
+def open_queue(save_dir_parent, data_list, settings):
+    # the queue directory of this save directory, created with data_list and the settings that change the
+    # results (mos_journal.RESULT_SETTINGS) by the first worker. Raises ValueError if the queue holds a different
+    # data list or settings, so workers never mix rows of different settings, and a rerun with new settings
+    # does not merge the old queue's rows
+    queue_dir = os.path.join(save_dir_parent, QUEUE_DIR)
+    os.makedirs(queue_dir, exist_ok=True)
+    file_queue = os.path.join(queue_dir, 'queue.json')
+    queue = json.loads(json.dumps({'data list': data_list,
+                                   'settings': {key: settings.get(key) for key in mos_journal.RESULT_SETTINGS}},
+                                  default=str))
+
+    if not os.path.isfile(file_queue):
+        # link a complete temporary file into place: fails (harmlessly) if another worker got there first
+        file_temp = file_queue+'.'+uuid.uuid4().hex
+        with open(file_temp, 'w') as f:
+            json.dump(queue, f)
+        try:
+            os.link(file_temp, file_queue)
+        except FileExistsError:
+            pass
+        os.remove(file_temp)
+
+    with open(file_queue) as f:
+        queue_saved = json.load(f)
+    if queue_saved['data list'] != queue['data list']:
+        raise ValueError(queue_dir+' holds the queue of a different data list, remove it to start a new queue')
+    queue_settings = queue_saved.get('settings', dict())
+    changed = [key for key in mos_journal.RESULT_SETTINGS if queue_settings.get(key) != queue['settings'][key]]
+    if len(changed) > 0:
+        raise ValueError(queue_dir+' holds the queue of a run with other settings ('+', '.join(changed)+
+                         '), remove it to start a new queue')
+    return queue_dir
+
+def claim(queue_dir, index):
+    # True if this worker now holds the subject
+    try:
+        claim_fd = os.open(job_file(queue_dir, index, 'claim'), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.write(claim_fd, (socket.gethostname()+' '+str(os.getpid())+' '+time.strftime('%Y-%m-%d %H:%M:%S')).encode())
+    os.close(claim_fd)
+    return True
+
+def release_stale(queue_dir, index):
+    # release the claim if its worker stopped refreshing it, True if this worker released it
+    return release_stale_file(job_file(queue_dir, index, 'claim'), 'claim on subject '+str(index))
+
+def release_stale_file(file_claim, description):
+    # release_stale() for any claim or lock file (description for the log)
+    try:
+        claim_age = time.time() - os.stat(file_claim).st_mtime
+        if claim_age < STALE_SECONDS:
+            return False
+        with open(file_claim) as f:
+            claim_owner = f.read().strip()
+        # (the rename only succeeds for one worker, the renamed claim is then this worker's to delete)
+        file_released = file_claim+'.stale.'+uuid.uuid4().hex
+        os.rename(file_claim, file_released)
+        os.remove(file_released)
+    except FileNotFoundError:
+        # finished, or released by another worker, in the meantime
+        return False
+    parent_logger.warning(description+' ('+claim_owner+') not refreshed for '+
+                          str(int(claim_age))+' s, releasing it')
+    return True
+
+def heartbeat(file_claim, stop_heartbeat):
+    # refresh the claim's mtime until stop_heartbeat is set (runs in a thread while the subject is processed)
+    while not stop_heartbeat.wait(HEARTBEAT_SECONDS):
+        try:
+            os.utime(file_claim)
+        except FileNotFoundError:
+            parent_logger.warning(file_claim+' was released as stale while this worker still held it, '
+                                  'its work may be done twice')
+            return
+
+@contextmanager
+def merge_lock(file_lock, owner):
+    # hold file_lock for the with block: created with O_EXCL (owner, host, pid, time), refreshed every
+    # HEARTBEAT_SECONDS, removed afterwards. Waits while another process holds it; a lock not refreshed for
+    # STALE_SECONDS (its process was killed) is released, as a stale claim is
+    waiting = False
+    while True:
+        try:
+            lock_fd = os.open(file_lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if release_stale_file(file_lock, 'merge lock '+file_lock):
+                continue
+            if not waiting:
+                parent_logger.info('another process is merging the results ('+file_lock+'), waiting for it')
+                waiting = True
+            time.sleep(POLL_SECONDS)
+    os.write(lock_fd, (owner+' '+socket.gethostname()+' '+str(os.getpid())+' '+
+                       time.strftime('%Y-%m-%d %H:%M:%S')).encode())
+    os.close(lock_fd)
+
+    stop_heartbeat = threading.Event()
+    heartbeat_thread = threading.Thread(target=heartbeat, args=(file_lock, stop_heartbeat), daemon=True)
+    heartbeat_thread.start()
+    try:
+        yield
+    finally:
+        stop_heartbeat.set()
+        heartbeat_thread.join()
+        try:
+            os.remove(file_lock)
+        except FileNotFoundError:
+            pass
+
+def finish(queue_dir, index, results_metrics_list, subject_complete):
+    # mark the subject done with its rows, then drop the claim
+    file_done = job_file(queue_dir, index, 'done')
+    with open(file_done+'.tmp', 'w') as f:
+        json.dump({'complete': subject_complete, 'rows': results_metrics_list}, f,
+                  default=lambda value: value.item() if hasattr(value, 'item') else str(value))
+    os.replace(file_done+'.tmp', file_done)
+    try:
+        os.remove(job_file(queue_dir, index, 'claim'))
+    except FileNotFoundError:
+        pass
+
+def failed_attempts(queue_dir, index):
+    # [failed attempts at the subject so far, seconds since the last one]
+    file_failed = job_file(queue_dir, index, 'failed')
+    try:
+        with open(file_failed) as f:
+            attempts = json.load(f)['attempts']
+        return [attempts, time.time() - os.stat(file_failed).st_mtime]
+    except FileNotFoundError:
+        return [0, None]
+
+def release_failed(queue_dir, index, attempts):
+    # record the failed attempt, then drop the claim so the subject can be claimed again
+    file_failed = job_file(queue_dir, index, 'failed')
+    with open(file_failed+'.tmp', 'w') as f:
+        json.dump({'attempts': attempts, 'host': socket.gethostname(), 'pid': os.getpid()}, f)
+    os.replace(file_failed+'.tmp', file_failed)
+    try:
+        os.remove(job_file(queue_dir, index, 'claim'))
+    except FileNotFoundError:
+        pass
+
+def work(queue_dir, data_list, settings):
+    # claim and process subjects (lowest data list index first) until every subject is done.
+    # Returns the number of subjects this worker processed
+    processed = 0
+    # (a memory limit here only caps each subject's muscle threads, see mos_analysis_main.memory_plan)
+    memory_limit = float(settings.get('memory limit', 0)) * 1024**3
+    while True:
+        open_subjects = False
+        claimed = False
+        for index, subject in enumerate(data_list):
+            if os.path.isfile(job_file(queue_dir, index, 'done')):
+                continue
+            open_subjects = True
+            attempts, failed_age = failed_attempts(queue_dir, index)
+            if failed_age is not None and failed_age < RETRY_SECONDS:
+                continue
+            if not claim(queue_dir, index) and not (release_stale(queue_dir, index) and claim(queue_dir, index)):
+                continue
+            claimed = True
+            # (re-read now the claim is held: another worker may have failed it since)
+            attempts = failed_attempts(queue_dir, index)[0]
+
+            parent_logger.info('claimed '+subject[0]+' ('+str(index + 1)+' of '+str(len(data_list))+')'+
+                               (', attempt '+str(attempts + 1)+' of '+str(MAX_ATTEMPTS) if attempts > 0 else ''))
+            stop_heartbeat = threading.Event()
+            heartbeat_thread = threading.Thread(target=heartbeat, daemon=True,
+                                                args=(job_file(queue_dir, index, 'claim'), stop_heartbeat))
+            heartbeat_thread.start()
+            try:
+                subject_memory, subject_settings = mos_analysis_main.memory_plan(subject, settings, memory_limit)
+                results_metrics_list = mos_analysis_main.process_subject(subject, subject_settings)
+                # done only once the outputs are on disk
+                subject_complete = mos_writer.drain()
+            except Exception:
+                parent_logger.exception('processing '+subject[0]+' failed')
+                results_metrics_list = list()
+                subject_complete = False
+            finally:
+                stop_heartbeat.set()
+                heartbeat_thread.join()
+
+            if subject_complete:
+                finish(queue_dir, index, results_metrics_list, subject_complete)
+            elif attempts + 1 < MAX_ATTEMPTS:
+                parent_logger.warning(subject[0]+' failed (attempt '+str(attempts + 1)+' of '+str(MAX_ATTEMPTS)+
+                                      '), releasing it to be tried again in '+str(RETRY_SECONDS)+' s')
+                release_failed(queue_dir, index, attempts + 1)
+            else:
+                parent_logger.error(subject[0]+' failed '+str(MAX_ATTEMPTS)+' times, giving up on it')
+                finish(queue_dir, index, results_metrics_list, subject_complete)
+            processed += 1
+            break
+
+        if not open_subjects:
+            return processed
+        if not claimed:
+            # everything left is held by other workers: wait for them to finish (or go stale)
+            time.sleep(POLL_SECONDS)
+
+def merge_queue(queue_dir, data_list, save_dir_parent):
+    # mapping_results.xlsx from the done files, in data list order. True if every subject completed
+    results_metrics_list = list()
+    queue_complete = True
+    for index in range(len(data_list)):
+        with open(job_file(queue_dir, index, 'done')) as f:
+            subject_done = json.load(f)
+        results_metrics_list.extend(subject_done['rows'])
+        queue_complete = queue_complete and subject_done['complete']
+    mos_analysis_main.save_results(results_metrics_list, save_dir_parent)
+    parent_logger.info('all '+str(len(data_list))+' subjects done, results saved to '+
+                       os.path.join(save_dir_parent,'mapping_results.xlsx'))
+    return queue_complete
+
+def main(data_dict, config_dict, run_group=False):
+    # one queue worker (settings['workers'] local worker processes). Returns True if every subject completed
+    # and this worker's merge (and group analysis) completed
+    settings = mos_analysis_main.analysis_settings(data_dict, config_dict)
+    save_dir_parent = str(settings['save_dir'])
+    data_list = settings['data list']
+    queue_dir = open_queue(save_dir_parent, data_list, settings)
+    workers = max(int(settings.get('workers', 1)), 1)
+    parent_logger.info('work queue '+queue_dir+': '+str(len(data_list))+' subjects, '+str(workers)+' local workers')
+
+    if workers == 1:
+        work(queue_dir, data_list, settings)
+    else:
+        # worker processes log through a queue, re-emitted here by the 'main' logger (as in mos_analysis_main)
+        mp_context = multiprocessing.get_context('spawn')
+        log_queue = mp_context.Queue()
+        log_listener = QueueListener(log_queue, mos_analysis_main.ParentLogForwarder())
+        log_listener.start()
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=mos_analysis_main.init_worker,
+                                     initargs=(log_queue, parent_logger.getEffectiveLevel())) as executor:
+                for future in [executor.submit(work, queue_dir, data_list, settings) for worker in range(workers)]:
+                    future.result()
+        finally:
+            log_listener.stop()
+
+    # ~~~~~~MERGE, one worker at a time~~~~~~
+    with merge_lock(os.path.join(queue_dir, 'merge.lock'), 'queue worker'):
+        queue_complete = merge_queue(queue_dir, data_list, save_dir_parent)
+        if run_group:
+            queue_complete = mos_analysis_group.main(data_dict, config_dict) and queue_complete
+    return queue_complete
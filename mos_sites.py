@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+deSCRIPTion:
+    - stimulation site aggregation: rows of a stimulation spreadsheet at the same X / Y / Z (repeated trials at
+      one site) are grouped with np.unique, and each site's trials reduced to one value per muscle, which the
+      maps are made of. Set by configure_dict['site_aggregation'] (one of SITE_AGGREGATIONS):
+        Last stimulation        MEP of the site's last responsive trial (what MOSAICS has always mapped)
+        Mean / Median / Max MEP over all of the site's trials with an MEP, responsive or not
+        Proportion responsive   responsive trials / trials with an MEP
+    - a site is mapped for a muscle if any of its trials was responsive for it
+    - every reduction is reported per site in <tag>_sites.csv, next to the maps (coordinates as in the
+      spreadsheet, i.e. before the Brainsight AP flip)
+"""
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+import mos_writer
+from mos_options import SITE_AGGREGATIONS
+
+parent_logger = logging.getLogger('main')
+
+def aggregate_sites(stim_dict, site_aggregation):
+    # site_dict: a stim_dict (muscles, coords, MEPs, responsive) with one row per site, MEPs holding the
+    # site_aggregation values, plus each site's trials, responsive trials, mean, median and max MEP per muscle
+    # (NaN where a site has no MEP for a muscle)
+    coords, site_index = np.unique(stim_dict['coords'], axis=0, return_inverse=True)
+    site_index = site_index.reshape(-1)
+    MEPs = stim_dict['MEPs']
+    recorded = ~np.isnan(MEPs)
+    n_muscles = MEPs.shape[1]
+
+    # trials sorted by site, each site's trials starting at starts (grouped reductions by np.*.reduceat)
+    order = np.argsort(site_index, kind='stable')
+    starts = np.flatnonzero(np.diff(site_index[order], prepend=-1))
+    trials = np.add.reduceat(recorded[order].astype(np.int64), starts, axis=0)
+    responsive_trials = np.add.reduceat(stim_dict['responsive'][order].astype(np.int64), starts, axis=0)
+
+    sums = np.add.reduceat(np.where(recorded, MEPs, 0)[order], starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(trials > 0, sums / trials, np.nan)
+        proportion = np.where(trials > 0, responsive_trials / trials, np.nan)
+    # (fmax skips NaN, a site without MEPs stays NaN)
+    maximum = np.fmax.reduceat(MEPs[order], starts, axis=0)
+
+    # median: each site's MEPs in order (missing ones last), the middle one or two of its trials
+    median = np.full(trials.shape, np.nan)
+    for muscle_index in range(n_muscles):
+        site_sorted = np.lexsort((MEPs[:, muscle_index], site_index))
+        sorted_MEPs = MEPs[site_sorted, muscle_index]
+        has_trials = trials[:, muscle_index] > 0
+        lower = (starts + (trials[:, muscle_index] - 1) // 2)[has_trials]
+        upper = (starts + trials[:, muscle_index] // 2)[has_trials]
+        median[has_trials, muscle_index] = (sorted_MEPs[lower] + sorted_MEPs[upper]) / 2
+
+    # last responsive trial of each site (row -1 if none)
+    rows = np.where(stim_dict['responsive'], np.arange(len(MEPs))[:, None], -1)
+    last_rows = np.maximum.reduceat(rows[order], starts, axis=0)
+    last = np.where(last_rows >= 0, MEPs[last_rows, np.arange(n_muscles)], np.nan)
+
+    site_values = {SITE_AGGREGATIONS[0]: last, SITE_AGGREGATIONS[1]: mean, SITE_AGGREGATIONS[2]: median,
+                   SITE_AGGREGATIONS[3]: maximum, SITE_AGGREGATIONS[4]: proportion}
+    if site_aggregation not in site_values:
+        raise ValueError('unknown site aggregation: '+str(site_aggregation))
+
+    repeated = np.count_nonzero(np.diff(np.append(starts, len(site_index))) > 1)
+    if repeated > 0:
+        parent_logger.info(str(len(site_index))+' stimulations at '+str(len(coords))+' sites ('+str(repeated)+
+                           ' stimulated more than once), mapping the '+site_aggregation.lower()+' of each site')
+
+    return {'muscles': stim_dict['muscles'], 'coords': coords, 'MEPs': site_values[site_aggregation],
+            'responsive': responsive_trials > 0, 'trials': trials, 'responsive trials': responsive_trials,
+            'mean': mean, 'median': median, 'max': maximum, 'proportion': proportion}
+
+def save_site_table(site_dict, file_sites):
+    # one row per site: X, Y, Z, then per muscle its trials, responsive trials and reductions, and the value
+    # its maps were made of (<muscle>_map, 0 for a site not mapped)
+    columns = {'X': site_dict['coords'][:, 0], 'Y': site_dict['coords'][:, 1], 'Z': site_dict['coords'][:, 2]}
+    for muscle_index, muscle in enumerate(site_dict['muscles']):
+        for key, column in [['trials', 'trials'], ['responsive trials', 'responsive_trials'],
+                            ['proportion', 'proportion_responsive'], ['mean', 'mean'], ['median', 'median'],
+                            ['max', 'max']]:
+            columns[muscle+'_'+column] = site_dict[key][:, muscle_index]
+        columns[muscle+'_map'] = np.where(site_dict['responsive'][:, muscle_index],
+                                          site_dict['MEPs'][:, muscle_index], 0)
+
+    # written under a temporary name and swapped in, as the maps are (mos_writer)
+    file_temp = mos_writer.temporary_file(file_sites)
+    pd.DataFrame(columns).to_csv(file_temp, index=False)
+    os.replace(file_temp, file_sites)
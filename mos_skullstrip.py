@@ -14,21 +14,29 @@ deSCRIPTion:
 import os
 import logging
 from nipype.interfaces import fsl
+
+import mos_writer
+
 parent_logger = logging.getLogger('main')
 
-def main(tag, file_t1, data_folder, save_dir):
+def main(tag, file_t1, data_folder, save_dir, rerun=False):
+    # rerun = BET output in save_dir is out of date (see mos_cache), strip the T1 again even though it exists
     
     bet_output =  os.path.join(save_dir,tag+'_brain.nii.gz')
     bet_doublecheck = os.path.join(data_folder,tag+'_brain.nii.gz')
-    if not os.path.isfile(bet_output):
+    if not os.path.isfile(bet_output) or rerun:
         if not os.path.isfile(bet_doublecheck):
             bet = fsl.BET()
             bet.inputs.in_file = file_t1
             bet.inputs.frac = 0.5 #default for bet, set here for consistency
             bet.inputs.mask = True
-            bet.inputs.out_file = bet_output
+            # written under temporary names and moved into place (mask first, as the stripped T1 marks BET done),
+            # so a BET cut short is redone rather than taken as finished
+            bet.inputs.out_file = mos_writer.temporary_file(bet_output)
             t1_stripped = bet.run()
             brainmask = os.path.join(save_dir,tag+'_brain_mask.nii.gz')
+            os.replace(os.path.join(save_dir,tag+'_brain_tmp_mask.nii.gz'), brainmask)
+            os.replace(mos_writer.temporary_file(bet_output), bet_output)
         else:
             parent_logger.info(''+tag+'_brain_mask.nii.gz found in the data folder, we''ll use that.')
             brainmask = bet_doublecheck            
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+deSCRIPTion:
+    - sparse 'kernel splatting' heatmap engine, an alternative to ndi.gaussian_filter(map_responses, ...)
+    - the dilated responses map is zero except for a sphere around each stimulation, so its Gaussian blur is
+      the sum of one pre-blurred sphere per stimulation, scaled by the MEP. Cost scales with the number of
+      stimulations rather than the image size.
+    - voxels where the dilated map is not simply the sum of spheres (overlapping spheres, spheres cut off by
+      the edge of the image, repeated coordinates) are corrected voxel by voxel, so the result matches
+      ndi.gaussian_filter(map_responses, stdev_gaussian, 0, mode='reflect') to floating point precision
+    - the spheres are blurred on a canvas covering only the bounding box of the stimulations' kernels, and the
+      reflect boundary is only folded back along the edges of the image that box crosses
+    - python mos_splat.py checks the engine against ndi.gaussian_filter (self_check)
+"""
+
+import logging
+import numpy as np
+from scipy import ndimage as ndi
+
+import mos_operators
+
+parent_logger = logging.getLogger('main')
+
+def gaussian_kernel_radius(stdev_gaussian, truncate=4.0):
+    # same radius as scipy's gaussian_filter (which skips the filter entirely for a zero s.d.)
+    if stdev_gaussian <= 1e-15:
+        return 0
+    return int(truncate * stdev_gaussian + 0.5)
+
+def gaussian_kernel(stdev_gaussian, truncate=4.0):
+    # 3D (separable) Gaussian kernel with the weights scipy's gaussian_filter uses
+    radius = gaussian_kernel_radius(stdev_gaussian, truncate)
+    if radius == 0:
+        return np.ones((1, 1, 1))
+    x = np.arange(-radius, radius + 1)
+    kernel_1d = np.exp(-0.5 / stdev_gaussian ** 2 * x ** 2)
+    kernel_1d = kernel_1d / kernel_1d.sum()
+
+    return kernel_1d[:, None, None] * kernel_1d[None, :, None] * kernel_1d[None, None, :]
+
+def splat_heatmap(map_responses, stim_coords, stim_MEPs, dilate, stdev_gaussian, voxel_size, truncate=4.0):
+    # map_responses: dilated responses map (used only to correct overlapping / clipped spheres)
+    # stim_coords: N x 3 integer voxel coordinates of the responsive stimulations in map_responses
+    # stim_MEPs: N MEP values, as scattered into the samples map before dilation
+    shape = map_responses.shape
+    radius = gaussian_kernel_radius(stdev_gaussian, truncate)
+    sphere = mos_operators.sphere_kernel(dilate, voxel_size)
+    half = np.array([(width - 1) // 2 for width in sphere.shape])
+
+    # reflect boundaries are folded back once, the filter is used directly if the kernel is larger than the image
+    if any(dim < radius for dim in shape):
+        return ndi.gaussian_filter(map_responses, stdev_gaussian, 0, mode='reflect', truncate=truncate)
+
+    stim_coords = np.asarray(stim_coords, dtype=int).reshape(-1, 3)
+    stim_MEPs = np.asarray(stim_MEPs, dtype=float).reshape(-1)
+    map_heatmap = np.zeros(shape)
+    if len(stim_coords) == 0:
+        return map_heatmap
+
+    # ~~~~~~PRE-BLURRED SPHERE (one per stimulation)~~~~~~
+    site_kernel = np.pad(sphere.astype(float), radius)
+    if radius > 0:
+        site_kernel = ndi.gaussian_filter(site_kernel, stdev_gaussian, 0, mode='constant', truncate=truncate)
+    voxel_kernel = gaussian_kernel(stdev_gaussian, truncate)
+
+    # canvas = unbounded blur over the bounding box of the stimulations' kernels (image coordinates
+    # box_start to box_stop, reaching past the edge of the image where a kernel does)
+    box_start = stim_coords.min(axis=0) - half - radius
+    box_stop = stim_coords.max(axis=0) + half + radius + 1
+    canvas = np.zeros(tuple(box_stop - box_start))
+
+    for coord, MEP in zip(stim_coords, stim_MEPs):
+        # site_kernel is centred on the stimulation
+        window = tuple(slice(start, start + width) for start, width in zip(coord - half - radius - box_start,
+                                                                          site_kernel.shape))
+        canvas[window] += MEP * site_kernel
+
+    # ~~~~~~CORRECT VOXELS WHERE THE DILATED MAP IS NOT THE SUM OF SPHERES~~~~~~
+    sphere_offsets = np.argwhere(sphere) - half
+    sphere_voxels = (stim_coords[:, None, :] + sphere_offsets[None, :, :]).reshape(-1, 3)
+    stamped = np.repeat(stim_MEPs, len(sphere_offsets))
+
+    # sum of the spheres stamped on each voxel, vs. the actual dilated value (zero outside the image)
+    voxel_keys = np.ravel_multi_index(tuple((sphere_voxels - box_start).T), canvas.shape)
+    unique_keys, voxel_inverse = np.unique(voxel_keys, return_inverse=True)
+    voxel_inverse = voxel_inverse.reshape(-1)
+    stamped_sum = np.bincount(voxel_inverse, weights=stamped)
+    actual = np.zeros(len(unique_keys))
+    inside = np.all((sphere_voxels >= 0) & (sphere_voxels < np.array(shape)), axis=1)
+    actual[voxel_inverse[inside]] = map_responses[tuple(sphere_voxels[inside].T)]
+
+    residual = actual - stamped_sum
+    for key in np.flatnonzero(residual):
+        # voxel_kernel is centred on the voxel
+        start = np.array(np.unravel_index(unique_keys[key], canvas.shape)) - radius
+        window = tuple(slice(begin, begin + width) for begin, width in zip(start, voxel_kernel.shape))
+        canvas[window] += residual[key] * voxel_kernel
+
+    # ~~~~~~FOLD THE CANVAS BACK INTO THE IMAGE (mode='reflect'), where the box crosses its edge~~~~~~
+    # scipy 'reflect' mirrors about the edge of the image (d c b a | a b c d), so a contribution landing
+    # j voxels outside the image belongs to the voxel j voxels inside it. After the correction nothing lands
+    # more than radius voxels outside
+    for axis in range(3):
+        canvas = np.moveaxis(canvas, axis, 0)
+        start, stop = box_start[axis], box_stop[axis]
+        core = canvas[max(start, 0) - start:min(stop, shape[axis]) - start]
+        if start < 0:
+            below = canvas[max(start, -radius) - start:-start]
+            core[:len(below)] += below[::-1]
+        if stop > shape[axis]:
+            above = canvas[shape[axis] - start:min(stop, shape[axis] + radius) - start]
+            core[len(core) - len(above):] += above[::-1]
+        canvas = np.moveaxis(core, 0, axis)
+
+    map_heatmap[tuple(slice(max(start, 0), min(stop, dim)) for start, stop, dim in zip(box_start, box_stop, shape))] = canvas
+    return map_heatmap
+
+def self_check(seed=0):
+    # splat_heatmap() against ndi.gaussian_filter on random stimulations (overlapping, repeated, on the edge of
+    # the image or, with a margin, away from it), for several dilations, smoothing widths and voxel sizes.
+    # Returns the largest difference relative to the largest heatmap value
+    rng = np.random.default_rng(seed)
+    worst = 0.0
+    for dilate, fwhm, voxel_size, shape, n_stims, margin in [[3, 6, (1.0, 1.0, 1.0), (40, 44, 36), 60, 0],
+                                                              [2, 4, (1.0, 1.2, 0.9), (30, 33, 28), 25, 0],
+                                                              [0, 3, (1.0, 1.0, 1.0), (24, 24, 24), 10, 0],
+                                                              [4, 0, (1.0, 1.0, 1.0), (20, 22, 21), 8, 0],
+                                                              [3, 6, (1.0, 1.0, 1.0), (64, 60, 50), 20, 14],
+                                                              [5, 10, (1.0, 1.0, 1.0), (64, 60, 50), 4, 0]]:
+        stim_coords = rng.integers(margin, np.array(shape) - margin, size=(n_stims, 3))
+        if margin == 0:
+            # a few stimulations on the edge of the image
+            stim_coords[:3, 0] = 0
+            stim_coords[3:5, 1] = shape[1] - 1
+        # and repeated
+        stim_coords[-2:] = stim_coords[-3]
+        stim_MEPs = rng.uniform(0.05, 5.0, n_stims)
+
+        map_samples = np.zeros(shape)
+        map_samples[tuple(stim_coords.T)] = stim_MEPs
+        # (as scattered, a repeated coordinate holds its last MEP)
+        stim_MEPs = map_samples[tuple(stim_coords.T)]
+        map_responses = mos_operators.dilate_max_sphere(map_samples, dilate, voxel_size)
+
+        stdev_gaussian = fwhm / 2.355
+        map_filtered = ndi.gaussian_filter(map_responses, stdev_gaussian, 0, mode='reflect')
+        map_splatted = splat_heatmap(map_responses, stim_coords, stim_MEPs, dilate, stdev_gaussian, voxel_size)
+        worst = max(worst, np.max(np.abs(map_splatted - map_filtered)) / np.max(np.abs(map_filtered)))
+    return worst
+
+if __name__ == '__main__':
+    # python mos_splat.py: equivalence check against ndi.gaussian_filter
+    difference = self_check()
+    print('splatted vs. filtered heatmaps: max relative difference '+str(difference))
+    if difference > 1e-12:
+        raise SystemExit('kernel splatting does not match ndi.gaussian_filter')
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+deSCRIPTion:
+    - startup benchmark: import time of each module in MODULES, each in a fresh interpreter (python -X importtime),
+      median of --repeat runs, plus the HEAVY modules that importing the GUI pulls in (should be none)
+    - python mos_startup_benchmark.py [--repeat 5] [--output import_times.csv] [--baseline import_times.csv]
+        --output   appends this run's times (date, python version, module, seconds) to a csv
+        --baseline compares against the latest times recorded in a csv, and exits with 1 if a module got more
+                   than --tolerance (default 25%) slower, or the GUI imports a heavy module
+"""
+
+import os
+import re
+import sys
+import csv
+import time
+import argparse
+import statistics
+import subprocess
+
+# modules timed, in the order the GUI / command line load them
+MODULES = ['tkinter', 'PIL.ImageTk', 'numpy', 'scipy.ndimage', 'nibabel', 'pandas', 'nipype.interfaces.fsl',
+           'mos_options', 'mos_find_datasets', 'mos_operators', 'mos_storage', 'mos_analysis_main',
+           'mos_analysis_group', 'mos_cli', 'mos_gui']
+
+# modules the GUI should only import once an analysis starts
+HEAVY = ['nipype', 'pandas', 'scipy', 'nibabel', 'mos_analysis_main', 'mos_analysis_group']
+
+# -X importtime lines: "import time: <self us> | <cumulative us> | <indented module name>"
+importtime_regex = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def import_times(statement):
+    # -X importtime of statement in a fresh interpreter: [module, cumulative seconds, top level] per import,
+    # None if it fails
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    times = list()
+    for line in result.stderr.splitlines():
+        line_match = importtime_regex.match(line)
+        if line_match is not None:
+            times.append([line_match.group(4), int(line_match.group(2)) / 1e6, len(line_match.group(3)) == 1])
+    return times
+
+def import_seconds(module, startup_modules):
+    # import time (s) of module, and the top-level packages it loaded, leaving out what the interpreter
+    # imports before running anything (startup_modules). None if it cannot be imported
+    times = import_times('import '+module)
+    if times is None:
+        return None, set()
+    times = [entry for entry in times if entry[0] not in startup_modules]
+    # top-level (unindented) entries add up to the whole import
+    seconds = sum(cumulative for name, cumulative, top_level in times if top_level)
+    return seconds, set(name.split('.')[0] for name, cumulative, top_level in times)
+
+def latest_baseline(file_baseline):
+    # module -> seconds from the last run recorded in a csv written by --output
+    baseline = dict()
+    with open(file_baseline, newline='') as f:
+        rows = list(csv.DictReader(f))
+    if len(rows) == 0:
+        return baseline
+    last_run = rows[-1]['date']
+    for row in rows:
+        if row['date'] == last_run and row['seconds'] != '':
+            baseline[row['module']] = float(row['seconds'])
+    return baseline
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='import time of the MOSAICS modules')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per module (median is reported)')
+    parser.add_argument('--output', help='csv to append this run to')
+    parser.add_argument('--baseline', help='csv of earlier runs to compare against (its latest run)')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown vs the baseline (fraction)')
+    args = parser.parse_args(argv)
+
+    run_date = time.strftime('%Y-%m-%d %H:%M:%S')
+    results = dict()
+    gui_heavy = set()
+    startup_modules = set(name for name, cumulative, top_level in import_times('pass'))
+    for module in MODULES:
+        runs = [import_seconds(module, startup_modules) for repeat in range(max(args.repeat, 1))]
+        if runs[0][0] is None:
+            results[module] = None
+            print('%-24s  not importable here' % module)
+            continue
+        results[module] = statistics.median(seconds for seconds, loaded in runs)
+        print('%-24s %7.3f s' % (module, results[module]))
+        if module == 'mos_gui':
+            gui_heavy = runs[0][1].intersection(HEAVY)
+
+    regressions = list()
+    if gui_heavy:
+        regressions.append('mos_gui imports '+', '.join(sorted(gui_heavy))+' at startup')
+    if args.baseline is not None and os.path.isfile(args.baseline):
+        for module, seconds in latest_baseline(args.baseline).items():
+            if results.get(module) is not None and results[module] > seconds * (1 + args.tolerance):
+                regressions.append('%s: %.3f s, was %.3f s' % (module, results[module], seconds))
+
+    if args.output is not None:
+        new_file = not os.path.isfile(args.output)
+        with open(args.output, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(['date', 'python', 'module', 'seconds'])
+            for module, seconds in results.items():
+                writer.writerow([run_date, sys.version.split()[0], module, '' if seconds is None else round(seconds, 4)])
+
+    for regression in regressions:
+        print('REGRESSION: '+regression)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+deSCRIPTion:
+    - on-disk data type of the output maps, set by configure_dict['storage'] (one of STORAGE_LIST)
+    - 'Full precision' writes every map as the array it is computed as (float64 as MOSAICS always has, or
+      float32 heatmaps / responses and a uint8 grid for memory-lean runs)
+    - 'Compact' writes, per kind of map:
+        grid      -> uint8 (0 / 1, exact)
+        responses -> int16 scaled by scl_slope / scl_inter (nibabel maps the map's minimum, 0, exactly)
+        heatmap   -> float32
+    - only final outputs are stored compactly, intermediate maps read back by FSL keep full precision
+"""
+
+import logging
+import numpy as np
+import nibabel as nib
+
+from mos_options import STORAGE_LIST
+
+parent_logger = logging.getLogger('main')
+
+# kind of map -> [data type, scaled]. scaled = stored as integers with scl_slope / scl_inter,
+# otherwise the values are cast (exact for grids, float32 rounding for heatmaps)
+STORAGE_DTYPES = {STORAGE_LIST[0]: dict(),
+                  STORAGE_LIST[1]: {'grid': [np.uint8, False],
+                                    'responses': [np.int16, True],
+                                    'heatmap': [np.float32, False]}}
+
+def storage_option(config_dict):
+    # configure_dict['storage'] is a tk.StringVar set from the configure dialogue, older dicts without the key
+    # keep full precision
+    storage = config_dict.get('storage', STORAGE_LIST[0])
+    if hasattr(storage, 'get'):
+        storage = storage.get()
+    if storage not in STORAGE_DTYPES:
+        parent_logger.warning('unknown storage option '+str(storage)+', saving maps at full precision')
+        storage = STORAGE_LIST[0]
+    return storage
+
+def nifti_image(map_in, affine, kind=None, storage=STORAGE_LIST[0], header=None):
+    # Nifti1Image of map_in, stored as the data type the storage option gives this kind of map
+    # (kind None, or full precision = unchanged)
+    if kind not in STORAGE_DTYPES[storage]:
+        return nib.Nifti1Image(map_in, affine, header)
+
+    dtype, scaled = STORAGE_DTYPES[storage][kind]
+    if not scaled:
+        map_in = np.asarray(map_in).astype(dtype)
+    nifti = nib.Nifti1Image(map_in, affine, header)
+    nifti.set_data_dtype(dtype)
+    return nifti
@@ -10,6 +10,9 @@ Created on Wed Feb 24 11:12:45 2021
 import os
 import logging
 from nipype.interfaces import fsl
+
+import mos_writer
+
 parent_logger = logging.getLogger('main')
 
 def main(tag, muscle, data_dir, save_dir, file_t1, file_heatmap_nomask, file_atlas):
@@ -19,15 +22,7 @@ def main(tag, muscle, data_dir, save_dir, file_t1, file_heatmap_nomask, file_atl
 
     # FLIRT section:
     # Register T1 image to MNI_152 template using FLIRT and FNIRT
-    warped_t1 = os.path.join(save_dir,tag+'_warped.nii.gz')
-    if not os.path.isfile(warped_t1):
-        t1_flirt_mni = fsl.FLIRT()
-        t1_flirt_mni.inputs.in_file = file_t1
-        t1_flirt_mni.inputs.reference = file_atlas
-        t1_flirt_mni.inputs.out_file = warped_t1
-        t1_flirt_mni.inputs.out_matrix_file = os.path.join(save_dir,tag+'_warped_omat.mat')
-        t1_flirt_mni.inputs.output_type = 'NIFTI_GZ'
-        flirt_result = t1_flirt_mni.run()
+    register_t1(tag, save_dir, file_t1, file_atlas)
     
     # I'm going to leave FNIRT out for now because... non-linear 
     # # 2. FNIRT t1 to MNI:
@@ -43,11 +38,30 @@ def main(tag, muscle, data_dir, save_dir, file_t1, file_heatmap_nomask, file_atl
     # rather than that and a BET mask
     heatmap_applyxfm.inputs.in_file = file_heatmap_nomask
     heatmap_applyxfm.inputs.in_matrix_file = os.path.join(save_dir,tag+'_warped_omat.mat')
-    heatmap_applyxfm.inputs.out_file = os.path.join(save_dir,tag+'_'+muscle+'_warped_heatmap.nii.gz')
+    file_heatmap_warped = os.path.join(save_dir,tag+'_'+muscle+'_warped_heatmap.nii.gz')
+    heatmap_applyxfm.inputs.out_file = mos_writer.temporary_file(file_heatmap_warped)
     heatmap_applyxfm.inputs.out_matrix_file = os.path.join(save_dir,tag+'_'+muscle+'_heatmap_flirt.mat')
     heatmap_applyxfm.inputs.reference = file_atlas
     heatmap_applyxfm.inputs.apply_xfm = True
     result = heatmap_applyxfm.run()
+    os.replace(mos_writer.temporary_file(file_heatmap_warped), file_heatmap_warped)
+
+def register_t1(tag, save_dir, file_t1, file_atlas, rerun=False):
+    # T1 -> atlas FLIRT, done once per subject (skipped if the warped T1 already exists, unless rerun).
+    # Called before the muscles are processed, so muscles running in parallel threads only apply the matrix
+    warped_t1 = os.path.join(save_dir,tag+'_warped.nii.gz')
+    if not os.path.isfile(warped_t1) or rerun:
+        t1_flirt_mni = fsl.FLIRT()
+        t1_flirt_mni.inputs.in_file = file_t1
+        t1_flirt_mni.inputs.reference = file_atlas
+        # written under temporary names and moved into place (matrix first, as the warped T1 marks FLIRT done)
+        file_omat = os.path.join(save_dir,tag+'_warped_omat.mat')
+        t1_flirt_mni.inputs.out_file = mos_writer.temporary_file(warped_t1)
+        t1_flirt_mni.inputs.out_matrix_file = mos_writer.temporary_file(file_omat)
+        t1_flirt_mni.inputs.output_type = 'NIFTI_GZ'
+        flirt_result = t1_flirt_mni.run()
+        os.replace(mos_writer.temporary_file(file_omat), file_omat)
+        os.replace(mos_writer.temporary_file(warped_t1), warped_t1)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+deSCRIPTion:
+    - deferred compression of the .nii.gz outputs, so gzip is not on the processing critical path
+    - save() writes the image uncompressed next to its destination (<name>_staged.nii), and a background
+      thread pool compresses it to the .nii.gz and removes the staged file (zlib releases the GIL, so
+      several outputs compress in parallel)
+    - the gzip level is configurable (configure_dict['gzip level'], 1 = nibabel's default), and
+      configure_dict['compression threads'] = 0 compresses each output as it is saved, as before
+    - plain .gz streams with a fixed mtime: readable by nibabel and FSL, same bytes for the same image
+    - the queue is bounded (QUEUE_PER_THREAD outputs per thread), save() waits for a compression to finish
+      rather than letting staged outputs pile up
+    - a run is only complete once drain() has waited for every queued output; each process has its own queue
+    - every output is written under a temporary name (temporary_file) and swapped into place once complete, so an
+      interrupted run never leaves a partial file that a later run would take as done
+"""
+
+import os
+import gzip
+import shutil
+import logging
+import threading
+import nibabel as nib
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+parent_logger = logging.getLogger('main')
+
+# outputs queued (or compressing) per compression thread before save() waits
+QUEUE_PER_THREAD = 4
+
+# the compression pool and the outputs queued on it (per process)
+writer_lock = threading.Lock()
+writer_dict = {'executor': None, 'threads': 0, 'level': 1, 'pending': list()}
+
+def writer_options(config_dict):
+    # configure_dict entries (or plain values), older dicts without them compress in 2 threads at level 1
+    threads = config_dict.get('compression threads', 2)
+    level = config_dict.get('gzip level', 1)
+    if hasattr(threads, 'get'):
+        threads = threads.get()
+    if hasattr(level, 'get'):
+        level = level.get()
+    return max(int(threads), 0), min(max(int(level), 1), 9)
+
+def start(config_dict):
+    # set up this process's writer, a new pool is only made when the number of threads changes
+    threads, level = writer_options(config_dict)
+    with writer_lock:
+        writer_dict['level'] = level
+        if threads != writer_dict['threads']:
+            if writer_dict['executor'] is not None:
+                writer_dict['executor'].shutdown(wait=True)
+            writer_dict['executor'] = ThreadPoolExecutor(max_workers=threads) if threads > 0 else None
+            writer_dict['threads'] = threads
+
+def temporary_file(filename):
+    # name a file is written under until it is complete (same folder and extension, so nibabel and FSL keep
+    # the format), then moved into place with os.replace()
+    for extension in ['.nii.gz', '.nii', '.mat']:
+        if filename.endswith(extension):
+            return filename[:-len(extension)]+'_tmp'+extension
+    return filename+'.tmp'
+
+def save_now(nifti, filename):
+    # nib.save(), swapped into place once complete
+    nib.save(nifti, temporary_file(filename))
+    os.replace(temporary_file(filename), filename)
+
+def staged_file(filename):
+    # uncompressed file the image is written to before compression
+    return filename[:-len('.nii.gz')]+'_staged.nii'
+
+def compress(file_staged, filename, level):
+    # gzip the staged file into a temporary file and swap it in, so readers never see a partial output
+    with open(file_staged, 'rb') as f_in, open(filename+'.tmp', 'wb') as f_raw:
+        with gzip.GzipFile(filename='', mode='wb', compresslevel=level, fileobj=f_raw, mtime=0) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1 << 20)
+    os.replace(filename+'.tmp', filename)
+    os.remove(file_staged)
+    return filename
+
+def save(nifti, filename):
+    # nib.save() for outputs nothing reads back during the run. Returns a Future, done once the file is in place
+    if not filename.endswith('.nii.gz'):
+        save_now(nifti, filename)
+        written = Future()
+        written.set_result(filename)
+        return written
+
+    file_staged = staged_file(filename)
+    nib.save(nifti, file_staged)
+    while True:
+        with writer_lock:
+            executor = writer_dict['executor']
+            level = writer_dict['level']
+            if executor is None:
+                break
+            # (finished outputs are dropped from the queue, failed ones kept for drain() to report)
+            writer_dict['pending'] = [future for future in writer_dict['pending']
+                                      if not future.done() or future.exception() is not None]
+            queued = [future for future in writer_dict['pending'] if not future.done()]
+            if len(queued) < writer_dict['threads'] * QUEUE_PER_THREAD:
+                written = executor.submit(compress, file_staged, filename, level)
+                written.filename = filename
+                writer_dict['pending'].append(written)
+                return written
+        # queue full
+        wait(queued, return_when=FIRST_COMPLETED)
+
+    written = Future()
+    written.set_result(compress(file_staged, filename, level))
+    return written
+
+def after_writes(written, function, *args):
+    # call function(*args) once every Future in written has finished, if they all succeeded (in the thread
+    # that finished the last one). It is queued like an output, so drain() also waits for it
+    written = list(written)
+    finished = Future()
+    finished.filename = getattr(function, '__name__', 'callback')+' after writing outputs'
+    remaining = [len(written)]
+    remaining_lock = threading.Lock()
+
+    def write_done(future):
+        with remaining_lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        try:
+            if all(future.exception() is None for future in written):
+                function(*args)
+            finished.set_result(None)
+        except Exception as error:
+            finished.set_exception(error)
+
+    with writer_lock:
+        writer_dict['pending'].append(finished)
+    if len(written) == 0:
+        remaining[0] = 1
+        write_done(None)
+    for future in written:
+        future.add_done_callback(write_done)
+
+def drain():
+    # wait for every queued output (and after_writes() call), returns False (after logging them) if any failed
+    all_written = True
+    while True:
+        with writer_lock:
+            pending = writer_dict['pending']
+            writer_dict['pending'] = list()
+        if len(pending) == 0:
+            return all_written
+        wait(pending)
+        for future in pending:
+            if future.exception() is not None:
+                parent_logger.error('writing '+future.filename+' failed ('+repr(future.exception())+')')
+                all_written = False